@@ -1,17 +1,130 @@
 import os
+import hashlib
+import itertools
+import json
+import pickle
+import uuid
+from functools import partial
 import numpy as np
 from ml_collections import ConfigDict
 import mlxu
 import jax
 import jax.numpy as jnp
+from jax.sharding import NamedSharding
+from jax.interpreters import pxla
+from jax.experimental.multihost_utils import sync_global_devices
 import flax
 from flax.serialization import (
     from_bytes, to_bytes, to_state_dict, from_state_dict
 )
 from flax.traverse_util import flatten_dict, unflatten_dict, empty_node
 import msgpack
+import fsspec
 
-from EasyLM.jax_utils import tree_apply, float_tensor_to_dtype
+from EasyLM.jax_utils import (
+    tree_apply, float_tensor_to_dtype, get_float_dtype_by_name
+)
+
+
+CHECKPOINT_LOG_FILENAME = 'checkpoint_log.json'
+
+
+def file_exists(path):
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    return fs.exists(fs_path)
+
+
+def shard_index_to_bounds(index, shape):
+    """ Convert the tuple of slices indexing a shard of a global array into
+        a hashable tuple of (start, stop) pairs.
+    """
+    return tuple(
+        (s.start or 0, dim if s.stop is None else s.stop)
+        for s, dim in zip(index, shape)
+    )
+
+
+def quantize_blockwise(tensor, quantization, block_size):
+    """ Quantize a float tensor into int8 or fp8 (e4m3) blocks of block_size
+        consecutive elements, each block scaled by its own absmax.
+    """
+    tensor = np.asarray(tensor, dtype=np.float32)
+    flat = tensor.reshape(-1)
+    blocks = np.pad(flat, (0, (-flat.size) % block_size)).reshape(-1, block_size)
+    absmax = np.max(np.abs(blocks), axis=1, keepdims=True)
+    if quantization == 'int8':
+        scales = absmax / 127.0
+        blocks = blocks / np.where(scales == 0, 1.0, scales)
+        values = np.clip(np.round(blocks), -127, 127).astype(np.int8)
+    elif quantization == 'fp8':
+        scales = absmax / float(jnp.finfo(jnp.float8_e4m3fn).max)
+        blocks = blocks / np.where(scales == 0, 1.0, scales)
+        values = blocks.astype(jnp.float8_e4m3fn).view(np.uint8)
+    else:
+        raise ValueError(f'Unsupported quantization: {quantization}')
+    return {
+        'values': values,
+        'scales': scales.astype(np.float32),
+        'shape': list(tensor.shape),
+    }
+
+
+def dequantize_blockwise(quantized, quantization):
+    """ Inverse of quantize_blockwise, returns a float32 tensor. """
+    values = quantized['values']
+    if quantization == 'fp8':
+        values = values.view(jnp.float8_e4m3fn)
+    blocks = values.astype(np.float32) * quantized['scales']
+    shape = tuple(quantized['shape'])
+    return blocks.reshape(-1)[:int(np.prod(shape))].reshape(shape)
+
+
+def encode_tensor(tensor, float_dtype=None, compression='',
+                  compression_level=3, quantization='',
+                  quantization_block_size=256):
+    """ Serialize a tensor for the streaming format. Returns the bytes and
+        the list of encodings applied to them, which is empty for the plain
+        format.
+    """
+    encoding = []
+    if (quantization != '' and getattr(tensor, 'ndim', 0) >= 2
+            and jnp.issubdtype(tensor.dtype, jnp.floating)):
+        quantized = quantize_blockwise(
+            tensor, quantization, quantization_block_size
+        )
+        quantized['dtype'] = np.dtype(
+            float_tensor_to_dtype(tensor, float_dtype).dtype
+        ).name
+        value = flax.serialization.msgpack_serialize(quantized)
+        encoding.append(quantization)
+    else:
+        value = to_bytes(float_tensor_to_dtype(tensor, float_dtype))
+
+    if compression == 'zstd':
+        import zstandard
+        value = zstandard.ZstdCompressor(level=compression_level).compress(value)
+        encoding.append(compression)
+    elif compression != '':
+        raise ValueError(f'Unsupported compression: {compression}')
+    return value, encoding
+
+
+def decode_tensor(value, encoding=None):
+    """ Inverse of encode_tensor. """
+    if not encoding:
+        return from_bytes(None, value)
+    for stage in reversed(encoding):
+        if stage == 'zstd':
+            import zstandard
+            value = zstandard.ZstdDecompressor().decompress(value)
+        elif stage in ('int8', 'fp8'):
+            quantized = flax.serialization.msgpack_restore(value)
+            return dequantize_blockwise(quantized, stage).astype(
+                get_float_dtype_by_name(quantized['dtype'])
+            )
+        else:
+            raise ValueError(f'Unsupported checkpoint encoding: {stage}')
+    return from_bytes(None, value)
 
 
 class StreamingCheckpointer(object):
@@ -25,6 +138,15 @@ class StreamingCheckpointer(object):
         config = ConfigDict()
         config.float_dtype = 'bf16'
         config.save_optimizer_state = False
+        config.incremental = False
+        config.compression = ''
+        config.compression_level = 3
+        config.quantization = ''
+        config.quantization_block_size = 256
+        config.keep_last_n = 0
+        config.save_optimizer_state_sharded = False
+        config.optimizer_state_float_dtype = ''
+        config.save_gradient_accumulators = True
 
         if updates is not None:
             config.update(ConfigDict(updates).copy_and_resolve_references())
@@ -32,20 +154,42 @@ class StreamingCheckpointer(object):
 
     def __init__(self, config, checkpoint_dir, enable=True):
         self.config = self.get_default_config(config)
+        assert not (self.config.quantization and self.config.save_optimizer_state), (
+            'Quantized checkpoints only support saving params!'
+        )
+        assert not (self.config.save_optimizer_state_sharded and self.config.incremental), (
+            'Sharded optimizer state is not supported in incremental mode!'
+        )
         self.checkpoint_dir = checkpoint_dir
         self.enable = enable
+        self._checkpoint_log = None
+        # Incremental mode bookkeeping: the tensor table of the last delta
+        # manifest saved for each checkpoint name, and the data files that
+        # each manifest written by this checkpointer refers to.
+        self._delta_tensors = {}
+        self._delta_references = {}
+        self._delta_files_created = set()
 
     def save_checkpoint(self, train_state, filename, gather_fns=None):
-        if self.enable:
-            path = os.path.join(self.checkpoint_dir, filename)
-        else:
-            path = '/dev/null'
         self.save_train_state_to_file(
-            train_state, path, gather_fns, self.config.float_dtype
+            train_state, self._get_temporary_path(filename), gather_fns,
+            **self._get_encoding_kwargs()
+        )
+        self._commit_file(filename)
+
+    def _get_encoding_kwargs(self):
+        return dict(
+            float_dtype=self.config.float_dtype,
+            compression=self.config.compression,
+            compression_level=self.config.compression_level,
+            quantization=self.config.quantization,
+            quantization_block_size=self.config.quantization_block_size,
         )
 
     @staticmethod
-    def save_train_state_to_file(train_state, path, gather_fns=None, float_dtype=None):
+    def save_train_state_to_file(train_state, path, gather_fns=None, float_dtype=None,
+                                 compression='', compression_level=3,
+                                 quantization='', quantization_block_size=256):
         train_state = to_state_dict(train_state)
         packer = msgpack.Packer()
         flattend_train_state = flatten_dict(train_state)
@@ -56,15 +200,295 @@ class StreamingCheckpointer(object):
             for key, value in flattend_train_state.items():
                 if gather_fns is not None:
                     value = gather_fns[key](value)
-                value = float_tensor_to_dtype(value, float_dtype)
-                fout.write(packer.pack((key, to_bytes(value))))
+                value, encoding = encode_tensor(
+                    value, float_dtype, compression, compression_level,
+                    quantization, quantization_block_size
+                )
+                fout.write(StreamingCheckpointer._pack_record(packer, key, value, encoding))
+
+    def save_sharded_checkpoint(self, train_state, filename, gather_fns=None):
+        """ Save a train state without gathering the optimizer state to the
+            host. The params and the step are gathered and saved to the main
+            file as usual, while the optimizer state tensors are only recorded
+            there by their shapes and dtypes. Every process then saves the
+            optimizer state shards it holds to its own file next to the main
+            file, named with a .process_<index> suffix.
+        """
+        train_state = to_state_dict(train_state)
+        packer = msgpack.Packer()
+        flattend_train_state = flatten_dict(train_state)
+        if gather_fns is not None:
+            gather_fns = flatten_dict(to_state_dict(gather_fns))
+
+        sharded_tensors = {}
+        with mlxu.open_file(self._get_temporary_path(filename), "wb") as fout:
+            for key, value in flattend_train_state.items():
+                if key[0] == 'opt_state' and isinstance(value, jax.Array):
+                    if (not self.config.save_gradient_accumulators
+                            and self._is_gradient_accumulator(key)):
+                        # Restored as zeros, which starts a new accumulation
+                        encoding = ['zeros']
+                    else:
+                        encoding = ['sharded']
+                        sharded_tensors[key] = value
+                    value = flax.serialization.msgpack_serialize({
+                        'shape': list(value.shape),
+                        'dtype': np.dtype(value.dtype).name,
+                    })
+                    fout.write(self._pack_record(packer, key, value, encoding))
+                    continue
+                if gather_fns is not None:
+                    value = gather_fns[key](value)
+                value, encoding = encode_tensor(value, **self._get_encoding_kwargs())
+                fout.write(self._pack_record(packer, key, value, encoding))
+        self._commit_file(filename)
+
+        self._save_process_shards(
+            sharded_tensors, self._get_process_filename(filename, jax.process_index()),
+            self.config.optimizer_state_float_dtype or self.config.float_dtype,
+        )
+        # The checkpoint is only complete after every process saved its shards
+        sync_global_devices(f'streaming_checkpointer_{filename}')
+
+    def _save_process_shards(self, flattened_tensors, process_filename, float_dtype):
+        # Every process writes its own file, so unlike the other files this
+        # is not gated by self.enable, which is only set on process 0.
+        path = os.path.join(self.checkpoint_dir, process_filename)
+        packer = msgpack.Packer()
+        with mlxu.open_file(path + '.tmp', "wb") as fout:
+            for key, value in flattened_tensors.items():
+                saved_indices = set()
+                for shard in value.addressable_shards:
+                    # Replicated shards are only saved once
+                    bounds = shard_index_to_bounds(shard.index, value.shape)
+                    if bounds in saved_indices:
+                        continue
+                    saved_indices.add(bounds)
+                    data = float_tensor_to_dtype(np.asarray(shard.data), float_dtype)
+                    fout.write(packer.pack(
+                        (key, [list(b) for b in bounds], to_bytes(data))
+                    ))
+        fs, tmp_path = fsspec.core.url_to_fs(path + '.tmp')
+        _, fs_path = fsspec.core.url_to_fs(path)
+        fs.mv(tmp_path, fs_path)
+
+    @staticmethod
+    def _get_process_filename(filename, process_index):
+        return f'{filename}.process_{process_index}'
+
+    @staticmethod
+    def _is_gradient_accumulator(key):
+        # optax.MultiSteps keeps the accumulated gradients and the micro step
+        return 'acc_grads' in key or 'mini_step' in key
+
+    @staticmethod
+    def _pack_record(packer, key, value, encoding):
+        # Plain tensors keep the original (key, value) record format, so that
+        # these checkpoints can still be read by older versions of EasyLM.
+        if encoding:
+            return packer.pack((key, value, encoding))
+        return packer.pack((key, value))
+
+    def save_delta_checkpoint(self, train_state, filename, gather_fns=None,
+                              chain_name=None, step=0):
+        """ Save a train state incrementally. Every tensor is hashed after the
+            dtype conversion, and only the tensors whose digest differs from
+            the previous save of the same chain are written to a new data file.
+            The file at filename becomes a small manifest that maps every key
+            to the data file holding its latest value.
+        """
+        if chain_name is None:
+            chain_name = filename
+        if chain_name not in self._delta_tensors:
+            # Continue the chain of a previous run if its manifest is present
+            previous_filename, previous = self._load_latest_delta_manifest(chain_name)
+            if previous is not None:
+                self._delta_tensors[chain_name] = previous['tensors']
+                self._delta_references[previous_filename] = set(
+                    data_file for data_file, _ in previous['tensors'].values()
+                )
+        previous_tensors = self._delta_tensors.get(chain_name, {})
+
+        train_state = to_state_dict(train_state)
+        packer = msgpack.Packer()
+        flattend_train_state = flatten_dict(train_state)
+        if gather_fns is not None:
+            gather_fns = flatten_dict(to_state_dict(gather_fns))
+
+        # Every save writes a new data file, so that a data file referenced
+        # by a manifest is never overwritten, even when the same filename is
+        # saved twice at the same step.
+        data_filename = f'{filename}.delta_{step}_{uuid.uuid4().hex[:8]}'
+        tensors = {}
+        num_written = 0
+        with mlxu.open_file(self._get_temporary_path(data_filename), "wb") as fout:
+            for key, value in flattend_train_state.items():
+                if gather_fns is not None:
+                    value = gather_fns[key](value)
+                value, encoding = encode_tensor(value, **self._get_encoding_kwargs())
+                digest = hashlib.blake2b(value, digest_size=16).hexdigest()
+                if key in previous_tensors and previous_tensors[key][1] == digest:
+                    tensors[key] = previous_tensors[key]
+                else:
+                    fout.write(self._pack_record(packer, key, value, encoding))
+                    tensors[key] = (data_filename, digest)
+                    num_written += 1
+        if num_written > 0:
+            self._commit_file(data_filename)
+            self._delta_files_created.add(data_filename)
+        else:
+            # Nothing changed since the previous save
+            self._remove_temporary_file(data_filename)
+
+        self.save_pickle({'format': 'delta', 'tensors': tensors}, filename)
+        self._delta_tensors[chain_name] = tensors
+        stale = self._delta_references.get(filename, set())
+        self._delta_references[filename] = set(
+            data_file for data_file, _ in tensors.values()
+        )
+        self._collect_delta_garbage(stale)
+
+    def _load_latest_delta_manifest(self, chain_name):
+        # The chain continues from the last regular checkpoint, since the
+        # milestone checkpoints are never saved again.
+        entry = self._get_latest_log_entry(
+            [e for e in self._get_checkpoint_log() if not e['milestone']],
+            chain_name
+        )
+        if entry is None or not entry.get('incremental', False):
+            return None, None
+        try:
+            manifest = mlxu.load_pickle(
+                os.path.join(self.checkpoint_dir, entry['checkpoint'])
+            )
+        except (FileNotFoundError, pickle.UnpicklingError):
+            return None, None
+        return entry['checkpoint'], manifest
+
+    def _collect_delta_garbage(self, candidates):
+        """ Delete the candidate data files that are no longer referenced by
+            any manifest. Only data files created by this checkpointer are
+            deleted, since manifests written by a previous run are not tracked.
+        """
+        live = set().union(*self._delta_references.values())
+        for data_filename in (set(candidates) - live) & self._delta_files_created:
+            self._remove_file(data_filename)
+            self._delta_files_created.discard(data_filename)
+
+    def _get_path(self, filename):
+        if self.enable:
+            return os.path.join(self.checkpoint_dir, filename)
+        return '/dev/null'
+
+    def _get_temporary_path(self, filename):
+        """ Files are written under a temporary name and renamed into place by
+            _commit_file once complete, so that a preemption in the middle of
+            a save never corrupts an existing file.
+        """
+        if self.enable:
+            return os.path.join(self.checkpoint_dir, filename + '.tmp')
+        return '/dev/null'
+
+    def _commit_file(self, filename):
+        if not self.enable:
+            return
+        fs, tmp_path = fsspec.core.url_to_fs(self._get_temporary_path(filename))
+        _, fs_path = fsspec.core.url_to_fs(self._get_path(filename))
+        fs.mv(tmp_path, fs_path)
+
+    def _remove_temporary_file(self, filename):
+        if not self.enable:
+            return
+        fs, tmp_path = fsspec.core.url_to_fs(self._get_temporary_path(filename))
+        if fs.exists(tmp_path):
+            fs.rm(tmp_path)
+
+    def _remove_file(self, filename):
+        if not self.enable:
+            return
+        fs, fs_path = fsspec.core.url_to_fs(self._get_path(filename))
+        if fs.exists(fs_path):
+            fs.rm(fs_path)
+
+    def _remove_checkpoint_file(self, filename):
+        self._remove_file(filename)
+        if self.config.save_optimizer_state_sharded:
+            for process_index in range(jax.process_count()):
+                self._remove_file(self._get_process_filename(filename, process_index))
+        if filename in self._delta_references:
+            self._collect_delta_garbage(self._delta_references.pop(filename))
 
     def save_pickle(self, obj, filename):
+        mlxu.save_pickle(obj, self._get_temporary_path(filename))
+        self._commit_file(filename)
+
+    def _get_checkpoint_log(self):
+        if self._checkpoint_log is None:
+            if self.enable:
+                self._checkpoint_log = self.read_checkpoint_log(self.checkpoint_dir)
+            else:
+                self._checkpoint_log = []
+        return self._checkpoint_log
+
+    @staticmethod
+    def read_checkpoint_log(checkpoint_dir):
+        """ Read the list of complete checkpoints in checkpoint_dir, which is
+            empty if the directory is not written by StreamingCheckpointer.
+        """
+        path = os.path.join(checkpoint_dir, CHECKPOINT_LOG_FILENAME)
+        if not file_exists(path):
+            return []
+        with mlxu.open_file(path, 'r') as fin:
+            return json.loads(fin.read())
+
+    @staticmethod
+    def _get_latest_log_entry(checkpoint_log, checkpoint_name):
+        entries = [e for e in checkpoint_log if e['name'] == checkpoint_name]
+        if len(entries) == 0:
+            return None
+        return max(entries, key=lambda e: e['step'])
+
+    def _commit_checkpoint(self, entry):
+        """ Record a complete checkpoint in the checkpoint log and apply the
+            keep_last_n retention policy. The log is only updated after all the
+            files of the checkpoint are in place, so every logged checkpoint
+            is complete.
+        """
+        checkpoint_log = self._get_checkpoint_log()
+        for previous in checkpoint_log:
+            if previous['checkpoint'] == entry['checkpoint']:
+                # The same files were saved again, keep the milestone status
+                entry['milestone'] = entry['milestone'] or previous['milestone']
+        checkpoint_log = [
+            e for e in checkpoint_log if e['checkpoint'] != entry['checkpoint']
+        ]
+        checkpoint_log.append(entry)
+
+        retired = []
+        if self.config.keep_last_n > 0:
+            regular = sorted(
+                [e for e in checkpoint_log
+                 if e['name'] == entry['name'] and not e['milestone']],
+                key=lambda e: e['step']
+            )
+            retired = regular[:-self.config.keep_last_n]
+            checkpoint_log = [e for e in checkpoint_log if e not in retired]
+
+        self._checkpoint_log = checkpoint_log
         if self.enable:
-            path = os.path.join(self.checkpoint_dir, filename)
-        else:
-            path = '/dev/null'
-        mlxu.save_pickle(obj, path)
+            with mlxu.open_file(self._get_temporary_path(CHECKPOINT_LOG_FILENAME), 'w') as fout:
+                fout.write(json.dumps(checkpoint_log, indent=2))
+            self._commit_file(CHECKPOINT_LOG_FILENAME)
+
+        live_files = set()
+        for e in checkpoint_log:
+            live_files.update((e['checkpoint'], e['metadata'], e['dataset']))
+        for e in retired:
+            if e['checkpoint'] not in live_files:
+                self._remove_checkpoint_file(e['checkpoint'])
+            for filename in (e['metadata'], e['dataset']):
+                if filename not in live_files:
+                    self._remove_file(filename)
 
     def save_all(self, train_state, gather_fns, metadata=None, dataset=None, milestone=False, is_value=False):
         step = int(jax.device_get(train_state.step))
@@ -80,20 +504,59 @@ class StreamingCheckpointer(object):
         if is_value:
             checkpoint_name = 'value_' + checkpoint_name
 
-        if milestone:
-            # Save a milestone checkpoint that will not be overwritten
-            self.save_pickle(metadata, f'metadata_{step}.pkl')
-            self.save_pickle(dataset, f'dataset_{step}.pkl')
-            self.save_checkpoint(
-                checkpoint_state, f'{checkpoint_name}_{step}', checkpoint_gather_fns
+        if self.config.incremental:
+            save_checkpoint = partial(
+                self.save_delta_checkpoint, chain_name=checkpoint_name, step=step
             )
+        elif self.config.save_optimizer_state and self.config.save_optimizer_state_sharded:
+            save_checkpoint = self.save_sharded_checkpoint
+        else:
+            save_checkpoint = self.save_checkpoint
+
+        if milestone or self.config.keep_last_n > 0:
+            # Save a checkpoint with the step in the file names. Milestone
+            # checkpoints will never be overwritten or deleted, while regular
+            # checkpoints are subject to the keep_last_n retention policy.
+            suffix = f'_{step}'
         else:
             # Save a normal checkpoint that can be overwritten
-            self.save_pickle(metadata, 'metadata.pkl')
-            self.save_pickle(dataset, 'dataset.pkl')
-            self.save_checkpoint(
-                checkpoint_state, f'{checkpoint_name}', checkpoint_gather_fns
-            )
+            suffix = ''
+
+        # The tensors are saved first since they take the longest to write,
+        # which keeps the metadata and dataset state consistent with them.
+        save_checkpoint(
+            checkpoint_state, f'{checkpoint_name}{suffix}', checkpoint_gather_fns
+        )
+        self.save_pickle(metadata, f'metadata{suffix}.pkl')
+        self.save_pickle(dataset, f'dataset{suffix}.pkl')
+        self._commit_checkpoint(dict(
+            name=checkpoint_name,
+            step=step,
+            milestone=milestone,
+            incremental=self.config.incremental,
+            checkpoint=f'{checkpoint_name}{suffix}',
+            metadata=f'metadata{suffix}.pkl',
+            dataset=f'dataset{suffix}.pkl',
+        ))
+
+    @classmethod
+    def resolve_latest_checkpoint(cls, checkpoint_dir, checkpoint_name='streaming_params'):
+        """ Return the paths of the latest complete checkpoint with the given
+            name in checkpoint_dir, or None if there is no such checkpoint.
+        """
+        checkpoint_log = cls.read_checkpoint_log(checkpoint_dir)
+        # Skip checkpoints whose files have been removed by hand
+        checkpoint_log = [
+            e for e in checkpoint_log
+            if file_exists(os.path.join(checkpoint_dir, e['checkpoint']))
+        ]
+        entry = cls._get_latest_log_entry(checkpoint_log, checkpoint_name)
+        if entry is None:
+            return None
+        entry = dict(entry)
+        for key in ('checkpoint', 'metadata', 'dataset'):
+            entry[key] = os.path.join(checkpoint_dir, entry[key])
+        return entry
 
     @staticmethod
     def load_checkpoint(path, target=None, shard_fns=None, remove_dict_prefix=None, keys_to_ignore=None):
@@ -101,14 +564,97 @@ class StreamingCheckpointer(object):
             shard_fns = flatten_dict(
                 to_state_dict(shard_fns)
             )
+        flattend_train_state = StreamingCheckpointer._load_flattened(
+            path, shard_fns, remove_dict_prefix, keys_to_ignore
+        )
+        return StreamingCheckpointer._restore_from_flattened(
+            flattend_train_state, target
+        )
+
+    @staticmethod
+    def load_delta_checkpoint(path, target=None, shard_fns=None, remove_dict_prefix=None, keys_to_ignore=None):
+        """ Load a checkpoint saved in incremental mode. The manifest at path
+            maps every key to the data file holding its latest value, so each
+            data file in the chain is streamed once for the keys it owns.
+        """
+        if shard_fns is not None:
+            shard_fns = flatten_dict(
+                to_state_dict(shard_fns)
+            )
+        manifest = mlxu.load_pickle(path)
+        assert manifest.get('format') == 'delta', f'{path} is not a delta manifest!'
+        keys_by_file = {}
+        for key, (data_filename, _) in manifest['tensors'].items():
+            keys_by_file.setdefault(data_filename, set()).add(key)
+
+        flattend_train_state = {}
+        checkpoint_dir = os.path.dirname(path)
+        for data_filename, keys in keys_by_file.items():
+            flattend_train_state.update(StreamingCheckpointer._load_flattened(
+                os.path.join(checkpoint_dir, data_filename), shard_fns,
+                remove_dict_prefix, keys_to_ignore, keys_to_load=keys
+            ))
+        return StreamingCheckpointer._restore_from_flattened(
+            flattend_train_state, target
+        )
+
+    @staticmethod
+    def iterate_checkpoint(path, remove_dict_prefix=None, keys_to_ignore=None,
+                           keys_to_load=None):
+        """ Iterate over the (key, tensor) pairs of a streaming checkpoint
+            file on the host, decoding one tensor at a time. This allows
+            processing checkpoints larger than the host memory.
+        """
+        if remove_dict_prefix is not None:
+            remove_dict_prefix = tuple(remove_dict_prefix)
+        with mlxu.open_file(path) as fin:
+            unpacker = msgpack.Unpacker(fin, read_size=83886080, max_buffer_size=0)
+            for record in unpacker:
+                key = tuple(record[0])
+                if keys_to_load is not None and key not in keys_to_load:
+                    continue
+                if keys_to_ignore is not None and key in keys_to_ignore:
+                    continue
+                if remove_dict_prefix is not None:
+                    if key[:len(remove_dict_prefix)] == remove_dict_prefix:
+                        key = key[len(remove_dict_prefix):]
+                    else:
+                        continue
+                yield key, decode_tensor(record[1], record[2] if len(record) > 2 else None)
+
+    @staticmethod
+    def iterate_delta_checkpoint(path, remove_dict_prefix=None, keys_to_ignore=None):
+        """ Same as iterate_checkpoint for a checkpoint saved in incremental
+            mode, streaming each data file of the manifest at path for the
+            keys it owns.
+        """
+        manifest = mlxu.load_pickle(path)
+        assert manifest.get('format') == 'delta', f'{path} is not a delta manifest!'
+        keys_by_file = {}
+        for key, (data_filename, _) in manifest['tensors'].items():
+            keys_by_file.setdefault(data_filename, set()).add(key)
+        checkpoint_dir = os.path.dirname(path)
+        for data_filename, keys in keys_by_file.items():
+            yield from StreamingCheckpointer.iterate_checkpoint(
+                os.path.join(checkpoint_dir, data_filename), remove_dict_prefix,
+                keys_to_ignore, keys_to_load=keys
+            )
+
+    @staticmethod
+    def _load_flattened(path, shard_fns=None, remove_dict_prefix=None,
+                        keys_to_ignore=None, keys_to_load=None):
         if remove_dict_prefix is not None:
             remove_dict_prefix = tuple(remove_dict_prefix)
         flattend_train_state = {}
+        deferred_tensors = {}
         with mlxu.open_file(path) as fin:
             # 83886080 bytes = 80 MB, which is 16 blocks on GCS
             unpacker = msgpack.Unpacker(fin, read_size=83886080, max_buffer_size=0)
-            for key, value in unpacker:
-                key = tuple(key)
+            for record in unpacker:
+                key, value = tuple(record[0]), record[1]
+                saved_key = key
+                if keys_to_load is not None and key not in keys_to_load:
+                    continue
                 if keys_to_ignore is not None and key in keys_to_ignore:
                     continue
                 if remove_dict_prefix is not None:
@@ -117,11 +663,84 @@ class StreamingCheckpointer(object):
                     else:
                         continue
 
-                tensor = from_bytes(None, value)
+                encoding = record[2] if len(record) > 2 else None
+                if encoding and encoding[0] in ('sharded', 'zeros'):
+                    # Tensors saved in the sharded form are only described
+                    # in the main file
+                    deferred_tensors[saved_key] = (
+                        key, encoding[0], flax.serialization.msgpack_restore(value)
+                    )
+                    continue
+                tensor = decode_tensor(value, encoding)
                 if shard_fns is not None:
                     tensor = shard_fns[key](tensor)
                 flattend_train_state[key] = tensor
 
+        if len(deferred_tensors) > 0:
+            flattend_train_state.update(StreamingCheckpointer._load_process_shards(
+                path, deferred_tensors, shard_fns
+            ))
+        return flattend_train_state
+
+    @staticmethod
+    def _load_process_shards(path, deferred_tensors, shard_fns):
+        """ Load the tensors saved in the sharded form directly onto the
+            devices of this process, using the partition specs of shard_fns
+            under the current mesh. Zeros are created for the tensors that
+            were not saved.
+        """
+        assert shard_fns is not None, (
+            'Loading the sharded optimizer state requires shard_fns!'
+        )
+        mesh = pxla.thread_resources.env.physical_mesh
+
+        def make_array(key, metadata, shard_getter):
+            shape = tuple(metadata['shape'])
+            dtype = jnp.dtype(metadata['dtype'])
+            sharding = NamedSharding(mesh, shard_fns[key].partition_spec)
+            return jax.make_array_from_callback(
+                shape, sharding,
+                lambda index: shard_getter(
+                    shard_index_to_bounds(index, shape)
+                ).astype(dtype)
+            )
+
+        flattend_train_state = {}
+        for key, kind, metadata in deferred_tensors.values():
+            if kind == 'zeros':
+                flattend_train_state[key] = make_array(
+                    key, metadata,
+                    lambda bounds: np.zeros([stop - start for start, stop in bounds])
+                )
+
+        sharded_tensors = {
+            saved_key: (key, metadata)
+            for saved_key, (key, kind, metadata) in deferred_tensors.items()
+            if kind == 'sharded'
+        }
+        if len(sharded_tensors) == 0:
+            return flattend_train_state
+
+        process_path = StreamingCheckpointer._get_process_filename(
+            path, jax.process_index()
+        )
+        with mlxu.open_file(process_path) as fin:
+            unpacker = msgpack.Unpacker(fin, read_size=83886080, max_buffer_size=0)
+            # The shards of each tensor are stored contiguously
+            records = itertools.groupby(unpacker, key=lambda r: tuple(r[0]))
+            for saved_key, tensor_records in records:
+                if saved_key not in sharded_tensors:
+                    continue
+                shards = {
+                    tuple(tuple(b) for b in bounds): from_bytes(None, value)
+                    for _, bounds, value in tensor_records
+                }
+                key, metadata = sharded_tensors[saved_key]
+                flattend_train_state[key] = make_array(key, metadata, shards.__getitem__)
+        return flattend_train_state
+
+    @staticmethod
+    def _restore_from_flattened(flattend_train_state, target=None):
         if target is not None:
             flattened_target = flatten_dict(
                 to_state_dict(target), keep_empty_nodes=True
@@ -136,6 +755,48 @@ class StreamingCheckpointer(object):
 
         return from_state_dict(target, train_state)
 
+    @classmethod
+    def iterate_params_checkpoint(cls, load_from):
+        """ Iterate over the (key, tensor) pairs of the params of a checkpoint
+            specified with the load types of load_trainstate_checkpoint. The
+            streaming and incremental formats are read one tensor at a time,
+            while the other load types, such as flax_params, are loaded into
+            the host memory as a whole.
+        """
+        load_type, load_path = load_from.split('::', 1)
+        incremental = load_type.startswith('delta_')
+        if incremental:
+            load_type = load_type[len('delta_'):]
+        if load_type not in ('params', 'trainstate_params'):
+            with jax.default_device(jax.devices('cpu')[0]):
+                _, params = cls.load_trainstate_checkpoint(
+                    load_from, disallow_trainstate=True
+                )
+            for key, tensor in flatten_dict(params['params']).items():
+                yield key, jax.device_get(tensor)
+            return
+
+        checkpoint_name = {
+            'params': 'streaming_params',
+            'trainstate_params': 'streaming_train_state',
+        }[load_type]
+        latest = cls.resolve_latest_checkpoint(load_path, checkpoint_name)
+        if latest is not None:
+            load_path = latest['checkpoint']
+            incremental = latest['incremental']
+        if load_type == 'trainstate_params':
+            remove_dict_prefix = ('params', 'params')
+        else:
+            remove_dict_prefix = None
+        if incremental:
+            yield from cls.iterate_delta_checkpoint(
+                load_path, remove_dict_prefix=remove_dict_prefix
+            )
+        else:
+            yield from cls.iterate_checkpoint(
+                load_path, remove_dict_prefix=remove_dict_prefix
+            )
+
     @staticmethod
     def load_flax_checkpoint(path, target=None, shard_fns=None):
         """ Load a standard flax checkpoint that's not saved with the
@@ -169,13 +830,33 @@ class StreamingCheckpointer(object):
             params_shard_fns = None
 
         load_type, load_path = load_from.split('::', 1)
+        if load_type.startswith('delta_'):
+            # Checkpoints saved in incremental mode
+            load_type = load_type[len('delta_'):]
+            load_fn = cls.load_delta_checkpoint
+        else:
+            load_fn = cls.load_checkpoint
+
+        if load_type in ('trainstate', 'trainstate_params', 'params'):
+            # A checkpoint directory resolves to its latest complete checkpoint
+            checkpoint_name = {
+                'trainstate': 'streaming_train_state',
+                'trainstate_params': 'streaming_train_state',
+                'params': 'streaming_params',
+            }[load_type]
+            latest = cls.resolve_latest_checkpoint(load_path, checkpoint_name)
+            if latest is not None:
+                load_path = latest['checkpoint']
+                if latest['incremental']:
+                    load_fn = cls.load_delta_checkpoint
+
         if disallow_trainstate:
             assert load_type != 'trainstate', 'Loading full trainstate is not allowed!'
         train_state = None
         restored_params = None
         if load_type == 'trainstate':
             # Load the entire train state in the streaming format
-            train_state = cls.load_checkpoint(
+            train_state = load_fn(
                 path=load_path,
                 target=trainstate_target,
                 shard_fns=trainstate_shard_fns,
@@ -183,7 +864,7 @@ class StreamingCheckpointer(object):
             )
         elif load_type == 'trainstate_params':
             # Load the params part of the train state in the streaming format
-            restored_params = cls.load_checkpoint(
+            restored_params = load_fn(
                 path=load_path,
                 target=params_target,
                 shard_fns=params_shard_fns,
@@ -195,7 +876,7 @@ class StreamingCheckpointer(object):
             )
         elif load_type == 'params':
             # Load the params in the streaming format
-            restored_params = cls.load_checkpoint(
+            restored_params = load_fn(
                 path=load_path,
                 target=params_target,
                 shard_fns=params_shard_fns,
@@ -0,0 +1,411 @@
+import dataclasses
+from functools import partial
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+import queue
+from threading import Thread, Condition
+import hashlib
+import time
+from typing import Any, Callable, List, Optional
+
+import absl.logging
+import numpy as np
+from ml_collections import ConfigDict
+
+
+class BlockAllocator(object):
+    """ Allocator of the fixed-size blocks of a paged KV cache. Block 0 is
+        reserved as the scratch block that unused block table entries point
+        to, so it is never allocated.
+    """
+
+    def __init__(self, num_blocks, block_size):
+        assert num_blocks > 1, 'A paged cache needs at least one usable block!'
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self._free_blocks = list(range(num_blocks - 1, 0, -1))
+
+    def blocks_needed(self, num_tokens):
+        return -(-num_tokens // self.block_size)
+
+    def num_free(self):
+        return len(self._free_blocks)
+
+    def allocate(self, num_blocks):
+        assert num_blocks <= len(self._free_blocks), 'Out of paged cache blocks!'
+        blocks = self._free_blocks[-num_blocks:] if num_blocks > 0 else []
+        del self._free_blocks[len(self._free_blocks) - num_blocks:]
+        return blocks
+
+    def free(self, blocks):
+        self._free_blocks.extend(blocks)
+
+
+class PrefixCache(object):
+    """ LRU cache of the keys and values of prompt prefixes. Prompts are
+        split into blocks of block_size tokens, and the KV cache of each full
+        block is stored under the hash of all the tokens up to the end of
+        that block, so a block is only reused after exactly the same prefix.
+        Prompts that share a system prompt or few-shot examples can then
+        skip the prefill of their shared blocks. The values are opaque to
+        the cache, which only tracks their size to stay within max_bytes.
+    """
+
+    @staticmethod
+    def get_default_config(updates=None):
+        config = ConfigDict()
+        config.enable = False
+        config.block_size = 64
+        config.max_bytes = 2 ** 30
+        config.log_every = 100
+
+        if updates is not None:
+            config.update(ConfigDict(updates).copy_and_resolve_references())
+        return config
+
+    def __init__(self, config):
+        self.config = self.get_default_config(config)
+        self._blocks = OrderedDict()
+        self.num_bytes = 0
+        self.num_lookups = 0
+        self.num_hits = 0
+        self.num_lookup_tokens = 0
+        self.num_saved_tokens = 0
+
+    def block_hashes(self, tokens):
+        """ Return the hash of the prefix ending at each full block. """
+        block_size = self.config.block_size
+        tokens = np.asarray(tokens, dtype=np.int32)
+        prefix_hash = hashlib.sha256()
+        hashes = []
+        for start in range(0, len(tokens) - block_size + 1, block_size):
+            prefix_hash.update(tokens[start:start + block_size].tobytes())
+            hashes.append(prefix_hash.hexdigest())
+        return hashes
+
+    def lookup(self, tokens):
+        """ Return the cached values of the longest cached prefix of tokens.
+            At least one token is always left uncached, since the prefill
+            needs to produce the logits of the last token.
+        """
+        hashes = self.block_hashes(tokens[:-1])
+        values = []
+        for block_hash in hashes:
+            if block_hash not in self._blocks:
+                break
+            self._blocks.move_to_end(block_hash)
+            values.append(self._blocks[block_hash][0])
+
+        self.num_lookups += 1
+        self.num_hits += int(len(values) > 0)
+        self.num_lookup_tokens += len(tokens)
+        self.num_saved_tokens += len(values) * self.config.block_size
+        if self.config.log_every > 0 and self.num_lookups % self.config.log_every == 0:
+            absl.logging.info('Prefix cache stats: %s', self.stats())
+        return values
+
+    def insert(self, block_hash, value, num_bytes):
+        if block_hash in self._blocks or num_bytes > self.config.max_bytes:
+            return
+        self._blocks[block_hash] = (value, num_bytes)
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.config.max_bytes:
+            _, (_, evicted_bytes) = self._blocks.popitem(last=False)
+            self.num_bytes -= evicted_bytes
+
+    def stats(self):
+        return dict(
+            num_blocks=len(self._blocks),
+            num_bytes=self.num_bytes,
+            hit_rate=self.num_hits / max(self.num_lookups, 1),
+            saved_tokens=self.num_saved_tokens,
+            saved_token_ratio=self.num_saved_tokens / max(self.num_lookup_tokens, 1),
+        )
+
+
+@dataclasses.dataclass
+class DecodeSequence:
+    inputs: Any
+    num_input_tokens: int
+    temperature: float
+    sampling: Optional[dict]
+    max_new_tokens: int
+    future: Future
+    submit_time: float
+    admit_time: Optional[float] = None
+    first_token_time: Optional[float] = None
+    tokens: List[int] = dataclasses.field(default_factory=list)
+    blocks: Optional[List[int]] = None
+    on_token: Optional[Callable] = None
+
+
+@dataclasses.dataclass
+class DecodeResult:
+    text: str
+    tokens: List[int]
+    queue_time: float
+    compute_time: float
+    time_to_first_token: float
+
+
+class DecodeEngine(object):
+    """ Iteration-level (in-flight) batching for autoregressive generation.
+        The engine owns a KV cache with num_slots rows, each holding one
+        sequence. Between decode steps, queued sequences are admitted into
+        free slots by prefilling their prompts, and every decode step then
+        advances all the active sequences by one token. A sequence leaves its
+        slot as soon as it produces the EOS token or reaches its maximum
+        number of new tokens, and its result is returned immediately, so short
+        sequences never wait for long ones.
+
+        The engine is model agnostic and drives the model through the
+        following functions, which are called from a single worker thread:
+        * init_fn(): returns the initial device state of all the slots.
+        * encode_fn(text): returns the model inputs of a prompt and its
+            number of tokens.
+        * insert_fn(state, slot, inputs, temperature, sampling, blocks):
+            prefills a prompt into a slot, and returns the new state and the
+            first generated token. sampling is the dict of model specific
+            sampling parameters of the sequence (e.g. top_k), or None for the
+            defaults of the model. blocks is None unless the cache is paged.
+        * step_fn(state): runs one decode step for all the slots, and returns
+            the new state and an array of the generated token of each slot.
+        * decode_fn(tokens): returns the text of a list of generated tokens.
+        * release_fn(state, slot): optional, returns the new state after a
+            sequence leaves a slot.
+
+        With a paged KV cache (block_size > 0), the memory of the cache is
+        a shared pool of num_blocks blocks of block_size tokens instead of
+        a fixed maximum length per slot. A prompt is only admitted when the
+        blocks for its prompt and maximum number of new tokens are available,
+        and its blocks are returned to the pool as soon as it finishes, so
+        many more slots fit in the same memory when sequence lengths vary.
+        The release_fn must then detach the slot from its blocks, since the
+        decode step keeps running for the free slots.
+    """
+
+    @staticmethod
+    def get_default_config(updates=None):
+        config = ConfigDict()
+        config.enable = False
+        config.num_slots = 8
+        config.max_new_tokens = 1024
+        config.block_size = 0
+        config.num_blocks = 0
+
+        if updates is not None:
+            config.update(ConfigDict(updates).copy_and_resolve_references())
+        return config
+
+    def __init__(self, config, init_fn, encode_fn, insert_fn, step_fn,
+                 decode_fn, eos_token_id, release_fn=None):
+        self.config = self.get_default_config(config)
+        self._init_fn = init_fn
+        self._encode_fn = encode_fn
+        self._insert_fn = insert_fn
+        self._step_fn = step_fn
+        self._decode_fn = decode_fn
+        self._release_fn = release_fn
+        self.eos_token_id = eos_token_id
+        if self.config.block_size > 0:
+            self.allocator = BlockAllocator(
+                self.config.num_blocks, self.config.block_size
+            )
+        else:
+            self.allocator = None
+
+        self._pending = deque()
+        self._active = {}
+        self._released_slots = []
+        self._free_slots = list(range(self.config.num_slots))
+        self._condition = Condition()
+        self._worker = Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, text, temperature, max_new_tokens=None, on_token=None,
+               sampling=None):
+        """ Queue a prompt for generation. Returns a future of DecodeResult.
+            If on_token is not None, it is called from the worker thread with
+            every generated token, excluding the EOS token. sampling is passed
+            to insert_fn with the other sampling parameters of the prompt.
+        """
+        if max_new_tokens is None:
+            max_new_tokens = self.config.max_new_tokens
+        inputs, num_input_tokens = self._encode_fn(text)
+        sequence = DecodeSequence(
+            inputs=inputs,
+            num_input_tokens=num_input_tokens,
+            temperature=float(temperature),
+            sampling=sampling,
+            max_new_tokens=min(max_new_tokens, self.config.max_new_tokens),
+            future=Future(),
+            submit_time=time.time(),
+            on_token=on_token,
+        )
+        if self.allocator is not None:
+            num_blocks = self.allocator.blocks_needed(
+                num_input_tokens + sequence.max_new_tokens
+            )
+            if num_blocks > self.allocator.num_blocks - 1:
+                raise ValueError(
+                    f'Sequence needs {num_blocks} cache blocks, but the paged '
+                    f'cache only has {self.allocator.num_blocks - 1}.'
+                )
+        with self._condition:
+            self._pending.append(sequence)
+            self._condition.notify()
+        return sequence.future
+
+    def generate(self, text, temperature, max_new_tokens=None, sampling=None):
+        """ Generate for a list of prompts, blocking until all are finished. """
+        futures = [
+            self.submit(t, temperature, max_new_tokens, sampling=sampling)
+            for t in text
+        ]
+        return [future.result() for future in futures]
+
+    def stream(self, text, temperature, max_new_tokens=None, sampling=None):
+        """ Generate for a list of prompts, yielding (index, text) pairs with
+            the text of the new tokens of the index-th prompt as soon as they
+            are generated. Text is only yielded once it decodes to complete
+            characters, since a character can span multiple tokens.
+        """
+        token_queue = queue.Queue()
+        futures = []
+        for index, t in enumerate(text):
+            future = self.submit(
+                t, temperature, max_new_tokens,
+                on_token=partial(lambda i, token: token_queue.put((i, token)), index),
+                sampling=sampling,
+            )
+            future.add_done_callback(
+                partial(lambda i, _: token_queue.put((i, None)), index)
+            )
+            futures.append(future)
+
+        tokens = [[] for _ in text]
+        output_text = ['' for _ in text]
+        num_finished = 0
+        while num_finished < len(futures):
+            index, token = token_queue.get()
+            if token is None:
+                num_finished += 1
+                # Propagate the exception of a failed sequence
+                new_text = futures[index].result().text
+            else:
+                tokens[index].append(token)
+                new_text = self._decode_fn(tokens[index])
+                if new_text.endswith('\ufffd'):
+                    continue
+            if len(new_text) > len(output_text[index]):
+                yield index, new_text[len(output_text[index]):]
+                output_text[index] = new_text
+
+    def num_active(self):
+        return len(self._active)
+
+    def num_pending(self):
+        with self._condition:
+            return len(self._pending)
+
+    def _run(self):
+        state = self._init_fn()
+        while True:
+            with self._condition:
+                while len(self._active) == 0 and not self._can_admit():
+                    self._condition.wait()
+                admitted = []
+                while len(self._pending) > 0 and len(self._free_slots) > 0:
+                    if self.allocator is not None:
+                        sequence = self._pending[0]
+                        num_blocks = self.allocator.blocks_needed(
+                            sequence.num_input_tokens + sequence.max_new_tokens
+                        )
+                        if num_blocks > self.allocator.num_free():
+                            # Wait for running sequences to release blocks
+                            break
+                        sequence.blocks = self.allocator.allocate(num_blocks)
+                    admitted.append((self._free_slots.pop(), self._pending.popleft()))
+
+            # The admitted sequences are active before their prefill, so that
+            # they are failed and their slots freed if any prefill raises.
+            for slot, sequence in admitted:
+                self._active[slot] = sequence
+            try:
+                for slot, sequence in admitted:
+                    sequence.admit_time = time.time()
+                    state, token = self._insert_fn(
+                        state, slot, sequence.inputs, sequence.temperature,
+                        sequence.sampling, sequence.blocks
+                    )
+                    self._append_token(slot, sequence, int(token))
+                state = self._apply_releases(state)
+
+                if len(self._active) > 0:
+                    state, tokens = self._step_fn(state)
+                    for slot, sequence in list(self._active.items()):
+                        self._append_token(slot, sequence, int(tokens[slot]))
+                    state = self._apply_releases(state)
+            except Exception as e:
+                absl.logging.exception('Decode engine failure, resetting state.')
+                for slot, sequence in list(self._active.items()):
+                    self._release(slot)
+                    if not sequence.future.done():
+                        sequence.future.set_exception(e)
+                self._released_slots = []
+                state = self._init_fn()
+
+    def _apply_releases(self, state):
+        while len(self._released_slots) > 0:
+            slot = self._released_slots.pop()
+            if self._release_fn is not None:
+                state = self._release_fn(state, slot)
+        return state
+
+    def _append_token(self, slot, sequence, token):
+        if sequence.first_token_time is None:
+            sequence.first_token_time = time.time()
+        if token == self.eos_token_id:
+            self._finish(slot, sequence)
+            return
+        sequence.tokens.append(token)
+        if sequence.on_token is not None:
+            sequence.on_token(token)
+        if len(sequence.tokens) >= sequence.max_new_tokens:
+            self._finish(slot, sequence)
+
+    def _finish(self, slot, sequence):
+        finish_time = time.time()
+        try:
+            result = DecodeResult(
+                text=self._decode_fn(sequence.tokens),
+                tokens=sequence.tokens,
+                queue_time=sequence.admit_time - sequence.submit_time,
+                compute_time=finish_time - sequence.admit_time,
+                time_to_first_token=sequence.first_token_time - sequence.submit_time,
+            )
+        except Exception as e:
+            self._release(slot)
+            sequence.future.set_exception(e)
+            return
+        self._release(slot)
+        sequence.future.set_result(result)
+
+    def _can_admit(self):
+        if len(self._pending) == 0:
+            return False
+        if self.allocator is None:
+            return True
+        sequence = self._pending[0]
+        return self.allocator.blocks_needed(
+            sequence.num_input_tokens + sequence.max_new_tokens
+        ) <= self.allocator.num_free()
+
+    def _release(self, slot):
+        sequence = self._active.pop(slot)
+        self._released_slots.append(slot)
+        with self._condition:
+            self._free_slots.append(slot)
+            if sequence.blocks is not None:
+                self.allocator.free(sequence.blocks)
+                sequence.blocks = None
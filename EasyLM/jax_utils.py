@@ -113,6 +113,8 @@ def make_shard_and_gather_fns(partition_specs, dtype_specs=None):
         )
         def shard_fn(tensor):
             return jax_shard_function(tensor).block_until_ready()
+        # Exposed for loading pre-sharded tensors without going through host
+        shard_fn.partition_spec = partition_spec
         return shard_fn
 
     def make_gather_fn(partition_spec, dtype_spec=None):
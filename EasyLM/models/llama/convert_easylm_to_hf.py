@@ -15,17 +15,23 @@
 
 # This script converts LLaMA model checkpoint trained by EsayLM to the
 # HuggingFace transformers LLaMA PyTorch format, which can then be loaded
-# by HuggingFace transformers.
+# by HuggingFace transformers. The checkpoint is streamed tensor by tensor
+# and written directly as sharded safetensors files, one file per layer, so
+# only about one layer needs to be held in memory.
 
-import gc
 import json
 import os
+import re
 import shutil
+import time
+from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import mlxu
-from flax.traverse_util import flatten_dict
 import torch
-from transformers import LlamaConfig, LlamaForCausalLM, LlamaForSequenceClassification
+from safetensors.torch import save_file
+from transformers import LlamaConfig, GenerationConfig
 
 from EasyLM.checkpoint import StreamingCheckpointer
 from EasyLM.jax_utils import float_tensor_to_dtype
@@ -37,6 +43,7 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     model_size='13b',
     output_dir='',
     is_reward_model=False,
+    num_workers=4,
 )
 
 
@@ -104,17 +111,31 @@ def match_keywords(string, positives, negatives):
     return True
 
 
+# Names of the tensors in each transformer layer, in EasyLM and HuggingFace
+LLAMA_LAYER_KEYS = {
+    'attention.wq.kernel': 'self_attn.q_proj.weight',
+    'attention.wk.kernel': 'self_attn.k_proj.weight',
+    'attention.wv.kernel': 'self_attn.v_proj.weight',
+    'attention.wo.kernel': 'self_attn.o_proj.weight',
+    'feed_forward.w1.kernel': 'mlp.gate_proj.weight',
+    'feed_forward.w2.kernel': 'mlp.down_proj.weight',
+    'feed_forward.w3.kernel': 'mlp.up_proj.weight',
+    'attention_norm.kernel': 'input_layernorm.weight',
+    'ffn_norm.kernel': 'post_attention_layernorm.weight',
+}
+
+
 def load_and_convert_checkpoint(path):
-    _, flax_params = StreamingCheckpointer.load_trainstate_checkpoint(path)
-    flax_params = flatten_dict(flax_params['params'], sep='.')
-    torch_params = {}
-    for key, tensor in flax_params.items():
+    """ Iterate over the params of the checkpoint as bf16 torch tensors,
+        loading one tensor at a time.
+    """
+    for key, tensor in StreamingCheckpointer.iterate_params_checkpoint(path):
+        key = '.'.join(key)
         if match_keywords(key, ["kernel"], ["norm", 'ln_f']):
             tensor = tensor.T
-        torch_params[key] = torch.tensor(
+        yield key, torch.tensor(
             float_tensor_to_dtype(tensor, 'fp32'), dtype=torch.bfloat16
         )
-    return torch_params
 
 
 def read_json(path):
@@ -127,10 +148,16 @@ def write_json(text, path):
         json.dump(text, f)
 
 
-def write_model(loaded, model_path, model_size, is_reward_model=False):
+def write_model(loaded, model_path, model_size, is_reward_model=False, num_workers=4):
+    """ Write the (key, tensor) pairs of loaded to sharded safetensors files.
+        The tensors of each layer are buffered until the layer is complete
+        and then written to their own shard, while the embedding, final norm
+        and output head are written to the last shard. Completed layers are
+        converted and written by a pool of num_workers threads, with at most
+        2 * num_workers layers in flight to bound the memory usage.
+    """
     os.makedirs(model_path, exist_ok=True)
-    tmp_model_path = os.path.join(model_path, "tmp")
-    os.makedirs(tmp_model_path, exist_ok=True)
+    total_start_time = time.time()
 
     params = LLAMA_STANDARD_CONFIGS[model_size]
 
@@ -139,8 +166,6 @@ def write_model(loaded, model_path, model_size, is_reward_model=False):
     n_kv_heads = params.get("n_kv_heads", n_heads)
     dim = params["dim"]
     dims_per_head = dim // n_heads
-    base = 10000.0
-    inv_freq = 1.0 / (base ** (torch.arange(0, dims_per_head, 2).float() / dims_per_head))
 
     # permute for sliced rotary
     def permute(w):
@@ -150,61 +175,98 @@ def write_model(loaded, model_path, model_size, is_reward_model=False):
     def permute_gqa(w):
         return w.view(n_kv_heads, dims_per_head // 2, 2, dim).transpose(1, 2).reshape(dims_per_head * n_kv_heads, dim)
 
+    def shard_filename(shard_i):
+        return f"model-{shard_i + 1:05d}-of-{n_layers + 1:05d}.safetensors"
+
+    index_dict = {"metadata": {"total_size": 0}, "weight_map": {}}
+    # Time spent in each stage, summed over the worker threads
+    timings = {"read": 0.0, "convert": 0.0, "write": 0.0}
+
+    def convert_and_write_shard(convert_fn, filename):
+        start_time = time.time()
+        state_dict = {k: v.contiguous() for k, v in convert_fn().items()}
+        convert_time = time.time() - start_time
+        start_time = time.time()
+        save_file(state_dict, os.path.join(model_path, filename), metadata={"format": "pt"})
+        write_time = time.time() - start_time
+        sizes = {k: v.numel() * v.element_size() for k, v in state_dict.items()}
+        return sizes, convert_time, write_time
+
+    def finish_shard(filename, future):
+        # Shards are finished in submission order, so that the index is the
+        # same regardless of the number of workers.
+        sizes, convert_time, write_time = future.result()
+        for k, size in sizes.items():
+            index_dict["weight_map"][k] = filename
+            index_dict["metadata"]["total_size"] += size
+        timings["convert"] += convert_time
+        timings["write"] += write_time
+
+    def timed_iterate(iterator):
+        iterator = iter(iterator)
+        while True:
+            start_time = time.time()
+            item = next(iterator, None)
+            timings["read"] += time.time() - start_time
+            if item is None:
+                return
+            yield item
+
+    def convert_layer(layer_i, layer):
+        layer["attention.wq.kernel"] = permute(layer["attention.wq.kernel"])
+        layer["attention.wk.kernel"] = permute_gqa(layer["attention.wk.kernel"])
+        return {
+            f"model.layers.{layer_i}.{hf_key}": layer[key]
+            for key, hf_key in LLAMA_LAYER_KEYS.items()
+        }
 
-    param_count = 0
-    index_dict = {"weight_map": {}}
-    for layer_i in range(n_layers):
-        filename = f"pytorch_model-{layer_i + 1}-of-{n_layers + 1}.bin"
+    layers = {}
+    unsharded = {}
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for key, tensor in timed_iterate(loaded):
+            match = re.fullmatch(r'transformer\.h\.(\d+)\.(.+)', key)
+            if match is None:
+                unsharded[key] = tensor
+                continue
+            layer_i = int(match.group(1))
+            layers.setdefault(layer_i, {})[match.group(2)] = tensor
+            if len(layers[layer_i]) == len(LLAMA_LAYER_KEYS):
+                # The tensors of a layer are stored contiguously in the checkpoint,
+                # so the layer can be written as soon as it is complete.
+                filename = shard_filename(layer_i)
+                pending.append((filename, executor.submit(
+                    convert_and_write_shard,
+                    partial(convert_layer, layer_i, layers.pop(layer_i)),
+                    filename,
+                )))
+                if len(pending) >= 2 * num_workers:
+                    finish_shard(*pending.popleft())
+        assert len(layers) == 0, f'Incomplete layers in checkpoint: {sorted(layers.keys())}'
+
+        # Unsharded
         state_dict = {
-            f"model.layers.{layer_i}.self_attn.q_proj.weight": permute(
-                loaded[f"transformer.h.{layer_i}.attention.wq.kernel"]
-            ),
-            f"model.layers.{layer_i}.self_attn.k_proj.weight": permute_gqa(
-                loaded[f"transformer.h.{layer_i}.attention.wk.kernel"]
-            ),
-            f"model.layers.{layer_i}.self_attn.v_proj.weight": loaded[f"transformer.h.{layer_i}.attention.wv.kernel"],
-            f"model.layers.{layer_i}.self_attn.o_proj.weight": loaded[f"transformer.h.{layer_i}.attention.wo.kernel"],
-
-            f"model.layers.{layer_i}.mlp.gate_proj.weight": loaded[f"transformer.h.{layer_i}.feed_forward.w1.kernel"],
-            f"model.layers.{layer_i}.mlp.down_proj.weight": loaded[f"transformer.h.{layer_i}.feed_forward.w2.kernel"],
-            f"model.layers.{layer_i}.mlp.up_proj.weight": loaded[f"transformer.h.{layer_i}.feed_forward.w3.kernel"],
-
-            f"model.layers.{layer_i}.input_layernorm.weight": loaded[f"transformer.h.{layer_i}.attention_norm.kernel"],
-            f"model.layers.{layer_i}.post_attention_layernorm.weight": loaded[f"transformer.h.{layer_i}.ffn_norm.kernel"],
-
+            "model.embed_tokens.weight": unsharded["transformer.wte.embedding"],
+            "model.norm.weight": unsharded["transformer.ln_f.kernel"],
         }
-
-        state_dict[f"model.layers.{layer_i}.self_attn.rotary_emb.inv_freq"] = inv_freq
-        for k, v in state_dict.items():
-            index_dict["weight_map"][k] = filename
-            param_count += v.numel()
-        torch.save(state_dict, os.path.join(tmp_model_path, filename))
-
-    filename = f"pytorch_model-{n_layers + 1}-of-{n_layers + 1}.bin"
-    # Unsharded
-    state_dict = {
-        "model.embed_tokens.weight": loaded["transformer.wte.embedding"],
-        "model.norm.weight": loaded["transformer.ln_f.kernel"],
-    }
-    # if reward model, we have the score head instead of the lm head
-    if is_reward_model:
-        state_dict.update({
-            "score.weight": loaded["score.kernel"],
-        })
-    else:
-        state_dict.update({
-            "lm_head.weight": loaded["lm_head.kernel"],
-        })
-
-    for k, v in state_dict.items():
-        index_dict["weight_map"][k] = filename
-        param_count += v.numel()
-    torch.save(state_dict, os.path.join(tmp_model_path, filename))
+        # if reward model, we have the score head instead of the lm head
+        if is_reward_model:
+            state_dict.update({
+                "score.weight": unsharded["score.kernel"],
+            })
+        else:
+            state_dict.update({
+                "lm_head.weight": unsharded["lm_head.kernel"],
+            })
+        filename = shard_filename(n_layers)
+        pending.append((filename, executor.submit(
+            convert_and_write_shard, lambda: state_dict, filename
+        )))
+        while len(pending) > 0:
+            finish_shard(*pending.popleft())
+    write_json(index_dict, os.path.join(model_path, "model.safetensors.index.json"))
 
     # Write configs
-    index_dict["metadata"] = {"total_size": param_count * 2}
-    write_json(index_dict, os.path.join(tmp_model_path, "pytorch_model.bin.index.json"))
-
     config = LlamaConfig(
         hidden_size=dim,
         intermediate_size=params["intermediate_size"],
@@ -212,28 +274,23 @@ def write_model(loaded, model_path, model_size, is_reward_model=False):
         num_hidden_layers=params["n_layers"],
         rms_norm_eps=params["norm_eps"],
         num_key_value_heads=params.get("n_kv_heads", params["n_heads"]),
+        torch_dtype="bfloat16",
     )
     # Set the number of labels to 1 for reward models.
     if is_reward_model:
         config.num_labels = 1
-    config.save_pretrained(tmp_model_path)
-
-    # Make space so we can load the model properly now.
-    del state_dict
-    del loaded
-    gc.collect()
-
-    print("Loading the checkpoint in a Llama model.")
-    if is_reward_model:
-        model = LlamaForSequenceClassification.from_pretrained(tmp_model_path, torch_dtype=torch.bfloat16)
+        config.architectures = ["LlamaForSequenceClassification"]
     else:
-        model = LlamaForCausalLM.from_pretrained(tmp_model_path, torch_dtype=torch.bfloat16)
-    # Avoid saving this as part of the config.
-    del model.config._name_or_path
-
-    print("Saving in the Transformers format.")
-    model.save_pretrained(model_path)
-    shutil.rmtree(tmp_model_path)
+        config.architectures = ["LlamaForCausalLM"]
+        GenerationConfig.from_model_config(config).save_pretrained(model_path)
+    config.save_pretrained(model_path)
+
+    print(
+        f"Read and decode: {timings['read']:.1f}s, "
+        f"convert: {timings['convert']:.1f}s, "
+        f"write: {timings['write']:.1f}s (summed over {num_workers} workers), "
+        f"total: {time.time() - total_start_time:.1f}s"
+    )
 
 
 def write_tokenizer(tokenizer_path, input_tokenizer_path):
@@ -316,6 +373,7 @@ def main(argv):
         model_path=FLAGS.output_dir,
         model_size=FLAGS.model_size,
         is_reward_model=FLAGS.is_reward_model,
+        num_workers=FLAGS.num_workers,
     )
 
 
@@ -4,17 +4,26 @@ python convert_hf_to_easylm.py  \
        --checkpoint_dir     /path/hf_format_dir/    \
        --output_file /path/easylm_format.stream   \
        --model_size 7b \
+       --float_dtype bf16 \
        --streaming
 """
+import re
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import argparse
 
+import numpy as np
 import mlxu
+import msgpack
 import torch
 import flax
+from flax.traverse_util import unflatten_dict
+from safetensors import safe_open
 
-from EasyLM.checkpoint import StreamingCheckpointer
+from EasyLM.checkpoint import StreamingCheckpointer, encode_tensor
+from EasyLM.jax_utils import float_tensor_to_dtype
 
 LLAMA_STANDARD_CONFIGS = {
     '1b': {
@@ -82,101 +91,128 @@ def inverse_permute(params, w):
 
 def inverse_permute_kv(params, w):
     n_layers = params["n_layers"]
-    n_kv_heads = params["n_kv_heads"]
     n_heads = params["n_heads"]
+    n_kv_heads = params.get("n_kv_heads", n_heads)
     dim = params["dim"]
     reshaped_w = w.reshape(n_kv_heads, 2, dim // n_heads // 2, dim)
     transposed_w = reshaped_w.transpose(0, 2, 1, 3)
-    inverted_w = transposed_w.reshape(dim, n_kv_heads * (dim // n_heads))
+    inverted_w = transposed_w.reshape(n_kv_heads * (dim // n_heads), dim)
     return inverted_w
 
 
+# Names of the tensors in each transformer layer in HuggingFace and EasyLM
+LAYER_KEY_MAP = {
+    "self_attn.q_proj.weight": ("attention", "wq", "kernel"),
+    "self_attn.k_proj.weight": ("attention", "wk", "kernel"),
+    "self_attn.v_proj.weight": ("attention", "wv", "kernel"),
+    "self_attn.o_proj.weight": ("attention", "wo", "kernel"),
+    "mlp.gate_proj.weight": ("feed_forward", "w1", "kernel"),
+    "mlp.down_proj.weight": ("feed_forward", "w2", "kernel"),
+    "mlp.up_proj.weight": ("feed_forward", "w3", "kernel"),
+    "input_layernorm.weight": ("attention_norm", "kernel"),
+    "post_attention_layernorm.weight": ("ffn_norm", "kernel"),
+}
+
+KEY_MAP = {
+    "embed_tokens.weight": ("transformer", "wte", "embedding"),
+    "norm.weight": ("transformer", "ln_f", "kernel"),
+    "lm_head.weight": ("lm_head", "kernel"),
+    "score.weight": ("score", "kernel"),
+}
+
+
+def iterate_hf_checkpoint(checkpoint_dir):
+    """ Iterate over the (key, tensor) pairs of a HuggingFace checkpoint. The
+        safetensors files are memory mapped and read one tensor at a time,
+        while the pytorch .bin files are loaded one shard at a time.
+    """
+    safetensors_paths = sorted(Path(checkpoint_dir).glob("*.safetensors"))
+    if len(safetensors_paths) > 0:
+        for path in safetensors_paths:
+            with safe_open(path, framework="pt", device="cpu") as fin:
+                for key in fin.keys():
+                    yield key, fin.get_tensor(key)
+    else:
+        for path in sorted(Path(checkpoint_dir).glob("*.bin")):
+            checkpoint = torch.load(path, map_location="cpu")
+            for key in list(checkpoint.keys()):
+                yield key, checkpoint.pop(key)
+            del checkpoint
+
+
+def convert_tensor(params, key, tensor):
+    """ Convert a HuggingFace tensor to its EasyLM key and value, or return
+        None for the tensors that are not part of the EasyLM model.
+    """
+    if key.startswith("model."):
+        key = key[6:]
+    match = re.fullmatch(r"layers\.(\d+)\.(.+)", key)
+    if match is not None:
+        if match.group(2) not in LAYER_KEY_MAP:
+            return None
+        layer, name = match.group(1), match.group(2)
+        easylm_key = ("transformer", "h", layer) + LAYER_KEY_MAP[name]
+    elif key in KEY_MAP:
+        name = key
+        easylm_key = KEY_MAP[key]
+    else:
+        return None
+
+    tensor = tensor.to(torch.float32).numpy()
+    if name == "self_attn.q_proj.weight":
+        tensor = inverse_permute(params, tensor)
+    elif name == "self_attn.k_proj.weight":
+        tensor = inverse_permute_kv(params, tensor)
+    if easylm_key[-1] == "kernel" and tensor.ndim == 2:
+        # Linear layer weights are stored as (in, out) in EasyLM
+        tensor = tensor.transpose()
+    return easylm_key, np.ascontiguousarray(tensor)
+
+
 def main(args):
     start = time.time()
     params = LLAMA_STANDARD_CONFIGS[args.model_size]
 
-    ckpt_paths = sorted(Path(args.checkpoint_dir).glob("*.bin"))
-    ckpt = {}
-    for i, ckpt_path in enumerate(ckpt_paths):
-        checkpoint = torch.load(ckpt_path, map_location="cpu")
-        for k, v in checkpoint.items():
-            if k.startswith("model."):
-                k = k[6:]
-            ckpt[k] = v
-    print(f"Start convert weight to easylm format...")
-    jax_weights = {
-        "transformer": {
-            "wte": {"embedding": ckpt["embed_tokens.weight"].to(torch.float32).numpy()},
-            "ln_f": {"kernel": ckpt["norm.weight"].to(torch.float32).numpy()},
-            "h": {
-                "%d"
-                % (layer): {
-                    "attention": {
-                        "wq": {
-                            "kernel": inverse_permute(
-                                params,
-                                ckpt[f"layers.{layer}.self_attn.q_proj.weight"].to(torch.float32).numpy(),
-                            ).transpose()
-                        },
-                        "wk": {
-                            "kernel": inverse_permute_kv(
-                                params,
-                                ckpt[f"layers.{layer}.self_attn.k_proj.weight"].to(torch.float32).numpy(),
-                            )
-                        },
-                        "wv": {
-                            "kernel": ckpt[f"layers.{layer}.self_attn.v_proj.weight"]
-                            .to(torch.float32)
-                            .numpy()
-                            .transpose()
-                        },
-                        "wo": {
-                            "kernel": ckpt[f"layers.{layer}.self_attn.o_proj.weight"]
-                            .to(torch.float32)
-                            .numpy()
-                            .transpose()
-                        },
-                    },
-                    "feed_forward": {
-                        "w1": {
-                            "kernel": ckpt[f"layers.{layer}.mlp.gate_proj.weight"]
-                            .to(torch.float32)
-                            .numpy()
-                            .transpose()
-                        },
-                        "w2": {
-                            "kernel": ckpt[f"layers.{layer}.mlp.down_proj.weight"]
-                            .to(torch.float32)
-                            .numpy()
-                            .transpose()
-                        },
-                        "w3": {
-                            "kernel": ckpt[f"layers.{layer}.mlp.up_proj.weight"]
-                            .to(torch.float32)
-                            .numpy()
-                            .transpose()
-                        },
-                    },
-                    "attention_norm": {
-                        "kernel": ckpt[f"layers.{layer}.input_layernorm.weight"].to(torch.float32).numpy()
-                    },
-                    "ffn_norm": {
-                        "kernel": ckpt[
-                            f"layers.{layer}.post_attention_layernorm.weight"
-                        ].to(torch.float32).numpy()
-                    },
-                }
-                for layer in range(params["n_layers"])
-            },
-        },
-        "lm_head": {"kernel": ckpt["lm_head.weight"].to(torch.float32).numpy().transpose()},
-    }
-    print(f"Convert weight to easylm format finished...")
-    print(f"Start to save...")
+    def convert_and_encode(key, tensor):
+        converted = convert_tensor(params, key, tensor)
+        if converted is None:
+            return key, None
+        easylm_key, tensor = converted
+        if args.streaming:
+            return easylm_key, encode_tensor(tensor, args.float_dtype)
+        return easylm_key, float_tensor_to_dtype(tensor, args.float_dtype)
+
+    def iterate_converted():
+        # Tensors are converted by a pool of worker threads, with a bounded
+        # number of tensors in flight to keep the memory usage low.
+        with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+            futures = deque()
+            for key, tensor in iterate_hf_checkpoint(args.checkpoint_dir):
+                futures.append(executor.submit(convert_and_encode, key, tensor))
+                if len(futures) >= 2 * args.num_workers:
+                    yield futures.popleft().result()
+            while len(futures) > 0:
+                yield futures.popleft().result()
 
+    print(f"Start converting weights to easylm format...")
     if args.streaming:
-        StreamingCheckpointer.save_train_state_to_file(jax_weights, args.output_file)
+        packer = msgpack.Packer()
+        with mlxu.open_file(args.output_file, "wb") as fout:
+            for key, encoded in iterate_converted():
+                if encoded is None:
+                    print(f"Skipping {key}")
+                    continue
+                value, encoding = encoded
+                fout.write(StreamingCheckpointer._pack_record(packer, key, value, encoding))
     else:
+        # The standard flax format is serialized as a whole
+        jax_weights = {}
+        for key, tensor in iterate_converted():
+            if tensor is None:
+                print(f"Skipping {key}")
+                continue
+            jax_weights[key] = tensor
+        jax_weights = unflatten_dict(jax_weights)
         with mlxu.open_file(args.output_file, "wb") as fout:
             fout.write(flax.serialization.msgpack_serialize(jax_weights, in_place=True))
 
@@ -200,9 +236,22 @@ if __name__ == "__main__":
         "--model_size",
         type=str,
         default="7b",
-        choices=["7b", "13b", "30b", "65b", "70b"],
+        choices=list(LLAMA_STANDARD_CONFIGS.keys()),
         help="model size",
     )
+    parser.add_argument(
+        "--float_dtype",
+        type=str,
+        default="fp32",
+        choices=["bf16", "fp16", "fp32"],
+        help="float dtype of the saved model weights",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="number of threads converting the weights",
+    )
     parser.add_argument(
         "--streaming",
         action="store_true",
@@ -216,5 +265,6 @@ if __name__ == "__main__":
     print(f"output_file: {args.output_file}")
     print(f"model_size: {args.model_size}")
     print(f"streaming: {args.streaming}")
+    print(f"float_dtype: {args.float_dtype}")
 
     main(args)
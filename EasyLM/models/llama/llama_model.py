@@ -261,6 +261,11 @@ class LLaMAConfig(PretrainedConfig):
             relevant if `config.is_decoder=True`.
         tie_word_embeddings(`bool`, *optional*, defaults to `False`):
             Whether to tie weight embeddings
+        weight_quantization (`str`, *optional*, defaults to `""`):
+            Weight-only quantization of the dense layers for inference. Can be `"int8"` for per-channel int8
+            kernels, `"int4"` for group-wise int4 kernels, or `""` for float kernels.
+        weight_quantization_group_size (`int`, *optional*, defaults to 128):
+            The number of input features sharing a scale in the int4 kernels.
         Example:
     ```python
     >>> from transformers import LLaMAModel, LLaMAConfig
@@ -304,6 +309,8 @@ class LLaMAConfig(PretrainedConfig):
         fcm_max_ratio=0.0,
         rope_theta=10000,
         use_hf_rotary_emb=False,
+        weight_quantization='',
+        weight_quantization_group_size=128,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -332,6 +339,8 @@ class LLaMAConfig(PretrainedConfig):
         self.fcm_max_ratio = fcm_max_ratio
         self.rope_theta = rope_theta
         self.use_hf_rotary_emb = use_hf_rotary_emb
+        self.weight_quantization = weight_quantization
+        self.weight_quantization_group_size = weight_quantization_group_size
         super().__init__(
             # pad_token_id=pad_token_id,
             bos_token_id=bos_token_id,
@@ -370,6 +379,12 @@ class LLaMAConfig(PretrainedConfig):
             ("feed_forward/w1/kernel", PS("fsdp", "mp")),
             ("feed_forward/w2/kernel", PS("mp", "fsdp")),
             ("feed_forward/w3/kernel", PS("fsdp", "mp")),
+            # scales of the quantized kernels
+            ("attention/(wq|wk|wv)/scale", PS(None, "mp")),
+            ("attention/wo/scale", PS(None, "fsdp")),
+            ("feed_forward/(w1|w3)/scale", PS(None, "mp")),
+            ("feed_forward/w2/scale", PS(None, "fsdp")),
+            ("lm_head/scale", PS(None, "mp")),
             # layer norms
             ("attention_norm/kernel", PS(None)),
             ("ffn_norm/kernel", PS(None)),
@@ -504,6 +519,129 @@ def apply_hf_style_rotary_emb(q, k, cos, sin, position_ids=None):
     return q_embed, k_embed
 
 
+def quantize_kernel(kernel, quantization, group_size=128):
+    """ Quantize a dense kernel of shape (in_features, out_features) on the
+        host into the params of QuantizedDense. int8 kernels use a symmetric
+        scale per output channel. int4 kernels use a symmetric scale per group
+        of group_size input features and output channel, and two 4 bit values
+        offset by 8 are packed into each uint8 along the input features.
+    """
+    kernel = np.asarray(kernel, dtype=np.float32)
+    in_features, out_features = kernel.shape
+    if quantization == 'int8':
+        scale = np.max(np.abs(kernel), axis=0, keepdims=True) / 127.0
+        scale = np.where(scale == 0, 1.0, scale).astype(np.float32)
+        values = np.clip(np.round(kernel / scale), -127, 127).astype(np.int8)
+        return {'kernel': values, 'scale': scale}
+    elif quantization == 'int4':
+        assert in_features % group_size == 0 and group_size % 2 == 0, (
+            f'{in_features} input features cannot be split into groups of {group_size}'
+        )
+        groups = kernel.reshape(in_features // group_size, group_size, out_features)
+        scale = np.max(np.abs(groups), axis=1) / 7.0
+        scale = np.where(scale == 0, 1.0, scale).astype(np.float32)
+        values = np.clip(np.round(groups / scale[:, None, :]), -7, 7).astype(np.int32) + 8
+        values = values.reshape(in_features // 2, 2, out_features).astype(np.uint8)
+        return {'kernel': values[:, 0] | (values[:, 1] << 4), 'scale': scale}
+    raise ValueError(f'Unsupported weight quantization: {quantization}')
+
+
+class QuantizedDense(nn.Module):
+    """ Dense layer without bias whose kernel is stored with weight-only int8
+        or int4 quantization, see quantize_kernel. The kernel is dequantized
+        on the fly, so that only the quantized weights are kept in memory.
+    """
+    features: int
+    quantization: str = 'int8'
+    group_size: int = 128
+    dtype: jnp.dtype = jnp.float32
+    precision: Optional[Union[jax.lax.Precision, str]] = None
+
+    @nn.compact
+    def __call__(self, inputs):
+        in_features = inputs.shape[-1]
+        inputs = inputs.astype(self.dtype)
+        contract = (((inputs.ndim - 1,), (0,)), ((), ()))
+        if self.quantization == 'int8':
+            kernel = self.param(
+                'kernel', nn.initializers.zeros, (in_features, self.features), jnp.int8
+            )
+            scale = self.param(
+                'scale', nn.initializers.ones, (1, self.features), jnp.float32
+            )
+            # The per-channel scale is applied to the output instead of the kernel
+            outputs = lax.dot_general(
+                inputs, kernel.astype(self.dtype), contract, precision=self.precision
+            )
+            return outputs * scale[0].astype(self.dtype)
+        elif self.quantization == 'int4':
+            num_groups = in_features // self.group_size
+            kernel = self.param(
+                'kernel', nn.initializers.zeros, (in_features // 2, self.features), jnp.uint8
+            )
+            scale = self.param(
+                'scale', nn.initializers.ones, (num_groups, self.features), jnp.float32
+            )
+            values = jnp.stack([kernel & 0xF, kernel >> 4], axis=1).astype(self.dtype) - 8
+            kernel = (
+                values.reshape(num_groups, self.group_size, self.features)
+                * scale[:, None, :].astype(self.dtype)
+            ).reshape(in_features, self.features)
+            return lax.dot_general(inputs, kernel, contract, precision=self.precision)
+        raise ValueError(f'Unsupported weight quantization: {self.quantization}')
+
+
+def make_dense(config, features, dtype, param_dtype, precision, quantize=True):
+    """ Dense layer without bias of the LLaMA model, which is quantized if
+        weight quantization is enabled in the config.
+    """
+    if quantize and config.weight_quantization:
+        return QuantizedDense(
+            features,
+            quantization=config.weight_quantization,
+            group_size=config.weight_quantization_group_size,
+            dtype=dtype,
+            precision=precision,
+        )
+    return nn.Dense(
+        features,
+        dtype=dtype,
+        param_dtype=param_dtype,
+        use_bias=False,
+        kernel_init=jax.nn.initializers.normal(config.initializer_range),
+        precision=precision,
+    )
+
+
+def is_quantized_kernel(key, config):
+    """ Whether the param at the flattened key is the kernel of a dense layer
+        that is quantized with the weight quantization of the config.
+    """
+    if not config.weight_quantization or key[-1] != 'kernel':
+        return False
+    if key[-2] == 'lm_head':
+        return not config.tie_word_embeddings
+    return key[-2] in ('wq', 'wk', 'wv', 'wo', 'w1', 'w2', 'w3')
+
+
+def quantize_llama_params(params, config):
+    """ Quantize the dense kernels of float LLaMA params on the host, for the
+        model created with the weight quantization of the config.
+    """
+    flattened = {}
+    for key, value in flatten_dict(params).items():
+        if is_quantized_kernel(key, config):
+            quantized = quantize_kernel(
+                value, config.weight_quantization,
+                config.weight_quantization_group_size,
+            )
+            for name, tensor in quantized.items():
+                flattened[key[:-1] + (name,)] = tensor
+        else:
+            flattened[key] = value
+    return unflatten_dict(flattened)
+
+
 class FlaxLLaMAAttention(nn.Module):
     config: LLaMAConfig
     dtype: jnp.dtype=jnp.float32
@@ -520,37 +658,21 @@ class FlaxLLaMAAttention(nn.Module):
         self.num_heads = config.num_attention_heads
         self.head_dim = self.embed_dim // self.num_heads
 
-        self.wq = nn.Dense(
-            self.num_heads*self.head_dim,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            use_bias=False,
-            kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
-            precision=self.precision,
+        self.wq = make_dense(
+            config, self.num_heads*self.head_dim,
+            self.dtype, self.param_dtype, self.precision,
         )
-        self.wk = nn.Dense(
-            self.num_key_value_heads*self.head_dim,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            use_bias=False,
-            kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
-            precision=self.precision,
+        self.wk = make_dense(
+            config, self.num_key_value_heads*self.head_dim,
+            self.dtype, self.param_dtype, self.precision,
         )
-        self.wv = nn.Dense(
-            self.num_key_value_heads*self.head_dim,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            use_bias=False,
-            kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
-            precision=self.precision,
+        self.wv = make_dense(
+            config, self.num_key_value_heads*self.head_dim,
+            self.dtype, self.param_dtype, self.precision,
         )
-        self.wo = nn.Dense(
-            config.hidden_size,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            use_bias=False,
-            kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
-            precision=self.precision,
+        self.wo = make_dense(
+            config, config.hidden_size,
+            self.dtype, self.param_dtype, self.precision,
         )
 
         self.resid_dropout = nn.Dropout(rate=config.resid_pdrop)
@@ -587,21 +709,85 @@ class FlaxLLaMAAttention(nn.Module):
             *batch_dims, max_length, num_heads, depth_per_head = cached_key.value.shape
             # update key, value caches with our new 1d spatial slices
             cur_index = cache_index.value
-            indices = (0,) * len(batch_dims) + (cur_index, 0, 0)
-            key = lax.dynamic_update_slice(cached_key.value, key, indices)
-            value = lax.dynamic_update_slice(cached_value.value, value, indices)
+            num_updated_cache_vectors = query.shape[1]
+            if cur_index.ndim == 1:
+                # Per-row cache indices, used by in-flight batching where every
+                # row of the batch holds a different sequence.
+                update_row = jax.vmap(
+                    lambda cache, x, index: lax.dynamic_update_slice(cache, x, (index, 0, 0))
+                )
+                key = update_row(cached_key.value, key, cur_index)
+                value = update_row(cached_value.value, value, cur_index)
+                valid_length = (cur_index + num_updated_cache_vectors)[:, None, None, None]
+            else:
+                indices = (0,) * len(batch_dims) + (cur_index, 0, 0)
+                key = lax.dynamic_update_slice(cached_key.value, key, indices)
+                value = lax.dynamic_update_slice(cached_value.value, value, indices)
+                valid_length = cur_index + num_updated_cache_vectors
             cached_key.value = key
             cached_value.value = value
-            num_updated_cache_vectors = query.shape[1]
             cache_index.value = cache_index.value + num_updated_cache_vectors
             # causal mask for cached decoder self-attention: our single query position should only attend to those key positions that have already been generated and cached, not the remaining zero elements.
             pad_mask = jnp.broadcast_to(
-                jnp.arange(max_length) < cur_index + num_updated_cache_vectors,
+                jnp.arange(max_length) < valid_length,
                 tuple(batch_dims) + (1, num_updated_cache_vectors, max_length),
             )
             attention_mask = combine_masks(pad_mask, attention_mask)
         return key, value, attention_mask
 
+    def _write_and_gather_paged_cache(self, key, value, attention_mask):
+        """
+        Paged KV cache for decoding. The keys and values of all sequences are
+        stored in a shared pool of fixed-size blocks, and every row of the batch
+        owns a block table mapping its logical blocks to physical blocks in the
+        pool. The new keys and values are scattered into their blocks at the
+        current length of each row, and the blocks of each row are gathered back
+        into a contiguous view for attention. Unused block table entries point
+        to block 0, which is reserved as a scratch block.
+
+        The paged cache variables are always created by the caller, so they
+        are read and written with get_variable and put_variable, since only
+        _concatenate_to_cache can be the compact method of this module.
+        """
+        key_pages = self.get_variable("cache", "key_pages")
+        value_pages = self.get_variable("cache", "value_pages")
+        block_tables = self.get_variable("cache", "block_tables")
+        seq_lens = self.get_variable("cache", "seq_lens")
+
+        batch_size, query_length = key.shape[:2]
+        block_size = key_pages.shape[1]
+        max_blocks = block_tables.shape[1]
+        max_length = max_blocks * block_size
+
+        positions = seq_lens[:, None] + jnp.arange(query_length)[None, :]
+        block_ids = jnp.take_along_axis(
+            block_tables, jnp.clip(positions // block_size, 0, max_blocks - 1), axis=1
+        )
+        offsets = positions % block_size
+        key_pages = key_pages.at[block_ids, offsets].set(key.astype(key_pages.dtype))
+        value_pages = value_pages.at[block_ids, offsets].set(value.astype(value_pages.dtype))
+        self.put_variable("cache", "key_pages", key_pages)
+        self.put_variable("cache", "value_pages", value_pages)
+        self.put_variable("cache", "seq_lens", seq_lens + query_length)
+
+        key = key_pages[block_tables].reshape(
+            (batch_size, max_length) + key.shape[2:]
+        ).astype(self.dtype)
+        value = value_pages[block_tables].reshape(
+            (batch_size, max_length) + value.shape[2:]
+        ).astype(self.dtype)
+
+        # Each query attends to the cached keys up to its own position
+        causal_mask = jnp.arange(max_length)[None, None, :] <= positions[:, :, None]
+        attention_mask = combine_masks(
+            causal_mask[:, None, :, :],
+            jnp.broadcast_to(
+                attention_mask[:, None, None, :max_length] > 0,
+                (batch_size, 1, query_length, max_length),
+            ),
+        )
+        return key, value, attention_mask
+
     def repeat_kv(self, x, n_rep):
         """torch.repeat_interleave(x, dim=2, repeats=n_rep)"""
         bs, slen, n_kv_heads, head_dim = x.shape
@@ -659,7 +845,12 @@ class FlaxLLaMAAttention(nn.Module):
         if not deterministic and self.config.attn_pdrop > 0.0:
             dropout_rng = self.make_rng("dropout")
 
-        if self.config.scan_attention and not (self.has_variable("cache", "cached_key") or init_cache):
+        is_decoding = (
+            self.has_variable("cache", "cached_key")
+            or self.has_variable("cache", "key_pages")
+            or init_cache
+        )
+        if self.config.scan_attention and not is_decoding:
             # doesn't need blockwise attention if we are doing autoregressive decoding since no quadratic memory
             # if we have GQA - repeat out. have to do here due to kv cache shenanigans.
             xk = self.repeat_kv(xk, self.num_repetitions)
@@ -693,27 +884,38 @@ class FlaxLLaMAAttention(nn.Module):
             )
             attn_output = with_sharding_constraint(attn_output, PS(("dp", "fsdp"), None, "mp", None))
         else:
-            query_length, key_length = xq.shape[1], xk.shape[1]
-
-            if self.has_variable("cache", "cached_key"):
-                mask_shift = self.variables["cache"]["cache_index"]
-                max_decoder_length = self.variables["cache"]["cached_key"].shape[1]
-                causal_mask = lax.dynamic_slice(
-                    self.causal_mask, (0, 0, mask_shift, 0), (1, 1, query_length, max_decoder_length)
-                )
+            if self.has_variable("cache", "key_pages"):
+                xk, xv, attention_mask = self._write_and_gather_paged_cache(xk, xv, attention_mask)
             else:
-                causal_mask = self.causal_mask[:, :, :query_length, :key_length]
-
-            batch_size = hidden_states.shape[0]
-            causal_mask = jnp.broadcast_to(causal_mask, (batch_size,) + causal_mask.shape[1:])
-
-            attention_mask = jnp.broadcast_to(jnp.expand_dims(attention_mask, axis=(-3, -2)), causal_mask.shape)
-            attention_mask = combine_masks(attention_mask, causal_mask, fcm_mask)
-
-            # During fast autoregressive decoding, we feed one position at a time,
-            # and cache the keys and values step by step.
-            if self.has_variable("cache", "cached_key") or init_cache:
-                xk, xv, attention_mask = self._concatenate_to_cache(xk, xv, xq, attention_mask)
+                query_length, key_length = xq.shape[1], xk.shape[1]
+
+                if self.has_variable("cache", "cached_key"):
+                    mask_shift = self.variables["cache"]["cache_index"]
+                    max_decoder_length = self.variables["cache"]["cached_key"].shape[1]
+                    if mask_shift.ndim == 1:
+                        # Per-row cache indices
+                        query_positions = mask_shift[:, None] + jnp.arange(query_length)[None, :]
+                        causal_mask = (
+                            jnp.arange(max_decoder_length)[None, None, :]
+                            <= query_positions[:, :, None]
+                        )[:, None, :, :]
+                    else:
+                        causal_mask = lax.dynamic_slice(
+                            self.causal_mask, (0, 0, mask_shift, 0), (1, 1, query_length, max_decoder_length)
+                        )
+                else:
+                    causal_mask = self.causal_mask[:, :, :query_length, :key_length]
+
+                batch_size = hidden_states.shape[0]
+                causal_mask = jnp.broadcast_to(causal_mask, (batch_size,) + causal_mask.shape[1:])
+
+                attention_mask = jnp.broadcast_to(jnp.expand_dims(attention_mask, axis=(-3, -2)), causal_mask.shape)
+                attention_mask = combine_masks(attention_mask, causal_mask, fcm_mask)
+
+                # During fast autoregressive decoding, we feed one position at a time,
+                # and cache the keys and values step by step.
+                if self.has_variable("cache", "cached_key") or init_cache:
+                    xk, xv, attention_mask = self._concatenate_to_cache(xk, xv, xq, attention_mask)
 
             # grouped query attention: repeat if num_kv_heads < num_heads:
             xk = self.repeat_kv(xk, self.num_repetitions)
@@ -754,29 +956,17 @@ class FlaxLLaMAMLP(nn.Module):
     def setup(self) -> None:
         config = self.config
 
-        self.w1 = nn.Dense(
-            config.intermediate_size,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            use_bias=False,
-            kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
-            precision=self.precision,
+        self.w1 = make_dense(
+            config, config.intermediate_size,
+            self.dtype, self.param_dtype, self.precision,
         )
-        self.w2 = nn.Dense(
-            config.hidden_size,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            use_bias=False,
-            kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
-            precision=self.precision,
+        self.w2 = make_dense(
+            config, config.hidden_size,
+            self.dtype, self.param_dtype, self.precision,
         )
-        self.w3 = nn.Dense(
-            config.intermediate_size,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            use_bias=False,
-            kernel_init=jax.nn.initializers.normal(self.config.initializer_range),
-            precision=self.precision,
+        self.w3 = make_dense(
+            config, config.intermediate_size,
+            self.dtype, self.param_dtype, self.precision,
         )
         self.dropout = nn.Dropout(rate=self.config.resid_pdrop)
 
@@ -952,6 +1142,61 @@ class FlaxLLaMAPreTrainedModel(FlaxPreTrainedModel):
         )
         return init_variables["cache"]
 
+    def init_paged_cache(self, batch_size, num_blocks, block_size, max_length):
+        r"""
+        Args:
+            batch_size (`int`):
+                number of rows of the block tables.
+            num_blocks (`int`):
+                number of blocks in the shared pool, including the scratch block 0.
+            block_size (`int`):
+                number of tokens stored in each block.
+            max_length (`int`):
+                maximum possible length of a sequence, which defines the size of the block tables.
+        """
+        num_heads = self.config.num_attention_heads
+        num_kv_heads = self.config.num_key_value_heads or num_heads
+        head_dim = self.config.hidden_size // num_heads
+        max_blocks = -(-max_length // block_size)
+
+        def layer_cache():
+            return {
+                "key_pages": jnp.zeros((num_blocks, block_size, num_kv_heads, head_dim), dtype=self.dtype),
+                "value_pages": jnp.zeros((num_blocks, block_size, num_kv_heads, head_dim), dtype=self.dtype),
+                "block_tables": jnp.zeros((batch_size, max_blocks), dtype=jnp.int32),
+                "seq_lens": jnp.zeros((batch_size,), dtype=jnp.int32),
+            }
+
+        return {
+            "transformer": {
+                "h": {
+                    str(i): {"attention": layer_cache()}
+                    for i in range(self.config.num_hidden_layers)
+                }
+            }
+        }
+
+    @staticmethod
+    def get_paged_cache_tables(cache):
+        """ Return the block tables and sequence lengths of a paged cache. """
+        cache = flatten_dict(unfreeze(cache))
+        block_tables = [v for k, v in cache.items() if k[-1] == "block_tables"][0]
+        seq_lens = [v for k, v in cache.items() if k[-1] == "seq_lens"][0]
+        return block_tables, seq_lens
+
+    @staticmethod
+    def set_paged_cache_tables(cache, block_tables, seq_lens):
+        """ Replace the block tables and sequence lengths of all the layers
+            of a paged cache, keeping the shared blocks.
+        """
+        cache = flatten_dict(unfreeze(cache))
+        for key in cache.keys():
+            if key[-1] == "block_tables":
+                cache[key] = block_tables
+            elif key[-1] == "seq_lens":
+                cache[key] = seq_lens
+        return unflatten_dict(cache)
+
     @add_start_docstrings_to_model_forward("")
     def __call__(
         self,
@@ -1185,13 +1430,11 @@ class FlaxLLaMAForCausalLMModule(nn.Module):
 
     def setup(self):
         self.transformer = FlaxLLaMAModule(self.config, dtype=self.dtype)
-        self.lm_head = nn.Dense(
-            self.config.vocab_size,
-            dtype=self.dtype,
-            param_dtype=self.param_dtype,
-            use_bias=False,
-            kernel_init=jax.nn.initializers.normal(stddev=self.config.initializer_range),
-            precision=self.precision,
+        # The tied lm_head reuses the float embedding as its kernel
+        self.lm_head = make_dense(
+            self.config, self.config.vocab_size,
+            self.dtype, self.param_dtype, self.precision,
+            quantize=not self.config.tie_word_embeddings,
         )
 
     def __call__(
@@ -1,22 +1,28 @@
 import pprint
+import time
 from functools import partial
 
 import numpy as np
 import mlxu
+import absl.logging
 
 import jax
 import jax.numpy as jnp
+from jax import lax
 from jax.experimental.pjit import pjit
 from jax.sharding import PartitionSpec as PS
 import optax
-from transformers import GenerationConfig, FlaxLogitsProcessorList
+from flax.core.frozen_dict import unfreeze
+from flax.traverse_util import flatten_dict, unflatten_dict
 
 from EasyLM.checkpoint import StreamingCheckpointer
 from EasyLM.serving import LMServer
+from EasyLM.decoding import DecodeEngine, PrefixCache
+from EasyLM.sampling import filter_logits, sample_logits, sample_generate
 from EasyLM.jax_utils import (
     JaxRNG, JaxDistributedConfig, next_rng, match_partition_rules, tree_apply,
     set_random_seed, get_float_dtype_by_name, make_shard_and_gather_fns,
-    with_sharding_constraint, FlaxTemperatureLogitsWarper
+    with_sharding_constraint
 )
 from EasyLM.models.llama.llama_model import LLaMAConfig, FlaxLLaMAForCausalLM
 
@@ -28,15 +34,26 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     dtype='bf16',
     input_length=1024,
     seq_length=2048,
+    loglikelihood_min_bucket=128,
+    loglikelihood_shared_prefix=True,
+    loglikelihood_rolling_context=0,
     top_k=50,
     top_p=1.0,
+    min_p=0.0,
     do_sample=True,
     num_beams=1,
     add_bos_token=True,
     load_llama_config='',
     load_checkpoint='',
+    weight_quantization='',
+    weight_quantization_group_size=128,
+    load_draft_llama_config='',
+    load_draft_checkpoint='',
+    speculative_tokens=4,
     tokenizer=LLaMAConfig.get_tokenizer_config(),
     lm_server=LMServer.get_default_config(),
+    decode_engine=DecodeEngine.get_default_config(),
+    prefix_cache=PrefixCache.get_default_config(),
     jax_distributed=JaxDistributedConfig.get_default_config(),
 )
 
@@ -44,6 +61,11 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
 def main(argv):
     JaxDistributedConfig.initialize(FLAGS.jax_distributed)
     set_random_seed(FLAGS.seed)
+    if FLAGS.num_beams != 1:
+        absl.logging.warning(
+            'num_beams is deprecated and ignored, since beam search is not '
+            'supported by the native sampling loop.'
+        )
 
     prefix_tokenizer = LLaMAConfig.get_tokenizer(
         FLAGS.tokenizer, truncation_side='left', padding_side='left'
@@ -54,6 +76,12 @@ def main(argv):
 
     with jax.default_device(jax.devices("cpu")[0]):
         llama_config = LLaMAConfig.load_config(FLAGS.load_llama_config)
+        # The checkpoint of a quantized model is produced offline by
+        # quantize_llama_checkpoint with the same weight quantization.
+        llama_config.update(dict(
+            weight_quantization=FLAGS.weight_quantization,
+            weight_quantization_group_size=FLAGS.weight_quantization_group_size,
+        ))
         _, params = StreamingCheckpointer.load_trainstate_checkpoint(
             FLAGS.load_checkpoint, disallow_trainstate=True
         )
@@ -65,12 +93,35 @@ def main(argv):
             _do_init=False
         )
 
+        speculative_decoding = FLAGS.load_draft_checkpoint != ''
+        if speculative_decoding:
+            draft_llama_config = LLaMAConfig.load_config(FLAGS.load_draft_llama_config)
+            assert draft_llama_config.vocab_size == llama_config.vocab_size, (
+                'The draft model must share the vocabulary of the target model.'
+            )
+            _, draft_params = StreamingCheckpointer.load_trainstate_checkpoint(
+                FLAGS.load_draft_checkpoint, disallow_trainstate=True
+            )
+            draft_hf_model = FlaxLLaMAForCausalLM(
+                draft_llama_config,
+                input_shape=(1, FLAGS.seq_length),
+                seed=FLAGS.seed,
+                _do_init=False
+            )
+
     model_ps = match_partition_rules(
         LLaMAConfig.get_partition_rules(), params
     )
     shard_fns, _ = make_shard_and_gather_fns(
         model_ps, get_float_dtype_by_name(FLAGS.dtype)
     )
+    if speculative_decoding:
+        draft_model_ps = match_partition_rules(
+            LLaMAConfig.get_partition_rules(), draft_params
+        )
+        draft_shard_fns, _ = make_shard_and_gather_fns(
+            draft_model_ps, get_float_dtype_by_name(FLAGS.dtype)
+        )
 
     @partial(
         pjit,
@@ -103,107 +154,954 @@ def main(argv):
         is_greedy = match_count == total
         return loglikelihood, is_greedy, rng_generator()
 
+    @partial(
+        pjit,
+        in_shardings=(model_ps, PS()),
+        out_shardings=(PS(), PS(), PS())
+    )
+    def forward_loglikelihood_rolling(params, batch):
+        """ Loglikelihood of the windows of long texts, with an array of shape
+            (batch, num_windows, seq_length) for each input. All windows are
+            scored in a single scan, and the padding windows are skipped.
+            Returns the total loglikelihood, whether all the scored tokens are
+            greedy, and the loglikelihood of each scored token.
+        """
+        batch = with_sharding_constraint(batch, PS(('dp', 'fsdp')))
+
+        def score_window(window):
+            logits = hf_model.module.apply(
+                params, window['input_tokens'], attention_mask=window['input_mask'],
+                deterministic=True,
+            ).logits
+            token_loglikelihood = -optax.softmax_cross_entropy_with_integer_labels(
+                logits, window['output_tokens']
+            )
+            is_greedy = jnp.argmax(logits, axis=-1) == window['output_tokens']
+            return token_loglikelihood.astype(jnp.float32), is_greedy
+
+        def skip_window(window):
+            shape = window['output_tokens'].shape
+            return jnp.zeros(shape, dtype=jnp.float32), jnp.ones(shape, dtype=jnp.bool_)
+
+        def scan_fn(carry, window):
+            loglikelihood, is_greedy = carry
+            output_mask = window['output_mask']
+            token_loglikelihood, token_is_greedy = lax.cond(
+                jnp.any(output_mask > 0), score_window, skip_window, window
+            )
+            token_loglikelihood = token_loglikelihood * output_mask
+            carry = (
+                loglikelihood + jnp.sum(token_loglikelihood, axis=-1),
+                is_greedy & jnp.all(token_is_greedy | (output_mask == 0), axis=-1),
+            )
+            return carry, token_loglikelihood
+
+        batch_size = batch['output_tokens'].shape[0]
+        (loglikelihood, is_greedy), token_loglikelihood = lax.scan(
+            scan_fn,
+            (jnp.zeros((batch_size,), dtype=jnp.float32), jnp.ones((batch_size,), dtype=jnp.bool_)),
+            jax.tree_util.tree_map(lambda x: jnp.swapaxes(x, 0, 1), batch),
+        )
+        return loglikelihood, is_greedy, jnp.swapaxes(token_loglikelihood, 0, 1)
 
     @partial(
         pjit,
-        in_shardings=(model_ps, PS(), PS(), PS()),
+        in_shardings=(model_ps, PS()),
         out_shardings=(PS(), PS())
     )
-    def forward_generate(params, rng, batch, temperature):
-        batch = with_sharding_constraint(batch, PS(('dp', 'fsdp')))
-        rng_generator = JaxRNG(rng)
-        output = hf_model.generate(
-            batch['input_tokens'],
-            attention_mask=batch['attention_mask'],
-            params=params['params'],
-            prng_key=rng_generator(),
-            logits_processor=FlaxLogitsProcessorList(
-                [FlaxTemperatureLogitsWarper(temperature)]
+    def forward_shared_prefix_loglikelihood(params, batch):
+        """ Loglikelihood of continuations that share prefixes. Each unique
+            prefix is prefilled once into the KV cache, and the cache rows are
+            then gathered for the continuations of each prefix, so that the
+            continuations are scored without recomputing their prefix.
+        """
+        prefix_tokens = batch['prefix_tokens']
+        prefix_mask = batch['prefix_mask']
+        text_tokens = batch['text_tokens']
+        text_mask = batch['text_mask']
+        group_index = batch['group_index']
+        # The last token of the continuations is only scored, and is not fed
+        # to the model, as in the rows of make_loglikelihood_batch.
+        input_length = text_tokens.shape[1] - 1
+
+        outputs, variables = hf_model.module.apply(
+            {
+                'params': params['params'],
+                'cache': hf_model.init_cache(
+                    prefix_tokens.shape[0], prefix_tokens.shape[1] + input_length
+                ),
+            },
+            prefix_tokens,
+            jnp.concatenate(
+                [prefix_mask, jnp.zeros((prefix_mask.shape[0], input_length), dtype=prefix_mask.dtype)],
+                axis=1
             ),
-            generation_config=GenerationConfig(
-                max_new_tokens=FLAGS.seq_length - FLAGS.input_length,
-                pad_token_id=tokenizer.eos_token_id,
-                bos_token_id=tokenizer.bos_token_id,
-                eos_token_id=tokenizer.eos_token_id,
-                do_sample=FLAGS.do_sample,
-                num_beams=FLAGS.num_beams,
-                top_k=FLAGS.top_k,
-                top_p=FLAGS.top_p,
-            )
-        ).sequences[:, batch['input_tokens'].shape[1]:]
-        return output, rng_generator()
+            jnp.clip(jnp.cumsum(prefix_mask, axis=-1) - 1, a_min=0),
+            mutable=['cache'],
+        )
+        # The last prefix logits predict the first token of the continuation
+        logits = outputs.logits[:, -1:, :][group_index]
+        if input_length > 0:
+            cache = jax.tree_util.tree_map(
+                lambda x: x if x.ndim == 0 else x[group_index],
+                unfreeze(variables['cache'])
+            )
+            prefix_lengths = jnp.sum(prefix_mask, axis=-1)[group_index]
+            outputs, _ = hf_model.module.apply(
+                {'params': params['params'], 'cache': cache},
+                text_tokens[:, :-1],
+                jnp.concatenate([prefix_mask[group_index], text_mask[:, :-1]], axis=1),
+                prefix_lengths[:, None] + jnp.arange(input_length)[None, :],
+                mutable=['cache'],
+            )
+            logits = jnp.concatenate([logits, outputs.logits], axis=1)
+        logits = logits.astype(jnp.float32)
+        loglikelihood = -optax.softmax_cross_entropy_with_integer_labels(
+            logits, text_tokens
+        )
+        loglikelihood = jnp.sum(loglikelihood * text_mask, axis=-1)
+        match_count = jnp.sum(
+            (jnp.argmax(logits, axis=-1) == text_tokens) * text_mask, axis=-1
+        )
+        is_greedy = match_count == jnp.sum(text_mask, axis=-1)
+        return loglikelihood, is_greedy
+
 
     @partial(
         pjit,
         in_shardings=(model_ps, PS(), PS()),
         out_shardings=(PS(), PS())
     )
-    def forward_greedy_generate(params, rng, batch):
+    def forward_generate(params, rng, batch):
+        """ Sample with the sampling parameters of each row of the batch, so
+            that rows with different parameters share the compiled function.
+        """
         batch = with_sharding_constraint(batch, PS(('dp', 'fsdp')))
         rng_generator = JaxRNG(rng)
-        output = hf_model.generate(
-            batch['input_tokens'],
-            attention_mask=batch['attention_mask'],
-            params=params['params'],
-            prng_key=rng_generator(),
-            generation_config=GenerationConfig(
-                max_new_tokens=FLAGS.seq_length - FLAGS.input_length,
-                pad_token_id=tokenizer.eos_token_id,
-                bos_token_id=tokenizer.bos_token_id,
-                eos_token_id=tokenizer.eos_token_id,
-                do_sample=False,
-                num_beams=1,
-            )
-        ).sequences[:, batch['input_tokens'].shape[1]:]
+        output, _ = sample_generate(
+            hf_model, params, rng_generator(),
+            batch['input_tokens'], batch['attention_mask'],
+            max_new_tokens=FLAGS.seq_length - FLAGS.input_length,
+            temperature=batch['temperature'],
+            row_max_new_tokens=batch['max_new_tokens'],
+            top_k=batch['top_k'],
+            top_p=batch['top_p'],
+            min_p=batch['min_p'],
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.eos_token_id,
+        )
         return output, rng_generator()
 
+    @partial(
+        pjit,
+        in_shardings=(model_ps, PS()),
+        out_shardings=(PS(), PS(), PS())
+    )
+    def forward_greedy_until(params, batch):
+        """ Greedy decoding from the KV cache, which stops early once every
+            row has generated the EOS token or one of its stop token patterns.
+            The stop patterns of shape (batch, num_patterns, pattern_length)
+            are right aligned and padded with -1. Returns the generated
+            tokens, the number of generated tokens excluding EOS, and whether
+            each row generated EOS.
+        """
+        batch = with_sharding_constraint(batch, PS(('dp', 'fsdp')))
+        input_tokens = batch['input_tokens']
+        input_mask = batch['attention_mask']
+        stop_tokens = batch['stop_tokens']
+        batch_size = input_tokens.shape[0]
+        pattern_length = stop_tokens.shape[-1]
+        max_new_tokens = FLAGS.seq_length - FLAGS.input_length
+
+        attention_mask = jnp.concatenate(
+            [input_mask, jnp.ones((batch_size, max_new_tokens), dtype=input_mask.dtype)],
+            axis=1
+        )
+        position_ids = jnp.clip(jnp.cumsum(input_mask, axis=-1) - 1, a_min=0)
+        outputs, variables = hf_model.module.apply(
+            {
+                'params': params['params'],
+                'cache': hf_model.init_cache(batch_size, FLAGS.seq_length),
+            },
+            input_tokens, attention_mask, position_ids,
+            mutable=['cache'],
+        )
+
+        def update(state, tokens):
+            # The generated tokens are stored after pattern_length slots of
+            # -2, so that the last pattern_length tokens can always be sliced.
+            step = state['step']
+            output = state['output'].at[:, pattern_length + step].set(tokens)
+            window = lax.dynamic_slice_in_dim(output, step + 1, pattern_length, axis=1)
+            stopped = jnp.any(
+                jnp.all((stop_tokens == -1) | (stop_tokens == window[:, None, :]), axis=-1)
+                & jnp.any(stop_tokens != -1, axis=-1),
+                axis=-1
+            )
+            is_eos = tokens == tokenizer.eos_token_id
+            return dict(
+                state,
+                step=step + 1,
+                output=output,
+                lengths=jnp.where(state['done'] | is_eos, state['lengths'], state['lengths'] + 1),
+                eos=state['eos'] | (~state['done'] & is_eos),
+                done=state['done'] | is_eos | stopped,
+            )
+
+        state = update(
+            dict(
+                step=jnp.array(0, dtype=jnp.int32),
+                output=jnp.full(
+                    (batch_size, pattern_length + max_new_tokens), -2, dtype=jnp.int32
+                ),
+                lengths=jnp.zeros((batch_size,), dtype=jnp.int32),
+                eos=jnp.zeros((batch_size,), dtype=jnp.bool_),
+                done=jnp.zeros((batch_size,), dtype=jnp.bool_),
+                cache=unfreeze(variables['cache']),
+                positions=position_ids[:, -1] + 1,
+            ),
+            jnp.argmax(outputs.logits[:, -1, :], axis=-1).astype(jnp.int32),
+        )
+
+        def cond_fn(state):
+            return (state['step'] < max_new_tokens) & ~jnp.all(state['done'])
+
+        def body_fn(state):
+            tokens = state['output'][:, pattern_length + state['step'] - 1]
+            outputs, variables = hf_model.module.apply(
+                {'params': params['params'], 'cache': state['cache']},
+                tokens[:, None], attention_mask, state['positions'][:, None],
+                mutable=['cache'],
+            )
+            state = dict(
+                state,
+                cache=unfreeze(variables['cache']),
+                positions=state['positions'] + 1,
+            )
+            return update(
+                state,
+                jnp.argmax(outputs.logits[:, -1, :], axis=-1).astype(jnp.int32),
+            )
+
+        state = lax.while_loop(cond_fn, body_fn, state)
+        return state['output'][:, pattern_length:], state['lengths'], state['eos']
+
+    def stop_token_patterns(until):
+        """ Tokenize the stop strings into token patterns. A string is also
+            tokenized after a newline, since its tokenization in context can
+            differ from its tokenization at the beginning of a text.
+        """
+        newline = tokenizer.encode('\n', add_special_tokens=False)
+        patterns = []
+        for stop in until:
+            patterns.append(tokenizer.encode(stop, add_special_tokens=False))
+            in_context = tokenizer.encode('\n' + stop, add_special_tokens=False)
+            if in_context[:len(newline)] == newline:
+                patterns.append(in_context[len(newline):])
+        return [p for p in patterns if len(p) > 0]
+
+    if speculative_decoding:
+        # Speculative decoding. The draft model proposes speculative_tokens
+        # tokens, which are verified by a single forward pass of the target
+        # model with rejection sampling, so that the generated tokens follow
+        # the distribution of the target model. The KV caches of both models
+        # hold per-row cache indices, which are reset after every step to
+        # drop the keys and values of the rejected tokens.
+        num_speculative = FLAGS.speculative_tokens
+        assert num_speculative > 0
+        speculative_cache_length = FLAGS.seq_length + num_speculative
+
+        def init_row_cache(model, batch_size, max_length):
+            cache = flatten_dict(unfreeze(model.init_cache(batch_size, max_length)))
+            return unflatten_dict({
+                key: jnp.zeros((batch_size,), dtype=jnp.int32) if key[-1] == 'cache_index' else value
+                for key, value in cache.items()
+            })
+
+        def set_cache_index(cache, cache_index):
+            return unflatten_dict({
+                key: cache_index if key[-1] == 'cache_index' else value
+                for key, value in flatten_dict(unfreeze(cache)).items()
+            })
+
+        def token_probs(logits, batch):
+            """ Sampling distribution of the next tokens, with the temperature
+                and the top_k, top_p and min_p filters of each row, which are
+                applied in the same way to the draft and target models. Greedy
+                decoding uses one hot distributions, for which the rejection
+                sampling only accepts the draft tokens matching the greedy
+                target tokens.
+            """
+            temperature = batch['temperature']
+            logits = logits.astype(jnp.float32)
+            temperature = jnp.reshape(
+                temperature, temperature.shape + (1,) * (logits.ndim - 1)
+            )
+            greedy_probs = jax.nn.one_hot(
+                jnp.argmax(logits, axis=-1), logits.shape[-1], dtype=jnp.float32
+            )
+            if not FLAGS.do_sample:
+                return greedy_probs
+            logits = filter_logits(
+                logits / jnp.maximum(temperature, 1e-8),
+                batch['top_k'], batch['top_p'], batch['min_p'],
+            )
+            probs = jax.nn.softmax(logits, axis=-1)
+            return jnp.where(temperature > 0, probs, greedy_probs)
+
+        def sample_probs(rng, probs):
+            return jax.random.categorical(rng, jnp.log(probs), axis=-1).astype(jnp.int32)
+
+        @partial(
+            pjit,
+            in_shardings=(model_ps, draft_model_ps, PS(), PS()),
+            out_shardings=(PS(), PS(), PS(), PS(), PS(), PS())
+        )
+        def forward_speculative_generate(params, draft_params, rng, batch):
+            """ Sample from the target model with speculative decoding, which
+                stops early once every row has generated the EOS token. Returns
+                the generated tokens padded with EOS, the number of generated
+                tokens, and the number of drafted tokens, accepted tokens and
+                target model steps.
+            """
+            batch = with_sharding_constraint(batch, PS(('dp', 'fsdp')))
+            rng_generator = JaxRNG(rng)
+            input_tokens = batch['input_tokens']
+            input_mask = batch['attention_mask']
+            row_max_new_tokens = batch['max_new_tokens']
+            batch_size = input_tokens.shape[0]
+            max_new_tokens = FLAGS.seq_length - FLAGS.input_length
+            eos_token_id = tokenizer.eos_token_id
+
+            attention_mask = jnp.concatenate(
+                [
+                    input_mask,
+                    jnp.ones(
+                        (batch_size, speculative_cache_length - FLAGS.input_length),
+                        dtype=input_mask.dtype
+                    ),
+                ],
+                axis=1
+            )
+            position_ids = jnp.clip(jnp.cumsum(input_mask, axis=-1) - 1, a_min=0)
+
+            def prefill(model, model_params):
+                outputs, variables = model.module.apply(
+                    {
+                        'params': model_params['params'],
+                        'cache': init_row_cache(model, batch_size, speculative_cache_length),
+                    },
+                    input_tokens, attention_mask, position_ids,
+                    mutable=['cache'],
+                )
+                return outputs.logits[:, -1, :], unfreeze(variables['cache'])
+
+            logits, cache = prefill(hf_model, params)
+            _, draft_cache = prefill(draft_hf_model, draft_params)
+            tokens = sample_probs(rng_generator(), token_probs(logits, batch))
+
+            # The last generated token of every row is not yet in the caches,
+            # so the cache index of a row is input_length + lengths - 1.
+            state = dict(
+                output=jnp.full(
+                    (batch_size, max_new_tokens + num_speculative + 1),
+                    eos_token_id, dtype=jnp.int32
+                ).at[:, 0].set(tokens),
+                lengths=jnp.ones((batch_size,), dtype=jnp.int32),
+                done=(tokens == eos_token_id) | (row_max_new_tokens <= 1),
+                positions=position_ids[:, -1] + 1,
+                cache=cache,
+                draft_cache=draft_cache,
+                rng=rng_generator(),
+                num_drafted=jnp.array(0, dtype=jnp.int32),
+                num_accepted=jnp.array(0, dtype=jnp.int32),
+                num_steps=jnp.array(0, dtype=jnp.int32),
+            )
+
+            def cond_fn(state):
+                return ~jnp.all(state['done'])
+
+            def body_fn(state):
+                rng_generator = JaxRNG(state['rng'])
+                last_tokens = jnp.take_along_axis(
+                    state['output'], state['lengths'][:, None] - 1, axis=1
+                )[:, 0]
+                cache_index = FLAGS.input_length + state['lengths'] - 1
+
+                # The draft model also runs on its last draft token, so that
+                # its cache is complete when all the draft tokens are accepted.
+                def draft_step(carry, offset):
+                    draft_cache, tokens, rng = carry
+                    rng, sample_rng = jax.random.split(rng)
+                    outputs, variables = draft_hf_model.module.apply(
+                        {'params': draft_params['params'], 'cache': draft_cache},
+                        tokens[:, None], attention_mask,
+                        (state['positions'] + offset)[:, None],
+                        mutable=['cache'],
+                    )
+                    probs = token_probs(outputs.logits[:, -1, :], batch)
+                    tokens = sample_probs(sample_rng, probs)
+                    return (unfreeze(variables['cache']), tokens, rng), (tokens, probs)
+
+                (draft_cache, _, _), (draft_tokens, draft_probs) = lax.scan(
+                    draft_step,
+                    (set_cache_index(state['draft_cache'], cache_index), last_tokens, rng_generator()),
+                    jnp.arange(num_speculative + 1),
+                )
+                draft_tokens = draft_tokens[:num_speculative].T
+                draft_probs = jnp.swapaxes(draft_probs[:num_speculative], 0, 1)
+
+                outputs, variables = hf_model.module.apply(
+                    {'params': params['params'], 'cache': set_cache_index(state['cache'], cache_index)},
+                    jnp.concatenate([last_tokens[:, None], draft_tokens], axis=1),
+                    attention_mask,
+                    state['positions'][:, None] + jnp.arange(num_speculative + 1)[None, :],
+                    mutable=['cache'],
+                )
+                target_probs = token_probs(outputs.logits, batch)
+
+                # Accept every draft token x with probability min(1, p(x) / q(x))
+                # until the first rejection.
+                p = jnp.take_along_axis(target_probs[:, :-1], draft_tokens[..., None], axis=-1)[..., 0]
+                q = jnp.take_along_axis(draft_probs, draft_tokens[..., None], axis=-1)[..., 0]
+                accepted = jax.random.uniform(rng_generator(), p.shape) * q < p
+                num_accepted = jnp.sum(jnp.cumprod(accepted.astype(jnp.int32), axis=1), axis=1)
+
+                # Resample the first rejected token from max(0, p - q), or
+                # sample a bonus token from p when all the tokens are accepted.
+                draft_probs = jnp.concatenate(
+                    [draft_probs, jnp.zeros_like(draft_probs[:, :1])], axis=1
+                )
+                p = jnp.take_along_axis(target_probs, num_accepted[:, None, None], axis=1)[:, 0]
+                q = jnp.take_along_axis(draft_probs, num_accepted[:, None, None], axis=1)[:, 0]
+                residual = jnp.maximum(p - q, 0.0)
+                residual = jnp.where(jnp.sum(residual, axis=-1, keepdims=True) > 0, residual, p)
+                next_tokens = sample_probs(rng_generator(), residual)
+
+                offsets = jnp.arange(num_speculative + 1)[None, :]
+                new_tokens = jnp.where(
+                    offsets < num_accepted[:, None],
+                    jnp.concatenate([draft_tokens, next_tokens[:, None]], axis=1),
+                    next_tokens[:, None],
+                )
+                is_eos = (new_tokens == eos_token_id) & (offsets <= num_accepted[:, None])
+                num_new = jnp.where(
+                    jnp.any(is_eos, axis=1), jnp.argmax(is_eos, axis=1) + 1, num_accepted + 1
+                )
+                num_new = jnp.minimum(num_new, row_max_new_tokens - state['lengths'])
+                num_new = jnp.where(state['done'], 0, num_new)
+                output = jax.vmap(
+                    lambda row, tokens, start: lax.dynamic_update_slice(row, tokens, (start,))
+                )(state['output'], new_tokens, state['lengths'])
+                lengths = state['lengths'] + num_new
+                active = ~state['done']
+                return dict(
+                    output=jnp.where(state['done'][:, None], state['output'], output),
+                    lengths=lengths,
+                    done=state['done'] | jnp.any(is_eos, axis=1) | (lengths >= row_max_new_tokens),
+                    positions=state['positions'] + num_new,
+                    cache=unfreeze(variables['cache']),
+                    draft_cache=draft_cache,
+                    rng=rng_generator(),
+                    num_drafted=state['num_drafted'] + num_speculative * jnp.sum(active),
+                    num_accepted=state['num_accepted'] + jnp.sum(jnp.where(active, num_accepted, 0)),
+                    num_steps=state['num_steps'] + 1,
+                )
+
+            state = lax.while_loop(cond_fn, body_fn, state)
+            output = jnp.where(
+                jnp.arange(max_new_tokens)[None, :] < state['lengths'][:, None],
+                state['output'][:, :max_new_tokens],
+                eos_token_id,
+            )
+            return (
+                output, state['lengths'], state['num_drafted'],
+                state['num_accepted'], state['num_steps'], rng_generator(),
+            )
+
+        speculative_stats = dict(
+            requests=0, generated_tokens=0, drafted_tokens=0,
+            accepted_tokens=0, target_steps=0, generate_time=0.0,
+        )
+
+    # In-flight batching decode loop. The decode state holds a KV cache with
+    # one row per slot and a per-row cache index, along with the attention
+    # mask, next input token, next position and sampling parameters of every
+    # slot.
+    # With a paged KV cache, the slots instead share a pool of cache blocks
+    # and each slot holds a block table and sequence length.
+    num_slots = FLAGS.decode_engine.num_slots
+    paged_cache = FLAGS.decode_engine.block_size > 0
+    if paged_cache:
+        block_size = FLAGS.decode_engine.block_size
+        max_cache_length = -(-FLAGS.seq_length // block_size) * block_size
+        paged_cache_shape = flatten_dict(jax.eval_shape(
+            lambda: hf_model.init_paged_cache(
+                num_slots, FLAGS.decode_engine.num_blocks, block_size,
+                FLAGS.seq_length
+            )
+        ))
+        cache_ps = unflatten_dict({
+            key: PS(None, None, 'mp', None) if key[-1] in ('key_pages', 'value_pages') else PS()
+            for key in paged_cache_shape.keys()
+        })
+    else:
+        max_cache_length = FLAGS.seq_length
+        single_cache_shape = flatten_dict(unfreeze(jax.eval_shape(
+            lambda: hf_model.init_cache(1, FLAGS.seq_length)
+        )))
+        cache_ps = unflatten_dict({
+            key: PS() if key[-1] == 'cache_index' else PS(('dp', 'fsdp'), None, 'mp', None)
+            for key in single_cache_shape.keys()
+        })
+    decode_state_ps = dict(
+        cache=cache_ps,
+        attention_mask=PS(),
+        tokens=PS(),
+        positions=PS(),
+        temperature=PS(),
+        top_k=PS(),
+        top_p=PS(),
+        min_p=PS(),
+    )
+    slot_sampling_keys = ('temperature', 'top_k', 'top_p', 'min_p')
+
+    def sample_tokens(logits, sampling, rng):
+        temperature = sampling['temperature']
+        if not FLAGS.do_sample:
+            temperature = jnp.zeros_like(temperature)
+        return sample_logits(
+            logits, rng, temperature, top_k=sampling['top_k'],
+            top_p=sampling['top_p'], min_p=sampling['min_p'],
+        )
+
+    def sample_first_token(logits, sampling, rng):
+        sampling = jax.tree_util.tree_map(lambda x: jnp.reshape(x, (1,)), sampling)
+        return sample_tokens(logits, sampling, rng)[0]
+
+    def set_slot_sampling(state, slot, sampling):
+        return {
+            key: state[key].at[slot].set(sampling[key])
+            for key in slot_sampling_keys
+        }
+
+    @partial(pjit, in_shardings=(), out_shardings=decode_state_ps)
+    def decode_init():
+        if paged_cache:
+            cache = hf_model.init_paged_cache(
+                num_slots, FLAGS.decode_engine.num_blocks, block_size,
+                FLAGS.seq_length
+            )
+            # Attention is masked by the sequence length of each slot
+            attention_mask = jnp.ones((num_slots, max_cache_length), dtype=jnp.int32)
+        else:
+            cache = unflatten_dict({
+                key: jnp.zeros(
+                    (num_slots,) if key[-1] == 'cache_index' else (num_slots,) + shape.shape[1:],
+                    shape.dtype
+                )
+                for key, shape in single_cache_shape.items()
+            })
+            attention_mask = jnp.zeros((num_slots, FLAGS.seq_length), dtype=jnp.int32)
+        return dict(
+            cache=cache,
+            attention_mask=attention_mask,
+            tokens=jnp.zeros((num_slots,), dtype=jnp.int32),
+            positions=jnp.zeros((num_slots,), dtype=jnp.int32),
+            temperature=jnp.zeros((num_slots,), dtype=jnp.float32),
+            top_k=jnp.zeros((num_slots,), dtype=jnp.int32),
+            top_p=jnp.ones((num_slots,), dtype=jnp.float32),
+            min_p=jnp.zeros((num_slots,), dtype=jnp.float32),
+        )
+
+    @partial(
+        pjit,
+        in_shardings=(model_ps, PS(), decode_state_ps, PS(), PS(), PS()),
+        out_shardings=(decode_state_ps, PS(), PS()),
+        donate_argnums=(2,),
+    )
+    def decode_insert(params, rng, state, slot, batch, sampling):
+        rng_generator = JaxRNG(rng)
+        input_tokens = batch['input_tokens']
+        input_mask = batch['attention_mask']
+        cache = unflatten_dict({
+            key: jnp.zeros(shape.shape, shape.dtype)
+            for key, shape in single_cache_shape.items()
+        })
+        attention_mask = jnp.concatenate(
+            [input_mask, jnp.ones((1, FLAGS.seq_length - FLAGS.input_length), dtype=input_mask.dtype)],
+            axis=1
+        )
+        position_ids = jnp.clip(jnp.cumsum(input_mask, axis=-1) - 1, a_min=0)
+        outputs, variables = hf_model.module.apply(
+            {'params': params['params'], 'cache': cache},
+            input_tokens, attention_mask, position_ids,
+            mutable=['cache'],
+        )
+        token = sample_first_token(outputs.logits[:, -1, :], sampling, rng_generator())
+
+        def insert_row(slots_value, row_value):
+            if row_value.ndim == 0:
+                return slots_value.at[slot].set(row_value)
+            return lax.dynamic_update_slice_in_dim(slots_value, row_value, slot, axis=0)
+
+        state = dict(
+            cache=jax.tree_util.tree_map(insert_row, state['cache'], unfreeze(variables['cache'])),
+            attention_mask=state['attention_mask'].at[slot].set(attention_mask[0]),
+            tokens=state['tokens'].at[slot].set(token),
+            positions=state['positions'].at[slot].set(position_ids[0, -1] + 1),
+            **set_slot_sampling(state, slot, sampling),
+        )
+        return state, token, rng_generator()
+
+    @partial(
+        pjit,
+        in_shardings=(model_ps, PS(), decode_state_ps, PS(), PS(), PS(), PS()),
+        out_shardings=(decode_state_ps, PS(), PS()),
+        donate_argnums=(2,),
+    )
+    def decode_insert_paged(params, rng, state, slot, batch, sampling, block_table):
+        rng_generator = JaxRNG(rng)
+        # The prompt is right padded, and the padding positions beyond its
+        # length are overwritten by the generated tokens.
+        input_tokens = batch['input_tokens']
+        length = batch['length']
+        block_tables, seq_lens = hf_model.get_paged_cache_tables(state['cache'])
+        cache = hf_model.set_paged_cache_tables(
+            state['cache'], block_table[None, :], jnp.zeros((1,), dtype=jnp.int32)
+        )
+        outputs, variables = hf_model.module.apply(
+            {'params': params['params'], 'cache': cache},
+            input_tokens,
+            jnp.ones((1, max_cache_length), dtype=jnp.int32),
+            jnp.arange(FLAGS.input_length, dtype=jnp.int32)[None, :],
+            mutable=['cache'],
+        )
+        token = sample_first_token(
+            outputs.logits[:, length - 1, :], sampling, rng_generator()
+        )
+        state = dict(
+            state,
+            cache=hf_model.set_paged_cache_tables(
+                variables['cache'],
+                block_tables.at[slot].set(block_table),
+                seq_lens.at[slot].set(length),
+            ),
+            tokens=state['tokens'].at[slot].set(token),
+            positions=state['positions'].at[slot].set(length),
+            **set_slot_sampling(state, slot, sampling),
+        )
+        return state, token, rng_generator()
+
+    @partial(
+        pjit,
+        in_shardings=(decode_state_ps, PS()),
+        out_shardings=decode_state_ps,
+        donate_argnums=(0,),
+    )
+    def decode_release_paged(state, slot):
+        # Point the free slot to the scratch block so that the decode steps
+        # for it never write into blocks owned by other sequences.
+        block_tables, seq_lens = hf_model.get_paged_cache_tables(state['cache'])
+        return dict(
+            state,
+            cache=hf_model.set_paged_cache_tables(
+                state['cache'],
+                block_tables.at[slot].set(0),
+                seq_lens.at[slot].set(0),
+            ),
+            positions=state['positions'].at[slot].set(0),
+        )
+
+    @partial(
+        pjit,
+        in_shardings=(model_ps, PS(), decode_state_ps),
+        out_shardings=(decode_state_ps, PS(), PS()),
+        donate_argnums=(2,),
+    )
+    def decode_step(params, rng, state):
+        rng_generator = JaxRNG(rng)
+        outputs, variables = hf_model.module.apply(
+            {'params': params['params'], 'cache': state['cache']},
+            state['tokens'][:, None], state['attention_mask'],
+            state['positions'][:, None],
+            mutable=['cache'],
+        )
+        tokens = sample_tokens(outputs.logits[:, -1, :], state, rng_generator())
+        state = dict(
+            state,
+            cache=unfreeze(variables['cache']),
+            tokens=tokens,
+            positions=state['positions'] + 1,
+        )
+        return state, tokens, rng_generator()
+
+    if FLAGS.prefix_cache.enable:
+        # Prefix caching for the decode engine. Prompts are prefilled right
+        # padded from position 0, so the cache of each block of a prompt only
+        # depends on the tokens up to that block, and the cached blocks of a
+        # prompt prefix are copied into the slot before the prefill of the
+        # remaining tokens.
+        assert not paged_cache, 'Prefix cache is not supported with a paged KV cache.'
+        prefix_block_size = FLAGS.prefix_cache.block_size
+        prefix_block_ps = unflatten_dict({
+            key: PS(None, 'mp', None)
+            for key in single_cache_shape.keys() if key[-1] != 'cache_index'
+        })
+        prefix_block_bytes = sum(
+            prefix_block_size * np.prod(shape.shape[2:]) * shape.dtype.itemsize
+            for key, shape in single_cache_shape.items() if key[-1] != 'cache_index'
+        )
+
+        @partial(
+            pjit,
+            in_shardings=(decode_state_ps, PS(), PS()),
+            out_shardings=prefix_block_ps,
+        )
+        def read_prefix_block(state, slot, offset):
+            return unflatten_dict({
+                key: lax.dynamic_slice(
+                    value, (slot, offset, 0, 0), (1, prefix_block_size) + value.shape[2:]
+                )[0]
+                for key, value in flatten_dict(state['cache']).items()
+                if key[-1] != 'cache_index'
+            })
+
+        @partial(
+            pjit,
+            in_shardings=(decode_state_ps, PS(), prefix_block_ps, PS()),
+            out_shardings=decode_state_ps,
+            donate_argnums=(0,),
+        )
+        def write_prefix_block(state, slot, block, offset):
+            cache = flatten_dict(state['cache'])
+            for key, value in flatten_dict(block).items():
+                cache[key] = lax.dynamic_update_slice(
+                    cache[key], value[None].astype(cache[key].dtype), (slot, offset, 0, 0)
+                )
+            return dict(state, cache=unflatten_dict(cache))
+
+        @partial(
+            pjit,
+            in_shardings=(model_ps, PS(), decode_state_ps, PS(), PS(), PS()),
+            out_shardings=(decode_state_ps, PS(), PS()),
+            donate_argnums=(2,),
+        )
+        def decode_insert_suffix(params, rng, state, slot, batch, sampling):
+            # Prefill the tokens after the cached prefix, starting from the
+            # cache row of the slot. The suffix is right padded to end at
+            # input_length, and the padding positions are overwritten by the
+            # generated tokens.
+            rng_generator = JaxRNG(rng)
+            input_tokens = batch['input_tokens']
+            start = batch['start']
+            length = batch['length']
+            state_cache = flatten_dict(state['cache'])
+            cache = unflatten_dict({
+                key: (
+                    start if key[-1] == 'cache_index'
+                    else lax.dynamic_slice_in_dim(value, slot, 1, axis=0)
+                )
+                for key, value in state_cache.items()
+            })
+            outputs, variables = hf_model.module.apply(
+                {'params': params['params'], 'cache': cache},
+                input_tokens,
+                jnp.ones((1, FLAGS.seq_length), dtype=jnp.int32),
+                start + jnp.arange(input_tokens.shape[1], dtype=jnp.int32)[None, :],
+                mutable=['cache'],
+            )
+            token = sample_first_token(
+                outputs.logits[:, length - start - 1, :], sampling, rng_generator()
+            )
+            row_cache = flatten_dict(unfreeze(variables['cache']))
+            cache = unflatten_dict({
+                key: (
+                    value.at[slot].set(length) if key[-1] == 'cache_index'
+                    else lax.dynamic_update_slice_in_dim(value, row_cache[key], slot, axis=0)
+                )
+                for key, value in state_cache.items()
+            })
+            state = dict(
+                cache=cache,
+                attention_mask=state['attention_mask'].at[slot].set(1),
+                tokens=state['tokens'].at[slot].set(token),
+                positions=state['positions'].at[slot].set(length),
+                **set_slot_sampling(state, slot, sampling),
+            )
+            return state, token, rng_generator()
+
     mesh = LLaMAConfig.get_jax_mesh(FLAGS.mesh_dim)
     with mesh:
         params = tree_apply(shard_fns, params)
+        if speculative_decoding:
+            draft_params = tree_apply(draft_shard_fns, draft_params)
         sharded_rng = next_rng()
 
+    # Loglikelihood batches are padded to the smallest length bucket that
+    # fits the longest row, instead of always padding to seq_length.
+    loglikelihood_buckets = []
+    bucket = FLAGS.loglikelihood_min_bucket
+    while 0 < bucket < FLAGS.seq_length:
+        loglikelihood_buckets.append(bucket)
+        bucket *= 2
+    loglikelihood_buckets.append(FLAGS.seq_length)
+
+    def make_loglikelihood_batch(prefix_text, text):
+        """ Tokenize the prefix and text into left padded rows of the
+            smallest bucket length. The prefix is truncated to input_length
+            tokens and the text to seq_length - input_length tokens.
+        """
+        prefix_ids = prefix_tokenizer(
+            prefix_text, truncation=True, max_length=FLAGS.input_length,
+        ).input_ids
+        text_ids = tokenizer(
+            text, truncation=True, max_length=FLAGS.seq_length - FLAGS.input_length,
+        ).input_ids
+        max_length = max(len(p) + len(t) for p, t in zip(prefix_ids, text_ids))
+        bucket = min(b for b in loglikelihood_buckets if b >= max_length)
+
+        shape = (len(text_ids), bucket)
+        input_tokens = np.full(shape, tokenizer.pad_token_id, dtype=np.int32)
+        output_tokens = np.full(shape, tokenizer.pad_token_id, dtype=np.int32)
+        input_mask = np.zeros(shape, dtype=np.int32)
+        output_mask = np.zeros(shape, dtype=np.int32)
+        for i, (p, t) in enumerate(zip(prefix_ids, text_ids)):
+            tokens = p + t
+            start = bucket - len(tokens)
+            if len(tokens) == 0:
+                continue
+            output_tokens[i, start:] = tokens
+            input_tokens[i, start:] = [tokenizer.bos_token_id] + tokens[:-1]
+            input_mask[i, start:] = 1
+            input_mask[i, start] = int(FLAGS.add_bos_token)
+            output_mask[i, bucket - len(t):] = 1
+        return dict(
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            input_mask=input_mask,
+            output_mask=output_mask,
+        )
+
+    # Lengths of the prefix rows, which hold the BOS token and up to
+    # input_length prefix tokens, and of the text rows of the shared prefix
+    # loglikelihood batches.
+    shared_prefix_lengths = sorted(set(
+        min(FLAGS.input_length + 1, b) for b in loglikelihood_buckets
+    ))
+    shared_text_lengths = sorted(set(
+        min(FLAGS.seq_length - FLAGS.input_length, b) for b in loglikelihood_buckets
+    ))
+
+    def make_shared_prefix_loglikelihood_batch(prefix_text, text):
+        """ Tokenize the unique prefixes into left padded rows, which start
+            with the BOS token, and the texts into right padded rows, which
+            refer to the row of their prefix through group_index. The number
+            of prefix rows is padded to a power of two. The prefix and text
+            are truncated as in make_loglikelihood_batch.
+        """
+        groups = {}
+        group_index = np.array(
+            [groups.setdefault(p, len(groups)) for p in prefix_text], dtype=np.int32
+        )
+        prefix_ids = prefix_tokenizer(
+            list(groups.keys()), truncation=True, max_length=FLAGS.input_length,
+        ).input_ids
+        text_ids = tokenizer(
+            text, truncation=True, max_length=FLAGS.seq_length - FLAGS.input_length,
+        ).input_ids
+        prefix_length = min(
+            b for b in shared_prefix_lengths if b >= max(len(p) for p in prefix_ids) + 1
+        )
+        text_length = min(
+            b for b in shared_text_lengths if b >= max(max(len(t) for t in text_ids), 1)
+        )
+
+        num_prefixes = 1 << (len(prefix_ids) - 1).bit_length()
+        prefix_tokens = np.full(
+            (num_prefixes, prefix_length), tokenizer.pad_token_id, dtype=np.int32
+        )
+        prefix_mask = np.zeros((num_prefixes, prefix_length), dtype=np.int32)
+        for i, p in enumerate(prefix_ids + [[] for _ in range(num_prefixes - len(prefix_ids))]):
+            start = prefix_length - len(p) - 1
+            prefix_tokens[i, start:] = [tokenizer.bos_token_id] + p
+            prefix_mask[i, start:] = 1
+            prefix_mask[i, start] = int(FLAGS.add_bos_token)
+
+        text_tokens = np.full(
+            (len(text_ids), text_length), tokenizer.pad_token_id, dtype=np.int32
+        )
+        text_mask = np.zeros((len(text_ids), text_length), dtype=np.int32)
+        for i, t in enumerate(text_ids):
+            text_tokens[i, :len(t)] = t
+            text_mask[i, :len(t)] = 1
+        return dict(
+            prefix_tokens=prefix_tokens,
+            prefix_mask=prefix_mask,
+            text_tokens=text_tokens,
+            text_mask=text_mask,
+            group_index=group_index,
+        )
+
+    def make_rolling_loglikelihood_batch(text):
+        """ Split the texts into windows of seq_length tokens with a stride
+            of seq_length - loglikelihood_rolling_context. Every token is
+            scored exactly once, and all tokens except those of the first
+            window are scored with at least loglikelihood_rolling_context
+            tokens of context. The number of windows is padded to a power of
+            two, and the padding windows are not scored.
+        """
+        window_length = FLAGS.seq_length
+        context_length = FLAGS.loglikelihood_rolling_context
+        assert 0 <= context_length < window_length
+        stride = window_length - context_length
+
+        token_ids = tokenizer(text, truncation=False).input_ids
+        num_windows = [
+            1 + max(len(t) - window_length + stride - 1, 0) // stride
+            for t in token_ids
+        ]
+        padded_num_windows = 1 << (max(num_windows) - 1).bit_length()
+
+        shape = (len(token_ids), padded_num_windows, window_length)
+        input_tokens = np.full(shape, tokenizer.pad_token_id, dtype=np.int32)
+        output_tokens = np.full(shape, tokenizer.pad_token_id, dtype=np.int32)
+        input_mask = np.zeros(shape, dtype=np.int32)
+        output_mask = np.zeros(shape, dtype=np.int32)
+        for i, tokens in enumerate(token_ids):
+            tokens = np.asarray(tokens, dtype=np.int32)
+            inputs = np.concatenate([[tokenizer.bos_token_id], tokens[:-1]]).astype(np.int32)
+            for k in range(num_windows[i]):
+                score_start = 0 if k == 0 else window_length + (k - 1) * stride
+                score_end = min(window_length + k * stride, len(tokens))
+                start = max(score_end - window_length, 0)
+                end = min(start + window_length, len(tokens))
+                input_tokens[i, k, :end - start] = inputs[start:end]
+                output_tokens[i, k, :end - start] = tokens[start:end]
+                input_mask[i, k, :end - start] = 1
+                output_mask[i, k, score_start - start:score_end - start] = 1
+        return dict(
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            input_mask=input_mask,
+            output_mask=output_mask,
+        )
+
     class ModelServer(LMServer):
 
         @staticmethod
         def loglikelihood(prefix_text, text):
             nonlocal sharded_rng
-            prefix = prefix_tokenizer(
-                prefix_text,
-                padding='max_length',
-                truncation=True,
-                max_length=FLAGS.input_length,
-                return_tensors='np',
-            )
-            inputs = tokenizer(
-                text,
-                padding='max_length',
-                truncation=True,
-                max_length=FLAGS.seq_length - FLAGS.input_length,
-                return_tensors='np',
-            )
-            output_tokens = np.concatenate([prefix.input_ids, inputs.input_ids], axis=1)
-            bos_tokens = np.full(
-                (output_tokens.shape[0], 1), tokenizer.bos_token_id, dtype=np.int32
-            )
-            input_tokens = np.concatenate([bos_tokens, output_tokens[:, :-1]], axis=-1)
-            input_mask = np.concatenate(
-                [prefix.attention_mask, inputs.attention_mask], axis=1
-            )
-            if FLAGS.add_bos_token:
-                bos_mask = np.ones_like(input_mask[:, :1])
-            else:
-                bos_mask = np.zeros_like(input_mask[:, :1])
+            if FLAGS.loglikelihood_shared_prefix and len(set(prefix_text)) < len(prefix_text):
+                # Score the continuations of each shared prefix together
+                batch = make_shared_prefix_loglikelihood_batch(prefix_text, text)
+                with mesh:
+                    loglikelihood, is_greedy = jax.device_get(
+                        forward_shared_prefix_loglikelihood(params, batch)
+                    )
+                return loglikelihood, is_greedy
 
-            input_mask = np.concatenate([bos_mask, input_mask[:, :-1]], axis=1)
-            output_mask = np.concatenate(
-                [np.zeros_like(prefix.attention_mask), inputs.attention_mask], axis=1
-            )
-            batch = dict(
-                input_tokens=input_tokens,
-                output_tokens=output_tokens,
-                input_mask=input_mask,
-                output_mask=output_mask,
-            )
+            batch = make_loglikelihood_batch(prefix_text, text)
             with mesh:
                 loglikelihood, is_greedy, sharded_rng = forward_loglikelihood(
                     params, sharded_rng, batch
@@ -211,77 +1109,79 @@ def main(argv):
                 loglikelihood, is_greedy = jax.device_get((loglikelihood, is_greedy))
             return loglikelihood, is_greedy
 
-        @staticmethod
-        def loglikelihood_rolling(text):
+        def pre_compile_loglikelihood(self, pre_compile_data):
             nonlocal sharded_rng
-            inputs = tokenizer(
-                text,
-                padding='longest',
-                truncation=False,
-                max_length=np.iinfo(np.int32).max,
-                return_tensors='np',
-            )
-            batch_size = inputs.input_ids.shape[0]
-            output_tokens = inputs.input_ids
-            attention_mask = inputs.attention_mask
-
-            if output_tokens.shape[1] < FLAGS.seq_length:
-                padding_length = FLAGS.seq_length - output_tokens.shape[1]
-                pad_tokens = np.full(
-                    (batch_size, padding_length), tokenizer.pad_token_id, dtype=np.int32
-                )
-                output_tokens = np.concatenate([output_tokens, pad_tokens], axis=-1)
-                pad_mask = np.zeros(
-                    (batch_size, padding_length), dtype=inputs.attention_mask.dtype
+            super().pre_compile_loglikelihood(pre_compile_data)
+            for bucket in loglikelihood_buckets:
+                shape = (len(pre_compile_data), bucket)
+                batch = dict(
+                    input_tokens=np.zeros(shape, dtype=np.int32),
+                    output_tokens=np.zeros(shape, dtype=np.int32),
+                    input_mask=np.ones(shape, dtype=np.int32),
+                    output_mask=np.ones(shape, dtype=np.int32),
                 )
-                attention_mask = np.concatenate([attention_mask, pad_mask], axis=-1)
-
-            bos_tokens = np.full(
-                (batch_size, 1), tokenizer.bos_token_id, dtype=np.int32
-            )
-            input_tokens = np.concatenate([bos_tokens, output_tokens[:, :-1]], axis=-1)
-            bos_mask = np.ones((batch_size, 1), dtype=inputs.attention_mask.dtype)
-            total_seq_length = output_tokens.shape[1]
-
-            total_loglikelihood = 0.0
-            total_is_greedy = True
-            # Sliding window
-            for i in range(0, total_seq_length, FLAGS.seq_length):
-                # Last window
-                if i + FLAGS.seq_length > total_seq_length:
-                    last_output_mask = np.copy(attention_mask[:, -FLAGS.seq_length:])
-                    last_output_mask[:, :i - total_seq_length] = 0.0
-
-                    batch = dict(
-                        input_tokens=input_tokens[:, -FLAGS.seq_length:],
-                        output_tokens=output_tokens[:, -FLAGS.seq_length:],
-                        input_mask=attention_mask[:, -FLAGS.seq_length:],
-                        output_mask=last_output_mask,
-                    )
-
-                # Normal window
-                else:
-                    batch = dict(
-                        input_tokens=input_tokens[:, i:i + FLAGS.seq_length],
-                        output_tokens=output_tokens[:, i:i + FLAGS.seq_length],
-                        input_mask=attention_mask[:, i:i + FLAGS.seq_length],
-                        output_mask=attention_mask[:, i:i + FLAGS.seq_length],
-                    )
-
                 with mesh:
-                    loglikelihood, is_greedy, sharded_rng = forward_loglikelihood(
+                    _, _, sharded_rng = forward_loglikelihood(
                         params, sharded_rng, batch
                     )
-                    loglikelihood, is_greedy = jax.device_get((loglikelihood, is_greedy))
+            if not FLAGS.loglikelihood_shared_prefix or len(pre_compile_data) < 2:
+                return
+            # Batches with shared prefixes have fewer unique prefixes than
+            # rows, padded to a power of two.
+            max_prefixes = 1 << (len(pre_compile_data) - 2).bit_length()
+            num_prefixes = 1
+            while num_prefixes <= max_prefixes:
+                for prefix_length in shared_prefix_lengths:
+                    for text_length in shared_text_lengths:
+                        batch = dict(
+                            prefix_tokens=np.zeros((num_prefixes, prefix_length), dtype=np.int32),
+                            prefix_mask=np.ones((num_prefixes, prefix_length), dtype=np.int32),
+                            text_tokens=np.zeros((len(pre_compile_data), text_length), dtype=np.int32),
+                            text_mask=np.ones((len(pre_compile_data), text_length), dtype=np.int32),
+                            group_index=np.zeros((len(pre_compile_data),), dtype=np.int32),
+                        )
+                        with mesh:
+                            forward_shared_prefix_loglikelihood(params, batch)
+                num_prefixes *= 2
+
+        @staticmethod
+        def loglikelihood_rolling(text):
+            loglikelihood, is_greedy, _ = ModelServer.loglikelihood_rolling_tokens(text)
+            return loglikelihood, is_greedy
 
-                total_loglikelihood += loglikelihood
-                total_is_greedy = np.logical_and(is_greedy, total_is_greedy)
+        @staticmethod
+        def loglikelihood_rolling_tokens(text):
+            batch = make_rolling_loglikelihood_batch(text)
+            with mesh:
+                loglikelihood, is_greedy, token_loglikelihood = jax.device_get(
+                    forward_loglikelihood_rolling(params, batch)
+                )
+            output_mask = batch['output_mask'] > 0
+            token_loglikelihood = [
+                token_loglikelihood[i][output_mask[i]].tolist()
+                for i in range(len(text))
+            ]
+            return loglikelihood, is_greedy, token_loglikelihood
 
-            return total_loglikelihood, total_is_greedy
+        per_row_sampling = True
 
         @staticmethod
-        def generate(text, temperature):
+        def generate(text, temperature, max_new_tokens=None, top_k=None,
+                     top_p=None, min_p=None):
             nonlocal sharded_rng
+
+            def per_row(values, default, dtype):
+                # Missing values fall back to the defaults set by the flags
+                if not isinstance(values, (list, tuple)):
+                    values = [values for _ in text]
+                return np.array(
+                    [default if v is None else v for v in values], dtype=dtype
+                )
+
+            max_generated_tokens = FLAGS.seq_length - FLAGS.input_length
+            temperature = per_row(temperature, 1.0, np.float32)
+            if not FLAGS.do_sample:
+                temperature = np.zeros_like(temperature)
             inputs = prefix_tokenizer(
                 text,
                 padding='max_length',
@@ -297,12 +1197,38 @@ def main(argv):
             batch = dict(
                 input_tokens=input_tokens,
                 attention_mask=input_mask,
+                temperature=temperature,
+                max_new_tokens=np.clip(
+                    per_row(max_new_tokens, max_generated_tokens, np.int32),
+                    1, max_generated_tokens
+                ),
+                top_k=per_row(top_k, FLAGS.top_k, np.int32),
+                top_p=per_row(top_p, FLAGS.top_p, np.float32),
+                min_p=per_row(min_p, FLAGS.min_p, np.float32),
             )
-            with mesh:
-                output, sharded_rng = forward_generate(
-                    params, sharded_rng, batch, temperature
-                )
-                output = jax.device_get(output)
+            if speculative_decoding:
+                start_time = time.time()
+                with mesh:
+                    output, lengths, num_drafted, num_accepted, num_steps, sharded_rng = (
+                        forward_speculative_generate(
+                            params, draft_params, sharded_rng, batch
+                        )
+                    )
+                    output, lengths, num_drafted, num_accepted, num_steps = jax.device_get(
+                        (output, lengths, num_drafted, num_accepted, num_steps)
+                    )
+                speculative_stats['requests'] += 1
+                speculative_stats['generated_tokens'] += int(lengths.sum())
+                speculative_stats['drafted_tokens'] += int(num_drafted)
+                speculative_stats['accepted_tokens'] += int(num_accepted)
+                speculative_stats['target_steps'] += int(num_steps)
+                speculative_stats['generate_time'] += time.time() - start_time
+            else:
+                with mesh:
+                    output, sharded_rng = forward_generate(
+                        params, sharded_rng, batch
+                    )
+                    output = jax.device_get(output)
             output_text = []
             for text in list(tokenizer.batch_decode(output)):
                 if tokenizer.eos_token in text:
@@ -313,72 +1239,225 @@ def main(argv):
 
         @staticmethod
         def greedy_until(prefix_text, until, max_length):
-            nonlocal sharded_rng
-            all_outputs = []
-            for pf, ut in zip(prefix_text, until):
-                if isinstance(ut, str):
-                    ut = [ut]
-                total_length = 0
-                total_generated = ''
-
-                while total_length < max_length:
-                    pf_tokens = tokenizer(
-                        pf,
-                        padding=False,
-                        truncation=False,
-                        max_length=np.iinfo(np.int32).max,
-                        return_tensors='np',
+            until = [[u] if isinstance(u, str) else list(u) for u in until]
+            patterns = [stop_token_patterns(u) for u in until]
+            # Pad the number and length of the patterns to powers of two to
+            # bound the number of compilations. Only the last tokens of long
+            # patterns are matched, and every stop is verified on the text.
+            num_patterns = 1 << max(max(len(p) for p in patterns) - 1, 0).bit_length()
+            pattern_length = min(
+                1 << max(max([len(x) for p in patterns for x in p], default=1) - 1, 0).bit_length(),
+                32
+            )
+            stop_tokens = np.full(
+                (len(prefix_text), num_patterns, pattern_length), -1, dtype=np.int32
+            )
+            for i, row_patterns in enumerate(patterns):
+                for j, pattern in enumerate(row_patterns):
+                    pattern = pattern[-pattern_length:]
+                    stop_tokens[i, j, pattern_length - len(pattern):] = pattern
+
+            generated = ['' for _ in prefix_text]
+            num_generated = [0 for _ in prefix_text]
+            active = list(range(len(prefix_text)))
+            # Keep the batch shape fixed at the server batch size by repeating
+            # an active row, which stops together with the repeated row.
+            batch_size = max(len(prefix_text), FLAGS.lm_server.batch_size)
+            while len(active) > 0:
+                rows = active + [active[0]] * (batch_size - len(active))
+                inputs = prefix_tokenizer(
+                    [prefix_text[i] + generated[i] for i in rows],
+                    padding='max_length',
+                    truncation=True,
+                    max_length=FLAGS.input_length,
+                    return_tensors='np',
+                )
+                input_tokens = inputs.input_ids
+                input_mask = inputs.attention_mask
+                if FLAGS.add_bos_token:
+                    input_tokens[:, 0] = tokenizer.bos_token_id
+                    input_mask[:, 0] = 1
+                batch = dict(
+                    input_tokens=input_tokens,
+                    attention_mask=input_mask,
+                    stop_tokens=stop_tokens[rows],
+                )
+                with mesh:
+                    output, lengths, eos = jax.device_get(
+                        forward_greedy_until(params, batch)
                     )
-                    input_tokens = pf_tokens.input_ids
-                    attention_mask = pf_tokens.attention_mask
 
-                    if input_tokens.shape[1] < FLAGS.input_length:
-                        extra = FLAGS.input_length - input_tokens.shape[1]
-                        pad_tokens = np.full(
-                            (1, extra), tokenizer.pad_token_id, dtype=np.int32
-                        )
-                        input_tokens = np.concatenate(
-                            [pad_tokens, input_tokens], axis=1
-                        )
-                        pad_attention = np.zeros((1, extra), dtype=attention_mask.dtype)
-                        attention_mask = np.concatenate(
-                            [pad_attention, attention_mask], axis=1
-                        )
-                    elif input_tokens.shape[1] > FLAGS.input_length:
-                        input_tokens = input_tokens[:, -FLAGS.input_length:]
-                        attention_mask = attention_mask[:, -FLAGS.input_length:]
+                still_active = []
+                for j, i in enumerate(active):
+                    generated[i] += tokenizer.decode(output[j, :lengths[j]])
+                    num_generated[i] += int(lengths[j])
+                    stop_positions = [
+                        generated[i].find(s) for s in until[i] if s in generated[i]
+                    ]
+                    if len(stop_positions) > 0:
+                        generated[i] = generated[i][:min(stop_positions)]
+                    elif not eos[j] and num_generated[i] < max_length:
+                        still_active.append(i)
+                active = still_active
 
-                    if FLAGS.add_bos_token:
-                        input_tokens[:, 0] = tokenizer.bos_token_id
-                        attention_mask[:, 0] = 1
+            return generated
 
-                    batch = dict(input_tokens=input_tokens, attention_mask=attention_mask)
+        def model_stats(self):
+            if not speculative_decoding:
+                return {}
+            stats = dict(speculative_stats)
+            stats['acceptance_rate'] = (
+                stats['accepted_tokens'] / max(stats['drafted_tokens'], 1)
+            )
+            stats['tokens_per_target_step'] = (
+                stats['generated_tokens'] / max(stats['target_steps'], 1)
+            )
+            stats['tokens_per_second'] = (
+                stats['generated_tokens'] / max(stats['generate_time'], 1e-6)
+            )
+            return {'speculative_decoding': stats}
 
-                    with mesh:
-                        output, sharded_rng = forward_greedy_generate(
-                            params, sharded_rng, batch
-                        )
-                        output = jax.device_get(output)
 
-                    total_length += output.shape[1]
-                    output_text = tokenizer.batch_decode(output)[0]
-                    total_generated = total_generated + output_text
-                    pf = pf + output_text
+    if FLAGS.decode_engine.enable:
+        def encode_prompt(text):
+            inputs = prefix_tokenizer(
+                text,
+                padding='max_length',
+                truncation=True,
+                max_length=FLAGS.input_length,
+                return_tensors='np',
+            )
+            input_tokens = inputs.input_ids
+            input_mask = inputs.attention_mask
+            if FLAGS.add_bos_token:
+                input_tokens[:, 0] = tokenizer.bos_token_id
+                input_mask[:, 0] = 1
+            return (
+                dict(input_tokens=input_tokens, attention_mask=input_mask),
+                FLAGS.input_length,
+            )
+
+        def encode_right_padded_prompt(text):
+            input_tokens = prefix_tokenizer(text, add_special_tokens=False).input_ids
+            if FLAGS.add_bos_token:
+                input_tokens = [tokenizer.bos_token_id] + input_tokens
+            input_tokens = input_tokens[-FLAGS.input_length:]
+            length = len(input_tokens)
+            padded_tokens = np.full((1, FLAGS.input_length), tokenizer.pad_token_id, dtype=np.int32)
+            padded_tokens[0, :length] = input_tokens
+            return dict(input_tokens=padded_tokens, length=np.int32(length)), length
+
+        def init_decode_state():
+            with mesh:
+                return decode_init()
+
+        if FLAGS.prefix_cache.enable:
+            prefix_cache = PrefixCache(FLAGS.prefix_cache)
+
+        def insert_cached_prefix_sequence(state, slot, batch, sampling):
+            nonlocal sharded_rng
+            length = int(batch['length'])
+            tokens = batch['input_tokens'][0, :length]
+            cached_blocks = prefix_cache.lookup(tokens)
+            for i, block in enumerate(cached_blocks):
+                state = write_prefix_block(
+                    state, np.int32(slot), block, np.int32(i * prefix_block_size)
+                )
+            start = len(cached_blocks) * prefix_block_size
+            state, token, sharded_rng = decode_insert_suffix(
+                params, sharded_rng, state, np.int32(slot),
+                dict(
+                    input_tokens=batch['input_tokens'][:, start:],
+                    start=np.int32(start),
+                    length=np.int32(length),
+                ),
+                sampling,
+            )
+            block_hashes = prefix_cache.block_hashes(tokens)
+            for i in range(len(cached_blocks), len(block_hashes)):
+                prefix_cache.insert(
+                    block_hashes[i],
+                    read_prefix_block(state, np.int32(slot), np.int32(i * prefix_block_size)),
+                    prefix_block_bytes,
+                )
+            return state, token
 
-                    done = False
-                    for s in ut:
-                        if s in total_generated:
-                            total_generated = total_generated.split(s, maxsplit=1)[0]
-                            done = True
-                    if done:
-                        break
+        def insert_sequence(state, slot, batch, temperature, sampling, blocks):
+            nonlocal sharded_rng
 
-                all_outputs.append(total_generated)
+            def filter_value(key, default, dtype):
+                # Missing filters fall back to the defaults set by the flags
+                value = None if sampling is None else sampling.get(key)
+                return dtype(default if value is None else value)
 
-            return all_outputs
+            slot_sampling = dict(
+                temperature=np.float32(temperature),
+                top_k=filter_value('top_k', FLAGS.top_k, np.int32),
+                top_p=filter_value('top_p', FLAGS.top_p, np.float32),
+                min_p=filter_value('min_p', FLAGS.min_p, np.float32),
+            )
+            with mesh:
+                if FLAGS.prefix_cache.enable:
+                    state, token = insert_cached_prefix_sequence(
+                        state, slot, batch, slot_sampling
+                    )
+                elif paged_cache:
+                    block_table = np.zeros(
+                        (max_cache_length // block_size,), dtype=np.int32
+                    )
+                    block_table[:len(blocks)] = blocks
+                    state, token, sharded_rng = decode_insert_paged(
+                        params, sharded_rng, state, np.int32(slot), batch,
+                        slot_sampling, block_table
+                    )
+                else:
+                    state, token, sharded_rng = decode_insert(
+                        params, sharded_rng, state, np.int32(slot), batch,
+                        slot_sampling
+                    )
+                return state, jax.device_get(token)
 
+        def release_slot(state, slot):
+            with mesh:
+                return decode_release_paged(state, np.int32(slot))
+
+        def step_sequences(state):
+            nonlocal sharded_rng
+            with mesh:
+                state, tokens, sharded_rng = decode_step(params, sharded_rng, state)
+                return state, jax.device_get(tokens)
+
+        decode_engine = DecodeEngine(
+            FLAGS.decode_engine,
+            init_fn=init_decode_state,
+            encode_fn=(
+                encode_right_padded_prompt
+                if paged_cache or FLAGS.prefix_cache.enable
+                else encode_prompt
+            ),
+            insert_fn=insert_sequence,
+            step_fn=step_sequences,
+            decode_fn=lambda tokens: tokenizer.decode(tokens),
+            eos_token_id=tokenizer.eos_token_id,
+            release_fn=release_slot if paged_cache else None,
+        )
+        decode_engine.config.max_new_tokens = min(
+            decode_engine.config.max_new_tokens, FLAGS.seq_length - FLAGS.input_length
+        )
+    else:
+        decode_engine = None
 
-    server = ModelServer(FLAGS.lm_server)
+    if FLAGS.lm_server.response_cache.checkpoint_id == '':
+        # Cached responses are only valid for the same model, tokenization,
+        # truncation and rolling loglikelihood windows
+        FLAGS.lm_server.response_cache.checkpoint_id = ':'.join([
+            FLAGS.load_checkpoint, FLAGS.dtype, FLAGS.weight_quantization,
+            str(FLAGS.input_length), str(FLAGS.seq_length),
+            str(FLAGS.loglikelihood_rolling_context), str(FLAGS.add_bos_token),
+            FLAGS.tokenizer.vocab_file, str(FLAGS.tokenizer.add_bos_token),
+            str(FLAGS.tokenizer.add_eos_token),
+        ])
+    server = ModelServer(FLAGS.lm_server, decode_engine=decode_engine)
     server.run()
 
 
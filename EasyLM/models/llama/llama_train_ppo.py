@@ -16,6 +16,7 @@ import wandb
 from ...data import DatasetFactory
 from EasyLM.checkpoint import StreamingCheckpointer
 from EasyLM.optimizers import OptimizerFactory
+from EasyLM.sampling import sample_generate
 from EasyLM.jax_utils import (
     JaxRNG, JaxDistributedConfig, next_rng, match_partition_rules,
     global_norm, get_float_dtype_by_name, set_random_seed,
@@ -25,7 +26,6 @@ from EasyLM.jax_utils import (
 from EasyLM.models.llama.llama_model import (
     LLaMAConfig, FlaxLLaMAForCausalLM, FlaxLLaMAForSequenceClassification, FlaxLLaMAForTokenRegression
 )
-from transformers import GenerationConfig
 
 try:
     from jax_smi import initialise_tracking
@@ -71,6 +71,8 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
     reward_bias=0.0,
     # relatively static flags
     temperature=0.7,
+    top_k=50,
+    top_p=1.0,
     whiten_rewards=False,
     gamma=1.0,
     lam=0.95,
@@ -193,31 +195,19 @@ def ppo_step(
     # rollout from current policy
     t = time.time()
     pad_token_id = 0
-    bos_token_id = 1
     eos_token_id = 2
-    generation_config = GenerationConfig(
-        do_sample=True,
+    # The continuations keep their EOS token and are padded after it
+    cont_input_ids, _ = sample_generate(
+        policy_model, policy_train_state.params, rng_generator(),
+        prompt_input_ids, prompt_attn_mask,
+        max_new_tokens=FLAGS.max_continuation_len,
         temperature=FLAGS.temperature,
-        pad_token_id=pad_token_id,
-        bos_token_id=bos_token_id,
+        top_k=FLAGS.top_k,
+        top_p=FLAGS.top_p,
         eos_token_id=eos_token_id,
-        max_new_tokens=FLAGS.max_continuation_len,
-        # forced_eos_token_id=eos_token_id,
-    )
-    outputs = policy_model.generate(
-        input_ids=prompt_input_ids,
-        attention_mask=prompt_attn_mask,
-        generation_config=generation_config,
-        params=policy_train_state.params['params'],
-        prng_key=rng_generator(),
-    )
-    input_ids = outputs.sequences # (B, L)
-
-    # NOTE: This is a hack because generate() weirdly forces the last token to be 0 instead of 2
-    last_token_index = jnp.argmax(jnp.cumsum(jnp.where(input_ids == pad_token_id, 0, 1), axis=1), axis=1) # (B)
-    input_ids = jnp.concatenate([input_ids, input_ids[:, -1:]], axis=1) # (B, L+1)
-    input_ids = input_ids.at[jnp.arange(input_ids.shape[0]), last_token_index + 1].set(eos_token_id)
-    input_ids = input_ids[:, :-1] # (B, L)
+        pad_token_id=pad_token_id,
+    ) # (B, CL)
+    input_ids = jnp.concatenate([prompt_input_ids, cont_input_ids], axis=1) # (B, L)
 
     attn_mask = jnp.where(input_ids == pad_token_id, 0, 1) # (B, L)
     position_ids = jnp.clip(jnp.cumsum(attn_mask, axis=1) - 1, 0, None) # (B, L)
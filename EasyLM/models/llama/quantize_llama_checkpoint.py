@@ -0,0 +1,81 @@
+# This script quantizes the dense kernels of a LLaMA checkpoint trained by
+# EasyLM for weight-only int8 or int4 inference. The checkpoint is streamed
+# tensor by tensor, and the attention, MLP and lm_head kernels are replaced by
+# their quantized values and scales, while the other params are saved with
+# float_dtype. The output is a streaming params checkpoint, which is served by
+# llama_serve with the same weight quantization, e.g.:
+#    python -m EasyLM.models.llama.quantize_llama_checkpoint \
+#        --load_llama_config='7b' \
+#        --load_checkpoint='params::/path/to/streaming_params' \
+#        --output_file='/path/to/streaming_params_int8' \
+#        --weight_quantization='int8'
+#    python -m EasyLM.models.llama.llama_serve \
+#        --load_llama_config='7b' \
+#        --load_checkpoint='params::/path/to/streaming_params_int8' \
+#        --weight_quantization='int8'
+
+import time
+
+import numpy as np
+import msgpack
+import mlxu
+
+from EasyLM.checkpoint import StreamingCheckpointer, encode_tensor
+from EasyLM.models.llama.llama_model import (
+    LLaMAConfig, is_quantized_kernel, quantize_kernel
+)
+
+
+FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
+    load_llama_config='',
+    load_checkpoint='',
+    output_file='',
+    weight_quantization='int8',
+    weight_quantization_group_size=128,
+    float_dtype='bf16',
+)
+
+
+def main(argv):
+    assert FLAGS.load_checkpoint != '' and FLAGS.output_file != '', 'input and output must be specified'
+    assert FLAGS.weight_quantization in ('int8', 'int4'), (
+        f'Unsupported weight quantization: {FLAGS.weight_quantization}'
+    )
+    llama_config = LLaMAConfig.load_config(FLAGS.load_llama_config)
+    llama_config.update(dict(
+        weight_quantization=FLAGS.weight_quantization,
+        weight_quantization_group_size=FLAGS.weight_quantization_group_size,
+    ))
+
+    start_time = time.time()
+    original_bytes, quantized_bytes = 0, 0
+    packer = msgpack.Packer()
+    with mlxu.open_file(FLAGS.output_file, 'wb') as fout:
+        for key, value in StreamingCheckpointer.iterate_params_checkpoint(FLAGS.load_checkpoint):
+            value = np.asarray(value)
+            original_bytes += value.nbytes
+            if is_quantized_kernel(key, llama_config):
+                quantized = quantize_kernel(
+                    value, FLAGS.weight_quantization,
+                    FLAGS.weight_quantization_group_size,
+                )
+                # The scales are kept in float32
+                records = [(key[:-1] + (name,), tensor, None) for name, tensor in quantized.items()]
+            else:
+                records = [(key, value, FLAGS.float_dtype)]
+            for record_key, tensor, float_dtype in records:
+                tensor, encoding = encode_tensor(tensor, float_dtype)
+                quantized_bytes += len(tensor)
+                fout.write(StreamingCheckpointer._pack_record(
+                    packer, record_key, tensor, encoding
+                ))
+
+    print(
+        f'Quantized {FLAGS.load_checkpoint} to {FLAGS.weight_quantization} in '
+        f'{time.time() - start_time:.1f}s: {original_bytes / 2 ** 30:.2f} GiB -> '
+        f'{quantized_bytes / 2 ** 30:.2f} GiB'
+    )
+
+
+if __name__ == '__main__':
+    mlxu.run(main)
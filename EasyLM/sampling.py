@@ -0,0 +1,181 @@
+""" Native JAX sampling loop for autoregressive generation, which replaces
+    the Huggingface FlaxGenerationMixin.generate. The loop runs over the KV
+    cache of a Huggingface style causal language model module, whose inputs
+    are the input tokens, attention mask and position ids, and stops early once
+    every row has generated the EOS token or reached its maximum number of new
+    tokens.
+"""
+
+import jax
+import jax.numpy as jnp
+from jax import lax
+from flax.core.frozen_dict import unfreeze
+
+
+def filter_logits(logits, top_k=0, top_p=1.0, min_p=0.0):
+    """ Apply the top_k, top_p (nucleus) and min_p filters to logits of shape
+        (batch, ..., vocab_size), by setting the logits of the filtered tokens
+        to -inf. The filters can be scalars or arrays of shape (batch,) holding
+        the filters of each row, and are disabled by their default values.
+    """
+    batch_size, vocab_size = logits.shape[0], logits.shape[-1]
+    row_shape = (batch_size,) + (1,) * (logits.ndim - 1)
+    top_k = jnp.broadcast_to(jnp.asarray(top_k, dtype=jnp.int32), (batch_size,))
+    top_p = jnp.broadcast_to(jnp.asarray(top_p, dtype=jnp.float32), (batch_size,))
+    min_p = jnp.broadcast_to(jnp.asarray(min_p, dtype=jnp.float32), (batch_size,))
+
+    def apply_filters(logits):
+        row_top_k = jnp.reshape(top_k, row_shape)
+        row_top_p = jnp.reshape(top_p, row_shape)
+        sorted_logits = -jnp.sort(-logits, axis=-1)
+        ranks = jnp.arange(vocab_size)
+        sorted_logits = jnp.where(
+            (row_top_k > 0) & (ranks >= row_top_k), -jnp.inf, sorted_logits
+        )
+        # Keep the smallest set of tokens whose probability exceeds top_p
+        sorted_probs = jax.nn.softmax(sorted_logits, axis=-1)
+        mass_before = jnp.cumsum(sorted_probs, axis=-1) - sorted_probs
+        kept = (mass_before < row_top_p) | (row_top_p >= 1.0)
+        num_kept = jnp.maximum(
+            jnp.sum(kept & (sorted_logits > -jnp.inf), axis=-1, keepdims=True), 1
+        )
+        threshold = jnp.take_along_axis(sorted_logits, num_kept - 1, axis=-1)
+        logits = jnp.where(logits < threshold, -jnp.inf, logits)
+        # Keep the tokens whose probability is at least min_p times the
+        # probability of the most likely token.
+        max_logits = jnp.max(logits, axis=-1, keepdims=True)
+        return jnp.where(
+            logits < max_logits + jnp.log(jnp.reshape(min_p, row_shape)),
+            -jnp.inf, logits
+        )
+
+    # Skip the sort over the vocabulary when no row is filtered
+    return lax.cond(
+        jnp.any((top_k > 0) & (top_k < vocab_size))
+        | jnp.any(top_p < 1.0) | jnp.any(min_p > 0.0),
+        apply_filters, lambda logits: logits, logits
+    )
+
+
+def sample_logits(logits, rng, temperature, top_k=0, top_p=1.0, min_p=0.0):
+    """ Sample the next tokens from logits of shape (batch, vocab_size). The
+        temperature, top_k, top_p and min_p can be scalars or arrays of shape
+        (batch,) holding the sampling parameters of each row, so that rows with
+        different parameters share the same compiled function. Rows with zero
+        temperature are decoded greedily. The top_k, top_p (nucleus) and min_p
+        filters are applied to the temperature scaled logits with filter_logits.
+    """
+    batch_size = logits.shape[0]
+    logits = logits.astype(jnp.float32)
+    temperature = jnp.broadcast_to(jnp.asarray(temperature, dtype=jnp.float32), (batch_size,))
+    greedy_tokens = jnp.argmax(logits, axis=-1)
+    logits = filter_logits(
+        logits / jnp.maximum(temperature, 1e-8)[:, None], top_k, top_p, min_p
+    )
+    sampled_tokens = jax.random.categorical(rng, logits, axis=-1)
+    return jnp.where(temperature > 0, sampled_tokens, greedy_tokens).astype(jnp.int32)
+
+
+def sample_generate(model, params, rng, input_tokens, attention_mask,
+                    max_new_tokens, temperature, row_max_new_tokens=None,
+                    top_k=0, top_p=1.0, min_p=0.0, eos_token_id=2,
+                    pad_token_id=0):
+    """ Generate up to max_new_tokens tokens for a left padded batch of
+        prompts with a lax.while_loop over the KV cache.
+
+        Args:
+            model: a Huggingface style Flax model, such as FlaxLLaMAForCausalLM,
+                providing the module and init_cache.
+            params: the model parameters, including the 'params' collection.
+            rng: the random key for sampling.
+            input_tokens: the left padded prompt tokens of shape (batch, length).
+            attention_mask: the attention mask of the prompt tokens.
+            max_new_tokens: the static maximum number of generated tokens.
+            temperature: the sampling temperature, a scalar or an array of
+                shape (batch,), where rows with zero temperature are decoded
+                greedily.
+            row_max_new_tokens: the maximum number of generated tokens of each
+                row of shape (batch,), at most max_new_tokens.
+            top_k, top_p, min_p: the sampling filters, scalars or arrays of
+                shape (batch,), see sample_logits.
+            eos_token_id: the token that ends the generation of a row.
+            pad_token_id: the token filling the output after the generation of
+                each row has ended.
+
+        Returns:
+            The generated tokens of shape (batch, max_new_tokens) including the
+            EOS token and padded with pad_token_id, and the number of generated
+            tokens of each row.
+    """
+    batch_size, input_length = input_tokens.shape
+    if row_max_new_tokens is None:
+        row_max_new_tokens = jnp.full((batch_size,), max_new_tokens, dtype=jnp.int32)
+    row_max_new_tokens = jnp.clip(row_max_new_tokens, 1, max_new_tokens)
+    temperature = jnp.broadcast_to(jnp.asarray(temperature, dtype=jnp.float32), (batch_size,))
+
+    attention_mask = jnp.concatenate(
+        [
+            attention_mask,
+            jnp.ones((batch_size, max_new_tokens), dtype=attention_mask.dtype),
+        ],
+        axis=1
+    )
+    position_ids = jnp.clip(jnp.cumsum(attention_mask[:, :input_length], axis=-1) - 1, a_min=0)
+    outputs, variables = model.module.apply(
+        {
+            'params': params['params'],
+            'cache': model.init_cache(batch_size, input_length + max_new_tokens),
+        },
+        input_tokens, attention_mask, position_ids,
+        mutable=['cache'],
+    )
+
+    def update(state, logits):
+        rng, sample_rng = jax.random.split(state['rng'])
+        tokens = sample_logits(
+            logits, sample_rng, temperature, top_k=top_k, top_p=top_p, min_p=min_p
+        )
+        tokens = jnp.where(state['done'], pad_token_id, tokens)
+        lengths = jnp.where(state['done'], state['lengths'], state['lengths'] + 1)
+        return dict(
+            state,
+            step=state['step'] + 1,
+            tokens=tokens,
+            output=state['output'].at[:, state['step']].set(tokens),
+            lengths=lengths,
+            done=state['done'] | (tokens == eos_token_id) | (lengths >= row_max_new_tokens),
+            rng=rng,
+        )
+
+    state = update(
+        dict(
+            step=jnp.array(0, dtype=jnp.int32),
+            tokens=jnp.zeros((batch_size,), dtype=jnp.int32),
+            output=jnp.full((batch_size, max_new_tokens), pad_token_id, dtype=jnp.int32),
+            lengths=jnp.zeros((batch_size,), dtype=jnp.int32),
+            done=jnp.zeros((batch_size,), dtype=jnp.bool_),
+            cache=unfreeze(variables['cache']),
+            positions=position_ids[:, -1] + 1,
+            rng=rng,
+        ),
+        outputs.logits[:, -1, :],
+    )
+
+    def cond_fn(state):
+        return (state['step'] < max_new_tokens) & ~jnp.all(state['done'])
+
+    def body_fn(state):
+        outputs, variables = model.module.apply(
+            {'params': params['params'], 'cache': state['cache']},
+            state['tokens'][:, None], attention_mask, state['positions'][:, None],
+            mutable=['cache'],
+        )
+        state = dict(
+            state,
+            cache=unfreeze(variables['cache']),
+            positions=state['positions'] + 1,
+        )
+        return update(state, outputs.logits[:, -1, :])
+
+    state = lax.while_loop(cond_fn, body_fn, state)
+    return state['output'], state['lengths']
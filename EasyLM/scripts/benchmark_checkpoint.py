@@ -0,0 +1,108 @@
+# This script benchmarks the size, save time, load time and reconstruction
+# error of the streaming checkpoint encodings (float dtype, zstd compression
+# and blockwise int8/fp8 quantization) on a randomly initialized LLaMA-shaped
+# parameter tree.
+
+import os
+import tempfile
+from time import time
+
+import numpy as np
+import mlxu
+from flax.traverse_util import flatten_dict
+
+from EasyLM.checkpoint import StreamingCheckpointer
+
+
+FLAGS, _ = mlxu.define_flags_with_default(
+    seed=42,
+    vocab_size=32000,
+    hidden_size=2048,
+    intermediate_size=5504,
+    num_hidden_layers=4,
+    float_dtype='bf16',
+    encodings='none,zstd,int8,int8+zstd,fp8,fp8+zstd',
+    quantization_block_size=256,
+    compression_level=3,
+    output_dir='',
+)
+
+
+def random_params(rng):
+    def normal(*shape):
+        return (rng.standard_normal(shape) * 0.02).astype(np.float32)
+
+    blocks = {}
+    for i in range(FLAGS.num_hidden_layers):
+        blocks[str(i)] = {
+            'attention': {
+                'wq': {'kernel': normal(FLAGS.hidden_size, FLAGS.hidden_size)},
+                'wk': {'kernel': normal(FLAGS.hidden_size, FLAGS.hidden_size)},
+                'wv': {'kernel': normal(FLAGS.hidden_size, FLAGS.hidden_size)},
+                'wo': {'kernel': normal(FLAGS.hidden_size, FLAGS.hidden_size)},
+            },
+            'feed_forward': {
+                'w1': {'kernel': normal(FLAGS.hidden_size, FLAGS.intermediate_size)},
+                'w2': {'kernel': normal(FLAGS.intermediate_size, FLAGS.hidden_size)},
+                'w3': {'kernel': normal(FLAGS.hidden_size, FLAGS.intermediate_size)},
+            },
+            'attention_norm': {'kernel': np.ones(FLAGS.hidden_size, np.float32)},
+            'ffn_norm': {'kernel': np.ones(FLAGS.hidden_size, np.float32)},
+        }
+    return {
+        'transformer': {
+            'wte': {'embedding': normal(FLAGS.vocab_size, FLAGS.hidden_size)},
+            'ln_f': {'kernel': np.ones(FLAGS.hidden_size, np.float32)},
+            'h': blocks,
+        },
+        'lm_head': {'kernel': normal(FLAGS.hidden_size, FLAGS.vocab_size)},
+    }
+
+
+def main(argv):
+    params = random_params(np.random.default_rng(FLAGS.seed))
+    flat_params = flatten_dict(params)
+    if FLAGS.output_dir == '':
+        output_dir = tempfile.mkdtemp()
+    else:
+        output_dir = FLAGS.output_dir
+
+    print(f'{"encoding":>12} {"size (MB)":>10} {"save (s)":>9} {"load (s)":>9} {"max err":>9} {"mean err":>9}')
+    for name in FLAGS.encodings.split(','):
+        stages = [] if name == 'none' else name.split('+')
+        quantization = ''.join(s for s in stages if s in ('int8', 'fp8'))
+        compression = 'zstd' if 'zstd' in stages else ''
+        path = os.path.join(output_dir, f'streaming_params_{name}')
+
+        start_time = time()
+        StreamingCheckpointer.save_train_state_to_file(
+            params, path, float_dtype=FLAGS.float_dtype,
+            compression=compression,
+            compression_level=FLAGS.compression_level,
+            quantization=quantization,
+            quantization_block_size=FLAGS.quantization_block_size,
+        )
+        save_time = time() - start_time
+
+        start_time = time()
+        restored = flatten_dict(StreamingCheckpointer.load_checkpoint(path))
+        load_time = time() - start_time
+
+        max_error, total_error, total_size = 0.0, 0.0, 0
+        for key, value in flat_params.items():
+            error = np.abs(np.asarray(restored[key], np.float32) - value)
+            max_error = max(max_error, float(error.max()))
+            total_error += float(error.sum())
+            total_size += value.size
+
+        size = os.path.getsize(path) / 2 ** 20
+        print(
+            f'{name:>12} {size:>10.1f} {save_time:>9.2f} {load_time:>9.2f} '
+            f'{max_error:>9.2e} {total_error / total_size:>9.2e}'
+        )
+        if FLAGS.output_dir == '':
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    mlxu.run(main)
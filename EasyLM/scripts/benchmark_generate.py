@@ -0,0 +1,137 @@
+# This script benchmarks the native JAX sampling loop of EasyLM against the
+# Huggingface FlaxGenerationMixin.generate on a randomly initialized LLaMA
+# model, for greedy decoding and sampling. It reports the generation time and
+# throughput of both implementations, and checks that their greedy outputs
+# agree. It runs on CPU with the default debug model, e.g.:
+#    JAX_PLATFORMS=cpu python -m EasyLM.scripts.benchmark_generate
+
+from functools import partial
+from time import time
+
+import numpy as np
+import mlxu
+import jax
+from transformers import GenerationConfig, FlaxLogitsProcessorList
+
+from EasyLM.jax_utils import (
+    JaxRNG, FlaxTemperatureLogitsWarper, get_float_dtype_by_name
+)
+from EasyLM.models.llama.llama_model import LLaMAConfig, FlaxLLaMAForCausalLM
+from EasyLM.sampling import sample_generate
+
+
+FLAGS, _ = mlxu.define_flags_with_default(
+    seed=42,
+    llama_config='debug',
+    dtype='fp32',
+    batch_size=8,
+    input_length=64,
+    max_new_tokens=128,
+    temperature=1.0,
+    top_k=50,
+    eos_token_id=2,
+    repeats=5,
+)
+
+
+def main(argv):
+    llama_config = LLaMAConfig.load_config(FLAGS.llama_config)
+    hf_model = FlaxLLaMAForCausalLM(
+        llama_config,
+        input_shape=(1, FLAGS.input_length + FLAGS.max_new_tokens),
+        seed=FLAGS.seed,
+        dtype=get_float_dtype_by_name(FLAGS.dtype),
+    )
+    params = {'params': hf_model.params}
+
+    rng = np.random.default_rng(FLAGS.seed)
+    input_tokens = rng.integers(
+        3, llama_config.vocab_size, (FLAGS.batch_size, FLAGS.input_length)
+    ).astype(np.int32)
+    attention_mask = np.ones_like(input_tokens)
+    # Left pad the prompts to different lengths
+    for i in range(FLAGS.batch_size):
+        padding = rng.integers(0, FLAGS.input_length // 2)
+        input_tokens[i, :padding] = 0
+        attention_mask[i, :padding] = 0
+
+    @partial(jax.jit, static_argnums=(3,))
+    def hf_generate(params, rng, temperature, do_sample):
+        return hf_model.generate(
+            input_tokens,
+            attention_mask=attention_mask,
+            params=params['params'],
+            prng_key=rng,
+            logits_processor=FlaxLogitsProcessorList(
+                [FlaxTemperatureLogitsWarper(temperature)]
+            ),
+            generation_config=GenerationConfig(
+                max_new_tokens=FLAGS.max_new_tokens,
+                pad_token_id=FLAGS.eos_token_id,
+                eos_token_id=FLAGS.eos_token_id,
+                do_sample=do_sample,
+                num_beams=1,
+                top_k=FLAGS.top_k,
+            )
+        ).sequences[:, FLAGS.input_length:]
+
+    @partial(jax.jit, static_argnums=(3,))
+    def native_generate(params, rng, temperature, do_sample):
+        return sample_generate(
+            hf_model, params, rng, input_tokens, attention_mask,
+            max_new_tokens=FLAGS.max_new_tokens,
+            temperature=temperature if do_sample else 0.0,
+            top_k=FLAGS.top_k,
+            eos_token_id=FLAGS.eos_token_id,
+            pad_token_id=FLAGS.eos_token_id,
+        )[0]
+
+    def benchmark(generate_fn, do_sample):
+        rng_generator = JaxRNG.from_seed(FLAGS.seed)
+        start_time = time()
+        output = jax.device_get(
+            generate_fn(params, rng_generator(), FLAGS.temperature, do_sample)
+        )
+        compile_time = time() - start_time
+        start_time = time()
+        for _ in range(FLAGS.repeats):
+            output = jax.device_get(
+                generate_fn(params, rng_generator(), FLAGS.temperature, do_sample)
+            )
+        run_time = (time() - start_time) / FLAGS.repeats
+        return output, compile_time, run_time
+
+    def generated_lengths(output):
+        is_eos = output == FLAGS.eos_token_id
+        return np.where(
+            is_eos.any(axis=1), is_eos.argmax(axis=1) + 1, output.shape[1]
+        )
+
+    print(
+        f'{"decoding":>9} {"implementation":>15} {"compile (s)":>12} '
+        f'{"time (s)":>9} {"tokens/s":>10} {"mean length":>12}'
+    )
+    outputs = {}
+    for do_sample in (False, True):
+        decoding = 'sample' if do_sample else 'greedy'
+        for name, generate_fn in (('huggingface', hf_generate), ('native', native_generate)):
+            output, compile_time, run_time = benchmark(generate_fn, do_sample)
+            lengths = generated_lengths(output)
+            outputs[(decoding, name)] = (output, lengths)
+            print(
+                f'{decoding:>9} {name:>15} {compile_time:>12.2f} {run_time:>9.3f} '
+                f'{lengths.sum() / run_time:>10.1f} {lengths.mean():>12.1f}'
+            )
+
+    hf_output, hf_lengths = outputs[('greedy', 'huggingface')]
+    native_output, native_lengths = outputs[('greedy', 'native')]
+    matches = [
+        hf_lengths[i] == native_lengths[i]
+        and np.array_equal(hf_output[i, :hf_lengths[i]], native_output[i, :native_lengths[i]])
+        for i in range(FLAGS.batch_size)
+    ]
+    print(f'\nGreedy outputs matching between implementations: {sum(matches)}/{FLAGS.batch_size}')
+
+
+if __name__ == '__main__':
+    mlxu.run(main)
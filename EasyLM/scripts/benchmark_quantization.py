@@ -0,0 +1,150 @@
+# This script compares the weight-only int8 and int4 quantized inference of
+# LLaMA against the float model. The float params are quantized in memory, and
+# the script reports the param memory, the error of the log probabilities, the
+# difference of the token log likelihoods, the agreement of the next token
+# predictions and of greedy generations with the float model, and the
+# generation throughput with the native sampling loop. It runs on CPU with a
+# randomly initialized debug model, or with an EasyLM checkpoint, e.g.:
+#    JAX_PLATFORMS=cpu python -m EasyLM.scripts.benchmark_quantization
+#    JAX_PLATFORMS=cpu python -m EasyLM.scripts.benchmark_quantization \
+#        --llama_config='7b' --load_checkpoint='params::/path/to/streaming_params'
+
+from time import time
+
+import numpy as np
+import mlxu
+import jax
+import jax.numpy as jnp
+from flax.traverse_util import flatten_dict
+
+from EasyLM.checkpoint import StreamingCheckpointer
+from EasyLM.jax_utils import JaxRNG, get_float_dtype_by_name
+from EasyLM.models.llama.llama_model import (
+    LLaMAConfig, FlaxLLaMAForCausalLM, quantize_llama_params
+)
+from EasyLM.sampling import sample_generate
+
+
+FLAGS, _ = mlxu.define_flags_with_default(
+    seed=42,
+    llama_config='debug',
+    load_checkpoint='',
+    dtype='fp32',
+    weight_quantization_group_size=128,
+    batch_size=8,
+    input_length=64,
+    max_new_tokens=64,
+    eos_token_id=2,
+    repeats=5,
+)
+
+
+def params_bytes(params):
+    return sum(np.asarray(x).nbytes for x in flatten_dict(params).values())
+
+
+def main(argv):
+    dtype = get_float_dtype_by_name(FLAGS.dtype)
+    seq_length = FLAGS.input_length + FLAGS.max_new_tokens
+    llama_config = LLaMAConfig.load_config(FLAGS.llama_config)
+    if FLAGS.load_checkpoint != '':
+        _, params = StreamingCheckpointer.load_trainstate_checkpoint(
+            FLAGS.load_checkpoint, disallow_trainstate=True
+        )
+        params = jax.device_get(params['params'])
+    else:
+        params = jax.device_get(FlaxLLaMAForCausalLM(
+            llama_config, input_shape=(1, seq_length), seed=FLAGS.seed, dtype=dtype,
+        ).params)
+    params = jax.tree_util.tree_map(lambda x: np.asarray(x, dtype=np.float32), params)
+
+    rng = np.random.default_rng(FLAGS.seed)
+    input_tokens = rng.integers(
+        3, llama_config.vocab_size, (FLAGS.batch_size, FLAGS.input_length)
+    ).astype(np.int32)
+    attention_mask = np.ones_like(input_tokens)
+
+    models = {}
+    for quantization in ('', 'int8', 'int4'):
+        config = LLaMAConfig.load_config(FLAGS.llama_config)
+        config.update(dict(
+            weight_quantization=quantization,
+            weight_quantization_group_size=FLAGS.weight_quantization_group_size,
+        ))
+        model = FlaxLLaMAForCausalLM(
+            config, input_shape=(1, seq_length), seed=FLAGS.seed,
+            dtype=dtype, _do_init=False,
+        )
+        model_params = quantize_llama_params(params, config) if quantization else params
+        models[quantization or 'float'] = (model, {'params': model_params})
+
+    def make_forward_fn(model):
+        @jax.jit
+        def forward(params):
+            logits = model.module.apply(
+                params, input_tokens, attention_mask, deterministic=True,
+            ).logits.astype(jnp.float32)
+            return jax.nn.log_softmax(logits, axis=-1)
+        return forward
+
+    def make_generate_fn(model):
+        @jax.jit
+        def generate(params, rng):
+            return sample_generate(
+                model, params, rng, input_tokens, attention_mask,
+                max_new_tokens=FLAGS.max_new_tokens,
+                temperature=0.0,
+                eos_token_id=FLAGS.eos_token_id,
+                pad_token_id=FLAGS.eos_token_id,
+            )
+        return generate
+
+    def benchmark(generate_fn, params):
+        rng_generator = JaxRNG.from_seed(FLAGS.seed)
+        start_time = time()
+        output, lengths = jax.device_get(generate_fn(params, rng_generator()))
+        compile_time = time() - start_time
+        start_time = time()
+        for _ in range(FLAGS.repeats):
+            output, lengths = jax.device_get(generate_fn(params, rng_generator()))
+        run_time = (time() - start_time) / FLAGS.repeats
+        return output, lengths, compile_time, run_time
+
+    results = {}
+    for name, (model, model_params) in models.items():
+        log_probs = np.asarray(make_forward_fn(model)(model_params))
+        output, lengths, compile_time, run_time = benchmark(
+            make_generate_fn(model), model_params
+        )
+        results[name] = (log_probs, output, lengths, compile_time, run_time)
+
+    reference_log_probs, reference_output, reference_lengths = results['float'][:3]
+    # Log likelihoods of the next input tokens
+    target_tokens = input_tokens[:, 1:, None]
+    reference_token_ll = np.take_along_axis(reference_log_probs[:, :-1], target_tokens, axis=-1)
+
+    print(
+        f'{"weights":>8} {"memory (MB)":>12} {"logprob error":>14} {"ll diff":>8} '
+        f'{"top-1 agree":>12} {"greedy agree":>13} {"compile (s)":>12} '
+        f'{"time (s)":>9} {"tokens/s":>10}'
+    )
+    for name, (log_probs, output, lengths, compile_time, run_time) in results.items():
+        logprob_error = np.mean(np.abs(log_probs - reference_log_probs))
+        token_ll = np.take_along_axis(log_probs[:, :-1], target_tokens, axis=-1)
+        ll_diff = np.mean(np.abs(token_ll - reference_token_ll))
+        top1_agree = np.mean(log_probs.argmax(-1) == reference_log_probs.argmax(-1))
+        greedy_agree = np.mean([
+            lengths[i] == reference_lengths[i]
+            and np.array_equal(output[i, :lengths[i]], reference_output[i, :reference_lengths[i]])
+            for i in range(FLAGS.batch_size)
+        ])
+        print(
+            f'{name:>8} {params_bytes(models[name][1]) / 2 ** 20:>12.2f} '
+            f'{logprob_error:>14.5f} {ll_diff:>8.5f} {top1_agree:>12.3f} '
+            f'{greedy_agree:>13.3f} {compile_time:>12.2f} {run_time:>9.3f} '
+            f'{lengths.sum() / run_time:>10.1f}'
+        )
+
+
+if __name__ == '__main__':
+    mlxu.run(main)
@@ -0,0 +1,106 @@
+# This script benchmarks the JSON and msgpack protocols of the LMServer. It
+# measures the payload size and the encode and decode times of loglikelihood
+# requests and responses, and of rolling loglikelihood responses with per token
+# outputs. If query_server is set, it also measures the end to end latency of
+# the /loglikelihood endpoint of a running server with both protocols, e.g.:
+#    python -m EasyLM.scripts.lm_router --dummy_backend --dummy_latency=0
+#    python -m EasyLM.scripts.benchmark_serialization --query_server \
+#        --lm_client.url='http://localhost:5007'
+
+import json
+from time import time
+
+import numpy as np
+import msgpack
+import mlxu
+
+from EasyLM.serving import LMClient, InferenceRequest
+
+
+FLAGS, _ = mlxu.define_flags_with_default(
+    seed=42,
+    batch_size=1000,
+    text_length=512,
+    num_tokens=512,
+    repeats=10,
+    query_server=False,
+    lm_client=LMClient.get_default_config(),
+)
+
+
+def random_text(rng, length):
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz     '))
+    return ''.join(rng.choice(letters, length))
+
+
+def payloads(rng):
+    text = [random_text(rng, FLAGS.text_length) for _ in range(FLAGS.batch_size)]
+    prefix_text = [random_text(rng, FLAGS.text_length) for _ in range(FLAGS.batch_size)]
+    log_likelihood = rng.standard_normal(FLAGS.batch_size) * 10
+    return {
+        'loglikelihood request': {'prefix_text': prefix_text, 'text': text},
+        'loglikelihood response': {
+            'prefix_text': prefix_text,
+            'text': text,
+            'log_likelihood': log_likelihood.tolist(),
+            'is_greedy': (log_likelihood > 0).tolist(),
+        },
+        'token loglikelihood response': {
+            'text': text,
+            'log_likelihood': log_likelihood.tolist(),
+            'is_greedy': (log_likelihood > 0).tolist(),
+            'token_log_likelihood': (
+                rng.standard_normal((FLAGS.batch_size, FLAGS.num_tokens)).tolist()
+            ),
+        },
+    }
+
+
+def timeit(fn):
+    start_time = time()
+    for _ in range(FLAGS.repeats):
+        output = fn()
+    return (time() - start_time) / FLAGS.repeats, output
+
+
+def main(argv):
+    rng = np.random.default_rng(FLAGS.seed)
+    protocols = {
+        'json': (lambda x: json.dumps(x).encode('utf-8'), json.loads),
+        'msgpack': (msgpack.packb, msgpack.unpackb),
+    }
+
+    print(f'{"payload":>28} {"protocol":>9} {"size (MB)":>10} {"encode (ms)":>12} {"decode (ms)":>12}')
+    for name, payload in payloads(rng).items():
+        for protocol, (encode, decode) in protocols.items():
+            encode_time, encoded = timeit(lambda: encode(payload))
+            decode_time, decoded = timeit(lambda: decode(encoded))
+            if name.endswith('request'):
+                # The server also validates the decoded request
+                validate_time, _ = timeit(lambda: InferenceRequest(**decoded))
+                decode_time += validate_time
+            print(
+                f'{name:>28} {protocol:>9} {len(encoded) / 2 ** 20:>10.2f} '
+                f'{encode_time * 1000:>12.2f} {decode_time * 1000:>12.2f}'
+            )
+
+    if not FLAGS.query_server:
+        return
+
+    request = payloads(rng)['loglikelihood request']
+    print(f'\n{"protocol":>9} {"latency (ms)":>13} {"rows/s":>10}')
+    for protocol in protocols:
+        config = FLAGS.lm_client.copy_and_resolve_references()
+        config.protocol = protocol
+        config.batch_size = FLAGS.batch_size
+        client = LMClient(config)
+        # Warm up the connection and the server
+        client.loglikelihood(request['prefix_text'], request['text'])
+        latency, _ = timeit(
+            lambda: client.loglikelihood(request['prefix_text'], request['text'])
+        )
+        print(f'{protocol:>9} {latency * 1000:>13.2f} {FLAGS.batch_size / latency:>10.1f}')
+
+
+if __name__ == '__main__':
+    mlxu.run(main)
@@ -1,17 +1,16 @@
-# This script converts model checkpoint trained by EsayLM to a standard
-# mspack checkpoint that can be loaded by huggingface transformers or
-# flax.serialization.msgpack_restore. Such conversion allows models to be
-# used by other frameworks that integrate with huggingface transformers.
-
-import pprint
-from functools import partial
-import os
+# This script computes the difference between a base and a target checkpoint,
+# or recovers the target checkpoint from a base and a diff checkpoint. Both
+# checkpoints are streamed tensor by tensor in lockstep, so the host memory
+# needed is proportional to the largest tensor rather than the model size.
+
+import itertools
 import numpy as np
-import jax
 import jax.numpy as jnp
 import flax.serialization
+import msgpack
 import mlxu
-from EasyLM.checkpoint import StreamingCheckpointer
+from flax.traverse_util import unflatten_dict
+from EasyLM.checkpoint import StreamingCheckpointer, encode_tensor
 from EasyLM.jax_utils import float_to_dtype
 
 
@@ -25,33 +24,64 @@ FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
 )
 
 
-def main(argv):
-    assert FLAGS.load_base_checkpoint != '' and FLAGS.load_target_checkpoint != ''
-    assert FLAGS.output_file != ''
-    base_params = StreamingCheckpointer.load_trainstate_checkpoint(
-        FLAGS.load_base_checkpoint, disallow_trainstate=True
-    )[1]['params']
+def iterate_lockstep(base_iterator, target_iterator):
+    """ Pair up the tensors of two checkpoints by key. Both checkpoints are
+        usually saved in the same order, in which case only one tensor from
+        each is held in memory. Out of order tensors are buffered until their
+        counterpart is read.
+    """
+    base_pending, target_pending = {}, {}
+    for base_item, target_item in itertools.zip_longest(base_iterator, target_iterator):
+        if base_item is not None:
+            key, value = base_item
+            if key in target_pending:
+                yield key, value, target_pending.pop(key)
+            else:
+                base_pending[key] = value
+        if target_item is not None:
+            key, value = target_item
+            if key in base_pending:
+                yield key, base_pending.pop(key), value
+            else:
+                target_pending[key] = value
+    assert len(base_pending) == 0 and len(target_pending) == 0, (
+        'Base and target checkpoints have different keys: '
+        f'{sorted(base_pending.keys())} {sorted(target_pending.keys())}'
+    )
 
-    target_params = StreamingCheckpointer.load_trainstate_checkpoint(
-        FLAGS.load_target_checkpoint, disallow_trainstate=True
-    )[1]['params']
 
+def combine(base, target):
+    if jnp.issubdtype(base.dtype, jnp.floating):
+        # Computed in fp32 and converted to float_dtype when saving
+        base = np.asarray(base, dtype=np.float32)
+        target = np.asarray(target, dtype=np.float32)
     if FLAGS.recover_diff:
-        params = jax.tree_util.tree_map(
-            lambda b, t: b + t, base_params, target_params
-        )
-    else:
-        params = jax.tree_util.tree_map(
-            lambda b, t: t - b, base_params, target_params
-        )
+        return base + target
+    return target - base
+
+
+def main(argv):
+    assert FLAGS.load_base_checkpoint != '' and FLAGS.load_target_checkpoint != ''
+    assert FLAGS.output_file != ''
+    tensors = iterate_lockstep(
+        StreamingCheckpointer.iterate_params_checkpoint(FLAGS.load_base_checkpoint),
+        StreamingCheckpointer.iterate_params_checkpoint(FLAGS.load_target_checkpoint),
+    )
 
     if FLAGS.streaming:
-        StreamingCheckpointer.save_train_state_to_file(
-            params, FLAGS.output_file, float_dtype=FLAGS.float_dtype
-        )
+        packer = msgpack.Packer()
+        with mlxu.open_file(FLAGS.output_file, 'wb') as fout:
+            for key, base, target in tensors:
+                value, encoding = encode_tensor(combine(base, target), FLAGS.float_dtype)
+                fout.write(StreamingCheckpointer._pack_record(packer, key, value, encoding))
     else:
+        # The standard flax format is serialized as a whole, so the output
+        # params have to be held in memory.
+        params = unflatten_dict({
+            key: combine(base, target) for key, base, target in tensors
+        })
         params = float_to_dtype(params, FLAGS.float_dtype)
-        with mlxu.open_file(FLAGS.output, 'wb') as fout:
+        with mlxu.open_file(FLAGS.output_file, 'wb') as fout:
             fout.write(flax.serialization.msgpack_serialize(params, in_place=True))
 
 
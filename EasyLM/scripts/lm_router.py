@@ -0,0 +1,311 @@
+# This script runs a router that dispatches requests over multiple replicas of
+# the language model server, e.g.:
+#    python -m EasyLM.scripts.lm_router \
+#        --lm_router.backends='http://host1:5007,http://host2:5007'
+# The LMClient can then be pointed to the router instead of a single server.
+# For local testing, dummy CPU backends can be started with:
+#    python -m EasyLM.scripts.lm_router --dummy_backend --lm_server.port=5008
+
+import hashlib
+import json
+import time
+import urllib
+from collections import deque
+from threading import Thread, Lock
+
+import absl.logging
+import msgpack
+import mlxu
+from ml_collections import ConfigDict
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+import uvicorn
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
+
+from EasyLM.serving import LMServer, MSGPACK_CONTENT_TYPE
+
+
+class LMRouter(object):
+    """ HTTP router that fronts multiple LMServer backends. The router polls
+        the /stats endpoint of every backend, and dispatches each request to
+        the healthy backend with the lowest load, which is the number of
+        requests the router has in flight to the backend plus the rows queued
+        in the backend. Requests are routed to the same backend when their
+        text starts with the same prefix, as long as that backend is not much
+        more loaded than the others, so that the prefix and response caches
+        of the backends are reused.
+    """
+
+    ENDPOINTS = (
+        'loglikelihood', 'loglikelihood-rolling', 'generate', 'greedy-until',
+        'chat', 'generate-stream', 'chat-stream',
+    )
+
+    @staticmethod
+    def get_default_config(updates=None):
+        config = ConfigDict()
+        config.host = '0.0.0.0'
+        config.port = 5009
+        config.backends = 'http://localhost:5007'
+        config.stats_interval = 0.5
+        config.sticky_prefix_length = 256
+        config.sticky_max_imbalance = 4
+        config.throughput_window = 60.0
+
+        if updates is not None:
+            config.update(ConfigDict(updates).copy_and_resolve_references())
+        return config
+
+    def __init__(self, config):
+        self.config = self.get_default_config(config)
+        self.backends = [
+            url.strip() for url in self.config.backends.split(',') if url.strip() != ''
+        ]
+        assert len(self.backends) > 0, 'At least one backend is required!'
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.backends), pool_maxsize=64)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = Lock()
+        self.healthy = {url: False for url in self.backends}
+        self.backend_stats = {url: {} for url in self.backends}
+        self.in_flight = {url: 0 for url in self.backends}
+        self.num_requests = {url: 0 for url in self.backends}
+        self.num_rows = {url: 0 for url in self.backends}
+        self.num_failures = {url: 0 for url in self.backends}
+        self.total_latency = {url: 0.0 for url in self.backends}
+        self.num_sticky = 0
+        self.start_time = time.time()
+        self._recent = deque()
+
+        self._poller = Thread(target=self._poll_stats, daemon=True)
+        self._poller.start()
+
+        self.app = FastAPI()
+        for endpoint in self.ENDPOINTS:
+            self.app.post(f'/{endpoint}')(self.make_route(endpoint))
+        self.app.get('/ready')(self.serve_ready)
+        self.app.get('/stats')(self.serve_stats)
+
+    def _poll_stats(self):
+        while True:
+            for url in self.backends:
+                try:
+                    stats = self.session.get(
+                        urllib.parse.urljoin(url, 'stats'),
+                        timeout=max(self.config.stats_interval, 1.0),
+                    ).json()
+                    healthy = True
+                except (RequestException, ValueError):
+                    stats, healthy = {}, False
+                with self._lock:
+                    if self.healthy[url] != healthy:
+                        absl.logging.info(
+                            f'Backend {url} is {"healthy" if healthy else "unhealthy"}.'
+                        )
+                    self.healthy[url] = healthy
+                    self.backend_stats[url] = stats
+            time.sleep(self.config.stats_interval)
+
+    @staticmethod
+    def get_prefix(data):
+        """ Return the text prefix used for sticky routing of a request. """
+        if data.get('prefix_text'):
+            return data['prefix_text'][0]
+        if data.get('text'):
+            return data['text'][0]
+        if 'prompt' in data:
+            return data.get('context', '') + data['prompt']
+        return None
+
+    def load(self, url):
+        return self.in_flight[url] + self.backend_stats[url].get('queued_rows', 0)
+
+    def select_backend(self, data):
+        with self._lock:
+            candidates = [url for url in self.backends if self.healthy[url]]
+            if len(candidates) == 0:
+                # Fall back to all the backends before the first stats poll
+                candidates = self.backends
+            backend = min(candidates, key=self.load)
+            prefix = self.get_prefix(data)
+            if self.config.sticky_prefix_length > 0 and prefix:
+                prefix = prefix[:self.config.sticky_prefix_length].encode('utf-8')
+                # Rendezvous hashing keeps the mapping of prefixes stable when
+                # backends become healthy or unhealthy.
+                sticky_backend = max(
+                    candidates,
+                    key=lambda url: hashlib.sha256(url.encode('utf-8') + prefix).digest()
+                )
+                if self.load(sticky_backend) <= self.load(backend) + self.config.sticky_max_imbalance:
+                    backend = sticky_backend
+                    self.num_sticky += 1
+            self.in_flight[backend] += 1
+        return backend
+
+    def release_backend(self, url, start_time, num_rows, success):
+        now = time.time()
+        with self._lock:
+            self.in_flight[url] -= 1
+            self.num_requests[url] += 1
+            self.total_latency[url] += now - start_time
+            if success:
+                self.num_rows[url] += num_rows
+                self._recent.append((now, num_rows))
+            else:
+                self.num_failures[url] += 1
+            while len(self._recent) > 0 and self._recent[0][0] < now - self.config.throughput_window:
+                self._recent.popleft()
+
+    @staticmethod
+    def count_rows(data):
+        for key in ('prefix_text', 'text'):
+            if data.get(key):
+                return len(data[key])
+        return 1
+
+    def make_route(self, endpoint):
+        stream = endpoint.endswith('-stream')
+
+        async def route(request: Request):
+            # The request body is forwarded unchanged, so that both JSON and
+            # msgpack requests can be routed.
+            body = await request.body()
+            headers = {
+                key: request.headers[key]
+                for key in ('content-type', 'accept') if key in request.headers
+            }
+            try:
+                if headers.get('content-type', '').startswith(MSGPACK_CONTENT_TYPE):
+                    data = msgpack.unpackb(body)
+                else:
+                    data = json.loads(body)
+            except ValueError:
+                raise HTTPException(status_code=400, detail='Invalid request body.')
+            return await run_in_threadpool(forward, body, headers, data)
+
+        def forward(body, headers, data):
+            backend = self.select_backend(data)
+            start_time = time.time()
+            num_rows = self.count_rows(data)
+            try:
+                response = self.session.post(
+                    urllib.parse.urljoin(backend, endpoint),
+                    data=body, headers=headers, stream=stream,
+                )
+            except RequestException as e:
+                self.release_backend(backend, start_time, num_rows, False)
+                raise HTTPException(status_code=503, detail=f'Backend {backend} failed: {e!r}')
+
+            if response.status_code != 200:
+                self.release_backend(backend, start_time, num_rows, False)
+                raise HTTPException(status_code=response.status_code, detail=response.text)
+
+            if not stream:
+                self.release_backend(backend, start_time, num_rows, True)
+                return Response(
+                    response.content,
+                    media_type=response.headers.get('content-type'),
+                )
+
+            def iterate_stream():
+                success = False
+                try:
+                    for chunk in response.iter_content(chunk_size=None):
+                        yield chunk
+                    success = True
+                finally:
+                    response.close()
+                    self.release_backend(backend, start_time, num_rows, success)
+
+            return StreamingResponse(iterate_stream(), media_type='text/event-stream')
+
+        route.__name__ = 'route_' + endpoint.replace('-', '_')
+        return route
+
+    def serve_ready(self):
+        with self._lock:
+            if not any(self.healthy.values()):
+                raise HTTPException(status_code=503, detail='No healthy backend.')
+        return 'Ready!\n'
+
+    def serve_stats(self):
+        now = time.time()
+        with self._lock:
+            backends = [
+                {
+                    'url': url,
+                    'healthy': self.healthy[url],
+                    'in_flight_requests': self.in_flight[url],
+                    'requests': self.num_requests[url],
+                    'rows': self.num_rows[url],
+                    'failures': self.num_failures[url],
+                    'average_latency': self.total_latency[url] / max(self.num_requests[url], 1),
+                    'stats': self.backend_stats[url],
+                }
+                for url in self.backends
+            ]
+            window = min(now - self.start_time, self.config.throughput_window)
+            recent_rows = sum(rows for _, rows in self._recent)
+            total_requests = sum(self.num_requests.values())
+            return {
+                'uptime': now - self.start_time,
+                'requests': total_requests,
+                'rows': sum(self.num_rows.values()),
+                'sticky_ratio': self.num_sticky / max(total_requests, 1),
+                'rows_per_second': recent_rows / max(window, 1e-6),
+                'requests_per_second': len(self._recent) / max(window, 1e-6),
+                'backends': backends,
+            }
+
+    def run(self):
+        uvicorn.run(self.app, host=self.config.host, port=self.config.port)
+
+
+class DummyLMServer(LMServer):
+    """ CPU stand-in for a language model server, which returns fixed outputs
+        after sleeping for dummy_latency seconds per row.
+    """
+
+    @staticmethod
+    def loglikelihood(prefix_text, text):
+        time.sleep(FLAGS.dummy_latency * len(text))
+        return [-1.0 for _ in text], [False for _ in text]
+
+    @staticmethod
+    def loglikelihood_rolling(text):
+        time.sleep(FLAGS.dummy_latency * len(text))
+        return [-1.0 for _ in text], [False for _ in text]
+
+    @staticmethod
+    def generate(text, temperature):
+        time.sleep(FLAGS.dummy_latency * len(text))
+        return ['dummy text' for _ in text]
+
+    @staticmethod
+    def greedy_until(prefix_text, until, max_length):
+        time.sleep(FLAGS.dummy_latency * len(prefix_text))
+        return ['dummy text' for _ in prefix_text]
+
+
+FLAGS, FLAGS_DEF = mlxu.define_flags_with_default(
+    dummy_backend=False,
+    dummy_latency=0.01,
+    lm_router=LMRouter.get_default_config(),
+    lm_server=LMServer.get_default_config(),
+)
+
+
+def main(argv):
+    if FLAGS.dummy_backend:
+        DummyLMServer(FLAGS.lm_server).run()
+    else:
+        LMRouter(FLAGS.lm_router).run()
+
+
+if __name__ == "__main__":
+    mlxu.run(main)
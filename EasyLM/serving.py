@@ -3,22 +3,36 @@ import pprint
 from functools import partial
 import re
 import os
-from threading import Lock
+import json
+import hashlib
+import sqlite3
+from threading import Thread, Condition, Lock
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque, OrderedDict
 import urllib
 import time
 from typing import List, Optional, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 import absl.logging
 from tqdm import tqdm, trange
 import numpy as np
+import msgpack
 import mlxu
 from ml_collections import ConfigDict
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, JSONResponse, StreamingResponse
 import gradio as gr
 import requests
-from requests.exceptions import Timeout, ConnectionError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout, ConnectionError, HTTPError
+
+
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
 
 
 class InferenceRequest(BaseModel):
@@ -26,6 +40,12 @@ class InferenceRequest(BaseModel):
     text: Optional[List[str]] = None
     until: Optional[Union[List[str], List[List[str]]]] = None
     temperature: Optional[float] = None
+    max_new_tokens: Optional[int] = None
+    top_k: Optional[int] = None
+    top_p: Optional[float] = None
+    min_p: Optional[float] = None
+    do_sample: Optional[bool] = None
+    return_token_loglikelihood: Optional[bool] = None
 
 
 class ChatRequest(BaseModel):
@@ -34,15 +54,265 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = None
 
 
+@dataclasses.dataclass
+class ScheduledRow:
+    key: object
+    row: object
+    future: Future
+    submit_time: float
+
+
+@dataclasses.dataclass
+class ScheduledResult:
+    output: object
+    batch_id: int
+    queue_time: float
+    compute_time: float
+
+
+class BatchScheduler(object):
+    """ Continuous batching scheduler that merges the rows of concurrent
+        requests into shared device batches. Rows are queued by task key,
+        which identifies the batch function and all the arguments shared by
+        the rows of a batch (e.g. the temperature). A batch is dispatched as
+        soon as batch_size rows of the same key are queued or the oldest of
+        them has waited for max_wait seconds. All batches are run by a single
+        worker thread, so the device is never used concurrently.
+    """
+
+    def __init__(self, batch_size, max_wait=0.0):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._queues = {}
+        self._batch_fns = {}
+        self._batch_count = 0
+        self._condition = Condition()
+        self._worker = Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, key, batch_fn, rows, pad_row=None):
+        """ Queue rows to be processed by batch_fn, which takes a list of rows
+            and returns a list of outputs of the same length. If pad_row is
+            not None, partially filled batches are padded to batch_size with
+            it. Returns a list of futures of ScheduledResult, one per row.
+        """
+        submit_time = time.time()
+        futures = [Future() for _ in rows]
+        with self._condition:
+            queue = self._queues.setdefault(key, deque())
+            self._batch_fns[key] = (batch_fn, pad_row)
+            for row, future in zip(rows, futures):
+                queue.append(ScheduledRow(key, row, future, submit_time))
+            self._condition.notify()
+        return futures
+
+    def num_queued(self):
+        with self._condition:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _next_ready_key(self):
+        """ Return the ready key with the oldest queued row, and the time to
+            wait until a key becomes ready if none is ready yet.
+        """
+        now = time.time()
+        ready_key, ready_time, wait_time = None, None, None
+        for key, queue in self._queues.items():
+            head_time = queue[0].submit_time
+            if len(queue) >= self.batch_size or now - head_time >= self.max_wait:
+                if ready_key is None or head_time < ready_time:
+                    ready_key, ready_time = key, head_time
+            else:
+                remaining = head_time + self.max_wait - now
+                wait_time = remaining if wait_time is None else min(wait_time, remaining)
+        return ready_key, wait_time
+
+    def _run(self):
+        while True:
+            with self._condition:
+                key, wait_time = self._next_ready_key()
+                while key is None:
+                    self._condition.wait(wait_time)
+                    key, wait_time = self._next_ready_key()
+                queue = self._queues[key]
+                rows = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
+                if len(queue) == 0:
+                    del self._queues[key]
+                batch_fn, pad_row = self._batch_fns[key]
+                batch_id = self._batch_count
+                self._batch_count += 1
+            self._run_batch(batch_id, batch_fn, pad_row, rows)
+
+    def _run_batch(self, batch_id, batch_fn, pad_row, rows):
+        start_time = time.time()
+        batch = [r.row for r in rows]
+        if pad_row is not None:
+            batch.extend([pad_row for _ in range(self.batch_size - len(rows))])
+        try:
+            outputs = batch_fn(batch)
+        except Exception as e:
+            for r in rows:
+                r.future.set_exception(e)
+            return
+        compute_time = time.time() - start_time
+        for r, output in zip(rows, outputs):
+            r.future.set_result(ScheduledResult(
+                output=output,
+                batch_id=batch_id,
+                queue_time=start_time - r.submit_time,
+                compute_time=compute_time,
+            ))
+
+
+class ResponseCache(object):
+    """ Cache of the outputs of deterministic requests, keyed by the hash of
+        the checkpoint id, the endpoint, the request row and its parameters.
+        The outputs are kept in an in-memory LRU cache, and optionally in a
+        SQLite database on disk, so that they persist across server restarts.
+        Both are limited to a maximum number of entries, beyond which the
+        least recently used entries are evicted.
+    """
+
+    @staticmethod
+    def get_default_config(updates=None):
+        config = ConfigDict()
+        config.enable = False
+        config.checkpoint_id = ''
+        config.memory_size = 100000
+        config.disk_path = ''
+        config.disk_size = 10000000
+
+        if updates is not None:
+            config.update(ConfigDict(updates).copy_and_resolve_references())
+        return config
+
+    def __init__(self, config):
+        self.config = self.get_default_config(config)
+        self._memory = OrderedDict()
+        self._lock = Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+        if self.config.disk_path != '':
+            self._db = sqlite3.connect(self.config.disk_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses '
+                '(key TEXT PRIMARY KEY, value TEXT, access_time REAL)'
+            )
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS access_time_index ON responses (access_time)'
+            )
+            self._db.commit()
+            # The number of rows is tracked in memory, since counting them
+            # scans the whole table.
+            self._num_disk_entries = self._db.execute(
+                'SELECT COUNT(*) FROM responses'
+            ).fetchone()[0]
+        else:
+            self._db = None
+        self._pending_access = {}
+
+    def make_key(self, endpoint, row, params=None):
+        request = json.dumps(
+            [self.config.checkpoint_id, endpoint, row, params], sort_keys=True
+        )
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """ Return the cached outputs of a list of keys, with None for the keys
+            that are not cached. The access times of the disk hits are only
+            written to the database by the next put_many, so that a request
+            commits to the database at most once.
+        """
+        with self._lock:
+            outputs = [None for _ in keys]
+            disk_keys = []
+            for i, key in enumerate(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    outputs[i] = self._memory[key]
+                else:
+                    disk_keys.append(key)
+            if self._db is not None and len(disk_keys) > 0:
+                values = {}
+                # Stay below the SQLite limit on the number of parameters
+                for start in range(0, len(disk_keys), 500):
+                    chunk = disk_keys[start:start + 500]
+                    values.update(self._db.execute(
+                        'SELECT key, value FROM responses WHERE key IN '
+                        f'({", ".join("?" for _ in chunk)})', chunk
+                    ).fetchall())
+                access_time = time.time()
+                for i, key in enumerate(keys):
+                    if outputs[i] is None and key in values:
+                        outputs[i] = json.loads(values[key])
+                        self._put_memory(key, outputs[i])
+                        self._pending_access[key] = access_time
+            num_hits = sum(output is not None for output in outputs)
+            self.num_hits += num_hits
+            self.num_misses += len(keys) - num_hits
+            return outputs
+
+    def put_many(self, items):
+        """ Cache a list of (key, output) pairs, and write them to the
+            database together with the pending access times in a single
+            transaction.
+        """
+        with self._lock:
+            for key, value in items:
+                self._put_memory(key, value)
+            if self._db is None or (len(items) == 0 and len(self._pending_access) == 0):
+                return
+            now = time.time()
+            cursor = self._db.executemany(
+                'INSERT OR IGNORE INTO responses VALUES (?, ?, ?)',
+                [(key, json.dumps(value), now) for key, value in items]
+            )
+            self._num_disk_entries += max(cursor.rowcount, 0)
+            self._db.executemany(
+                'UPDATE responses SET access_time = ? WHERE key = ?',
+                [(access_time, key) for key, access_time in self._pending_access.items()]
+            )
+            self._pending_access = {}
+            if self._num_disk_entries > self.config.disk_size:
+                cursor = self._db.execute(
+                    'DELETE FROM responses WHERE key IN '
+                    '(SELECT key FROM responses ORDER BY access_time LIMIT ?)',
+                    (self._num_disk_entries - self.config.disk_size,)
+                )
+                self._num_disk_entries -= max(cursor.rowcount, 0)
+            self._db.commit()
+
+    def _put_memory(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.config.memory_size:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.num_hits,
+                'misses': self.num_misses,
+                'hit_rate': self.num_hits / max(self.num_hits + self.num_misses, 1),
+                'memory_entries': len(self._memory),
+            }
+
+
 class LMServer(object):
     """ HTTP server for serving langauge models. """
 
+    # Whether the generate method takes a list of per-row values for each of
+    # its sampling parameters. If so, generate requests with different
+    # sampling parameters share device batches. Otherwise only the temperature
+    # is supported, and it is shared by all the rows of a batch.
+    per_row_sampling = False
+
     @staticmethod
     def get_default_config(updates=None):
         config = ConfigDict()
         config.host = '0.0.0.0'
         config.port = 5007
         config.batch_size = 1
+        config.scheduler_max_wait = 0.005
         config.logging = False
         config.pre_compile = 'loglikelihood'
         config.default_temperature = 1.0
@@ -57,21 +327,39 @@ class LMServer(object):
         config.chat_lm_prefix = ''
         config.chat_lm_suffix = ''
         config.notes = ''
+        config.response_cache = ResponseCache.get_default_config()
 
         if updates is not None:
             config.update(ConfigDict(updates).copy_and_resolve_references())
         return config
 
-    def __init__(self, config):
+    def __init__(self, config, decode_engine=None):
         self.config = self.get_default_config(config)
-        self.lock = Lock()
+        # Generation is served by the in-flight batching decode engine when
+        # provided, and by the generate method through the scheduler otherwise.
+        self.decode_engine = decode_engine
+        self.scheduler = BatchScheduler(
+            self.config.batch_size, self.config.scheduler_max_wait
+        )
+        if self.config.response_cache.enable:
+            self.response_cache = ResponseCache(self.config.response_cache)
+        else:
+            self.response_cache = None
+        self.start_time = time.time()
+        self.num_in_flight = 0
+        self.num_completed = 0
+        self._stats_lock = Lock()
         self.app = FastAPI()
-        self.app.post('/loglikelihood')(self.serve_loglikelihood)
-        self.app.post('/loglikelihood-rolling')(self.serve_loglikelihood_rolling)
-        self.app.post('/generate')(self.serve_generate)
-        self.app.post('/greedy-until')(self.serve_greedy_until)
-        self.app.post('/chat')(self.serve_chat)
+        self.app.middleware('http')(self.count_requests)
+        self.add_endpoint('/loglikelihood', self.serve_loglikelihood, InferenceRequest)
+        self.add_endpoint('/loglikelihood-rolling', self.serve_loglikelihood_rolling, InferenceRequest)
+        self.add_endpoint('/generate', self.serve_generate, InferenceRequest)
+        self.add_endpoint('/greedy-until', self.serve_greedy_until, InferenceRequest)
+        self.add_endpoint('/chat', self.serve_chat, ChatRequest)
+        self.add_endpoint('/generate-stream', self.serve_generate_stream, InferenceRequest)
+        self.add_endpoint('/chat-stream', self.serve_chat_stream, ChatRequest)
         self.app.get('/ready')(self.serve_ready)
+        self.app.get('/stats')(self.serve_stats)
         self.app = gr.mount_gradio_app(self.app, self.create_chat_app(), '/')
 
     @staticmethod
@@ -82,6 +370,10 @@ class LMServer(object):
     def loglikelihood_rolling(text):
         raise NotImplementedError()
 
+    @staticmethod
+    def loglikelihood_rolling_tokens(text):
+        raise NotImplementedError()
+
     @staticmethod
     def generate(text, temperature):
         raise NotImplementedError()
@@ -96,197 +388,460 @@ class LMServer(object):
             return x.tolist()
         return x
 
+    def pre_compile_loglikelihood(self, pre_compile_data):
+        """ Trigger the compilation of the loglikelihood methods. Servers that
+            compile multiple shapes can override this to compile all of them.
+        """
+        self.loglikelihood(pre_compile_data, pre_compile_data)
+        self.loglikelihood_rolling(pre_compile_data)
+
     def serve_ready(self):
         return 'Ready!\n'
 
-    def serve_loglikelihood(self, data: InferenceRequest):
-        with self.lock:
-            if self.config.logging:
-                absl.logging.info(
-                    '\n========= Serving Log Likelihood Request ========= \n'
-                    + pprint.pformat(data) + '\n'
+    def add_endpoint(self, path, handler, request_type):
+        """ Register a POST endpoint that accepts either a JSON or a msgpack
+            request body, depending on its Content-Type header, and responds
+            with msgpack if the Accept header of the request contains the
+            msgpack content type, or JSON otherwise.
+        """
+        async def endpoint(request: Request):
+            body = await request.body()
+            # Malformed requests are client errors, which LMClient does not
+            # retry, unlike server errors.
+            try:
+                if request.headers.get('content-type', '').startswith(MSGPACK_CONTENT_TYPE):
+                    data = msgpack.unpackb(body)
+                else:
+                    data = json.loads(body)
+                if not isinstance(data, dict):
+                    raise HTTPException(
+                        status_code=400, detail='The request body must be an object.'
+                    )
+                data = request_type(**data)
+            except ValidationError as e:
+                # Pydantic v1 validation errors are rebuilt from their raw
+                # errors, and pydantic v2 ones from their error dicts.
+                raise RequestValidationError(getattr(e, 'raw_errors', None) or e.errors())
+            except (ValueError, TypeError, msgpack.UnpackException):
+                raise HTTPException(status_code=400, detail='Invalid request body.')
+
+            output = await run_in_threadpool(handler, data)
+            if isinstance(output, Response):
+                return output
+            if MSGPACK_CONTENT_TYPE in request.headers.get('accept', ''):
+                return Response(
+                    msgpack.packb(output, default=lambda x: x.tolist()),
+                    media_type=MSGPACK_CONTENT_TYPE,
                 )
+            return JSONResponse(jsonable_encoder(output))
+
+        endpoint.__name__ = handler.__name__
+        self.app.post(path)(endpoint)
+
+    async def count_requests(self, request, call_next):
+        """ Track the number of requests in flight, which is reported as the
+            load of the server.
+        """
+        with self._stats_lock:
+            self.num_in_flight += 1
+        try:
+            return await call_next(request)
+        finally:
+            with self._stats_lock:
+                self.num_in_flight -= 1
+                self.num_completed += 1
+
+    def serve_stats(self):
+        with self._stats_lock:
+            stats = {
+                'uptime': time.time() - self.start_time,
+                # Exclude the stats request itself
+                'in_flight_requests': self.num_in_flight - 1,
+                'completed_requests': self.num_completed,
+                'queued_rows': self.scheduler.num_queued(),
+            }
+        if self.decode_engine is not None:
+            stats['decode_active'] = self.decode_engine.num_active()
+            stats['decode_pending'] = self.decode_engine.num_pending()
+        if self.response_cache is not None:
+            stats['response_cache'] = self.response_cache.stats()
+        stats.update(self.model_stats())
+        return stats
+
+    def model_stats(self):
+        """ Statistics of the model, reported by the /stats endpoint. """
+        return {}
+
+    def schedule(self, key, batch_fn, rows, pad_row=None):
+        """ Run batch_fn over rows through the batch scheduler, sharing device
+            batches with the concurrent requests of the same key. Returns the
+            outputs for the rows and the time the request spent in the queue
+            and in computation.
+        """
+        start_time = time.time()
+        futures = self.scheduler.submit(key, batch_fn, rows, pad_row)
+        results = [future.result() for future in futures]
+        compute_time = sum({r.batch_id: r.compute_time for r in results}.values())
+        timing = {
+            'queue_time': max(time.time() - start_time - compute_time, 0.0),
+            'compute_time': compute_time,
+        }
+        return [r.output for r in results], timing
+
+    def cached_schedule(self, key, batch_fn, rows, pad_row=None):
+        """ Same as schedule, but the outputs of the rows are looked up in
+            the response cache first, and only the missing rows are computed.
+            Only used for deterministic methods.
+        """
+        if self.response_cache is None:
+            return self.schedule(key, batch_fn, rows, pad_row)
+        cache_keys = [
+            self.response_cache.make_key(key, row) for row in rows
+        ]
+        outputs = self.response_cache.get_many(cache_keys)
+        missing = [i for i, o in enumerate(outputs) if o is None]
+        if len(missing) > 0:
+            missing_outputs, timing = self.schedule(
+                key, batch_fn, [rows[i] for i in missing], pad_row
+            )
+            for i, output in zip(missing, missing_outputs):
+                outputs[i] = output
+        else:
+            timing = {'queue_time': 0.0, 'compute_time': 0.0}
+        self.response_cache.put_many([(cache_keys[i], outputs[i]) for i in missing])
+        return outputs, timing
+
+    def loglikelihood_batch(self, rows):
+        prefix_text, text = zip(*rows)
+        log_likelihood, is_greedy = self.loglikelihood(list(prefix_text), list(text))
+        return list(zip(self.to_list(log_likelihood), self.to_list(is_greedy)))
+
+    def loglikelihood_rolling_batch(self, rows):
+        log_likelihood, is_greedy = self.loglikelihood_rolling(list(rows))
+        return list(zip(self.to_list(log_likelihood), self.to_list(is_greedy)))
+
+    def loglikelihood_rolling_tokens_batch(self, rows):
+        log_likelihood, is_greedy, token_log_likelihood = self.loglikelihood_rolling_tokens(list(rows))
+        return list(zip(
+            self.to_list(log_likelihood), self.to_list(is_greedy),
+            self.to_list(token_log_likelihood),
+        ))
 
-            if data.prefix_text is None:
-                data.prefix_text = ['' for _ in data.text]
+    def generate_batch(self, rows):
+        text, sampling = zip(*rows)
+        if self.per_row_sampling:
+            kwargs = {key: [s[key] for s in sampling] for key in sampling[0]}
+        else:
+            kwargs = {'temperature': sampling[0]['temperature']}
+        return self.to_list(self.generate(list(text), **kwargs))
 
-            prefix_text = [
-                self.config.prepend_to_prefix + p + self.config.append_to_prefix
-                for p in data.prefix_text
-            ]
-            text = [
-                self.config.prepend_to_text + t + self.config.append_to_text
-                for t in data.text
-            ]
+    @staticmethod
+    def make_sampling(temperature, max_new_tokens=None, top_k=None, top_p=None,
+                      min_p=None, do_sample=None):
+        """ Sampling parameters of a generate request, where None stands for
+            the default of the model.
+        """
+        return {
+            'temperature': 0.0 if do_sample is False else float(temperature),
+            'max_new_tokens': max_new_tokens,
+            'top_k': top_k,
+            'top_p': top_p,
+            'min_p': min_p,
+        }
 
-            log_likelihood = []
-            is_greedy = []
-            for i in trange(0, len(text), self.config.batch_size, ncols=0):
-                batch_prefix_text = prefix_text[i:i + self.config.batch_size]
-                batch_text = text[i:i + self.config.batch_size]
-                batch_size = len(batch_text)
+    def schedule_generate(self, prefix_text, sampling):
+        """ Generate from the prefixes through the batch scheduler. """
+        if self.per_row_sampling:
+            key = 'generate'
+        else:
+            key = ('generate', sampling['temperature'])
+        return self.schedule(
+            key, self.generate_batch,
+            [(text, sampling) for text in prefix_text],
+            pad_row=('a', sampling),
+        )
+
+    def request_sampling(self, data):
+        if data.temperature is None:
+            data.temperature = self.config.default_temperature
+        return self.make_sampling(
+            data.temperature, data.max_new_tokens, data.top_k, data.top_p,
+            data.min_p, data.do_sample,
+        )
 
-                if batch_size < self.config.batch_size:
-                    extra = self.config.batch_size - batch_size
-                    batch_prefix_text.extend(['a' for _ in range(extra)])
-                    batch_text.extend(['a' for _ in range(extra)])
+    def greedy_until_batch(self, rows, max_length):
+        prefix_text, until = zip(*rows)
+        return self.to_list(self.greedy_until(list(prefix_text), list(until), max_length))
 
-                batch_log_likelihood, batch_is_greedy = self.loglikelihood(
-                    batch_prefix_text, batch_text
-                )
-                batch_log_likelihood = self.to_list(batch_log_likelihood)
-                batch_is_greedy = self.to_list(batch_is_greedy)
-                log_likelihood.extend(batch_log_likelihood[:batch_size])
-                is_greedy.extend(batch_is_greedy[:batch_size])
+    def serve_loglikelihood(self, data: InferenceRequest):
+        if self.config.logging:
+            absl.logging.info(
+                '\n========= Serving Log Likelihood Request ========= \n'
+                + pprint.pformat(data) + '\n'
+            )
 
-            output = {
-                'prefix_text': data.prefix_text,
-                'text': data.text,
-                'log_likelihood': log_likelihood,
-                'is_greedy': is_greedy,
-            }
-            if self.config.logging:
-                absl.logging.info(
+        if data.prefix_text is None:
+            data.prefix_text = ['' for _ in data.text]
+
+        prefix_text = [
+            self.config.prepend_to_prefix + p + self.config.append_to_prefix
+            for p in data.prefix_text
+        ]
+        text = [
+            self.config.prepend_to_text + t + self.config.append_to_text
+            for t in data.text
+        ]
+
+        # Sort the rows of this request by prefix length, then prefix, then
+        # text length, so that the rows of the request with identical
+        # prefixes are adjacent and land in the same batches, where the
+        # shared prefix is scored once, and rows of similar lengths need
+        # less padding. The scheduler merges concurrent requests in arrival
+        # order, so rows of different requests are not grouped by prefix.
+        order = sorted(
+            range(len(text)),
+            key=lambda i: (len(prefix_text[i]), prefix_text[i], len(text[i]))
+        )
+        sorted_outputs, timing = self.cached_schedule(
+            'loglikelihood', self.loglikelihood_batch,
+            [(prefix_text[i], text[i]) for i in order], pad_row=('a', 'a'),
+        )
+        outputs = [None for _ in order]
+        for i, o in zip(order, sorted_outputs):
+            outputs[i] = o
+        output = {
+            'prefix_text': data.prefix_text,
+            'text': data.text,
+            'log_likelihood': [o[0] for o in outputs],
+            'is_greedy': [o[1] for o in outputs],
+            **timing,
+        }
+        if self.config.logging:
+            absl.logging.info(
                 '\n========= Output ========= \n'
                 + pprint.pformat(output) + '\n'
             )
-
         return output
 
     def serve_loglikelihood_rolling(self, data: InferenceRequest):
-        with self.lock:
-            if self.config.logging:
-                absl.logging.info(
-                    '\n========= Serving Log Likelihood Request ========= \n'
-                    + pprint.pformat(data) + '\n'
-                )
+        if self.config.logging:
+            absl.logging.info(
+                '\n========= Serving Log Likelihood Request ========= \n'
+                + pprint.pformat(data) + '\n'
+            )
 
-            text = [
-                self.config.prepend_to_text + t + self.config.append_to_text
-                for t in data.text
-            ]
-            log_likelihood = []
-            is_greedy = []
-            for i in trange(0, len(text), self.config.batch_size, ncols=0):
-                batch_text = text[i:i + self.config.batch_size]
-                batch_size = len(batch_text)
-
-                if batch_size < self.config.batch_size:
-                    extra = self.config.batch_size - batch_size
-                    batch_text.extend(['a' for _ in range(extra)])
-
-                batch_log_likelihood, batch_is_greedy = self.loglikelihood_rolling(
-                    batch_text
-                )
-                batch_log_likelihood = self.to_list(batch_log_likelihood)
-                batch_is_greedy = self.to_list(batch_is_greedy)
-                log_likelihood.extend(batch_log_likelihood[:batch_size])
-                is_greedy.extend(batch_is_greedy[:batch_size])
-
-            output = {
-                'text': data.text,
-                'log_likelihood': log_likelihood,
-                'is_greedy': is_greedy,
-            }
-            if self.config.logging:
-                absl.logging.info(
+        text = [
+            self.config.prepend_to_text + t + self.config.append_to_text
+            for t in data.text
+        ]
+        if data.return_token_loglikelihood:
+            outputs, timing = self.cached_schedule(
+                'loglikelihood_rolling_tokens', self.loglikelihood_rolling_tokens_batch,
+                text, pad_row='a',
+            )
+        else:
+            outputs, timing = self.cached_schedule(
+                'loglikelihood_rolling', self.loglikelihood_rolling_batch,
+                text, pad_row='a',
+            )
+        output = {
+            'text': data.text,
+            'log_likelihood': [o[0] for o in outputs],
+            'is_greedy': [o[1] for o in outputs],
+            **timing,
+        }
+        if data.return_token_loglikelihood:
+            output['token_log_likelihood'] = [o[2] for o in outputs]
+        if self.config.logging:
+            absl.logging.info(
                 '\n========= Output ========= \n'
                 + pprint.pformat(output) + '\n'
             )
-
         return output
 
     def serve_generate(self, data: InferenceRequest):
-        with self.lock:
-            if self.config.logging:
-                absl.logging.info(
-                    '\n========= Serving Generate Request ========= \n'
-                    + pprint.pformat(data) + '\n'
-                )
-            prefix_text = [
-                self.config.prepend_to_prefix + p + self.config.append_to_prefix
-                for p in data.prefix_text
-            ]
-
-            if data.temperature is None:
-                data.temperature = self.config.default_temperature
-
-            output_text = []
-            for i in trange(0, len(prefix_text), self.config.batch_size, ncols=0):
-                batch_prefix_text = prefix_text[i:i + self.config.batch_size]
-                batch_size = len(batch_prefix_text)
-
-                if batch_size < self.config.batch_size:
-                    extra = self.config.batch_size - batch_size
-                    batch_prefix_text.extend(['a' for _ in range(extra)])
-
-                batch_output_text = self.generate(
-                    batch_prefix_text,
-                    temperature=data.temperature,
-                )
-                output_text.extend(self.to_list(batch_output_text)[:batch_size])
+        if self.config.logging:
+            absl.logging.info(
+                '\n========= Serving Generate Request ========= \n'
+                + pprint.pformat(data) + '\n'
+            )
+        prefix_text = [
+            self.config.prepend_to_prefix + p + self.config.append_to_prefix
+            for p in data.prefix_text
+        ]
+        sampling = self.request_sampling(data)
+
+        if self.decode_engine is not None:
+            results = self.decode_engine.generate(
+                prefix_text, sampling['temperature'], sampling['max_new_tokens'],
+                sampling=sampling,
+            )
+            output_text = [r.text for r in results]
+            timing = {
+                'queue_time': max([r.queue_time for r in results], default=0.0),
+                'compute_time': max([r.compute_time for r in results], default=0.0),
+            }
+        else:
+            output_text, timing = self.schedule_generate(prefix_text, sampling)
+        output = {
+            'prefix_text': data.prefix_text,
+            'output_text': output_text,
+            'temperature': data.temperature,
+            **timing,
+        }
+        if self.config.logging:
+            absl.logging.info(
+                '\n========= Output ========= \n'
+                + pprint.pformat(output) + '\n'
+            )
+        return output
 
-            output = {
+    @staticmethod
+    def to_event(data):
+        """ Format a server-sent event. """
+        return 'data: ' + json.dumps(data) + '\n\n'
+
+    def stream_generate(self, prefix_text, sampling):
+        """ Yield (index, text) pairs of the text generated for each prefix
+            as it is generated. Without the decode engine, the whole text of
+            each prefix is yielded at once after the batch is generated.
+        """
+        if self.decode_engine is not None:
+            yield from self.decode_engine.stream(
+                prefix_text, sampling['temperature'], sampling['max_new_tokens'],
+                sampling=sampling,
+            )
+        else:
+            output_text, _ = self.schedule_generate(prefix_text, sampling)
+            yield from enumerate(output_text)
+
+    def serve_generate_stream(self, data: InferenceRequest):
+        if self.config.logging:
+            absl.logging.info(
+                '\n========= Serving Generate Stream Request ========= \n'
+                + pprint.pformat(data) + '\n'
+            )
+        prefix_text = [
+            self.config.prepend_to_prefix + p + self.config.append_to_prefix
+            for p in data.prefix_text
+        ]
+        sampling = self.request_sampling(data)
+
+        def generate_events():
+            start_time = time.time()
+            time_to_first_token = None
+            output_text = ['' for _ in prefix_text]
+            for index, text in self.stream_generate(prefix_text, sampling):
+                if time_to_first_token is None:
+                    time_to_first_token = time.time() - start_time
+                output_text[index] += text
+                yield self.to_event({'index': index, 'text': text})
+            yield self.to_event({
+                'done': True,
                 'prefix_text': data.prefix_text,
                 'output_text': output_text,
                 'temperature': data.temperature,
-            }
-            if self.config.logging:
-                absl.logging.info(
-                    '\n========= Output ========= \n'
-                    + pprint.pformat(output) + '\n'
-                )
-        return output
-
-    def serve_greedy_until(self, data: InferenceRequest):
-        with self.lock:
-            if self.config.logging:
-                absl.logging.info(
-                    '\n========= Serving Greedy Until Request ========= \n'
-                    + pprint.pformat(data) + '\n'
-                )
-            prefix_text = [
-                self.config.prepend_to_prefix + p + self.config.append_to_prefix
-                for p in data.prefix_text
-            ]
-            until = data.until
-            max_length = self.config.greedy_until_max_length
-
-            output_text = []
-            for i in range(0, len(prefix_text), self.config.batch_size):
-                batch_prefix_text = prefix_text[i:i + self.config.batch_size]
-                batch_until = until[i:i + self.config.batch_size]
-                batch_size = len(batch_prefix_text)
+                'time_to_first_token': time_to_first_token,
+                'total_time': time.time() - start_time,
+            })
 
-                batch_output_text = self.greedy_until(batch_prefix_text, batch_until, max_length)
-                output_text.extend(self.to_list(batch_output_text)[:batch_size])
+        return StreamingResponse(generate_events(), media_type='text/event-stream')
 
-            output = {
-                'prefix_text': data.prefix_text,
-                'until': data.until,
-                'max_length': max_length,
-                'output_text': output_text,
-            }
-            if self.config.logging:
-                absl.logging.info(
-                    '\n========= Output ========= \n'
-                    + pprint.pformat(output) + '\n'
-                )
+    def serve_greedy_until(self, data: InferenceRequest):
+        if self.config.logging:
+            absl.logging.info(
+                '\n========= Serving Greedy Until Request ========= \n'
+                + pprint.pformat(data) + '\n'
+            )
+        prefix_text = [
+            self.config.prepend_to_prefix + p + self.config.append_to_prefix
+            for p in data.prefix_text
+        ]
+        max_length = self.config.greedy_until_max_length
+
+        # The batches are not padded with a fixed pad row, which would keep
+        # generating until max_length. The greedy_until method pads its device
+        # batches by repeating its own rows instead.
+        output_text, timing = self.cached_schedule(
+            ('greedy_until', max_length),
+            partial(self.greedy_until_batch, max_length=max_length),
+            list(zip(prefix_text, data.until)),
+        )
+        output = {
+            'prefix_text': data.prefix_text,
+            'until': data.until,
+            'max_length': max_length,
+            'output_text': output_text,
+            **timing,
+        }
+        if self.config.logging:
+            absl.logging.info(
+                '\n========= Output ========= \n'
+                + pprint.pformat(output) + '\n'
+            )
         return output
 
-    def process_chat(self, prompt, context, temperature):
-        context = (
+    def chat_context(self, prompt, context):
+        return (
             context + self.config.chat_user_prefix
             + prompt + self.config.chat_user_suffix
             + self.config.chat_lm_prefix
         )
-        response = self.generate(
-            [self.config.chat_prepend_text + context],
-            temperature=float(temperature),
-        )[0]
+
+    def process_chat(self, prompt, context, temperature):
+        context = self.chat_context(prompt, context)
+        temperature = float(temperature)
+        text = self.config.chat_prepend_text + context
+        if self.decode_engine is not None:
+            response = self.decode_engine.submit(text, temperature).result().text
+        else:
+            # Chat requests share device batches with the generate requests
+            (response, ), _ = self.schedule_generate(
+                [text], self.make_sampling(temperature)
+            )
         context = context + response + self.config.chat_lm_suffix
         return response, context
 
+    def stream_chat(self, prompt, context, temperature):
+        """ Same as process_chat, but yields the partial response and the
+            context updated with it as the response is generated.
+        """
+        context = self.chat_context(prompt, context)
+        text = self.config.chat_prepend_text + context
+        response = None
+        for _, new_text in self.stream_generate([text], self.make_sampling(temperature)):
+            response = new_text if response is None else response + new_text
+            yield response, context + response + self.config.chat_lm_suffix
+        if response is None:
+            # The response is empty
+            yield '', context + self.config.chat_lm_suffix
+
+    def serve_chat_stream(self, data: ChatRequest):
+        if data.temperature is None:
+            data.temperature = self.config.default_temperature
+
+        def chat_events():
+            start_time = time.time()
+            time_to_first_token = None
+            response, context = '', data.context
+            for new_response, context in self.stream_chat(
+                data.prompt, data.context, data.temperature
+            ):
+                if time_to_first_token is None:
+                    time_to_first_token = time.time() - start_time
+                yield self.to_event({'text': new_response[len(response):]})
+                response = new_response
+            yield self.to_event({
+                'done': True,
+                'response': response,
+                'context': context,
+                'temperature': data.temperature,
+                'time_to_first_token': time_to_first_token,
+                'total_time': time.time() - start_time,
+            })
+
+        return StreamingResponse(chat_events(), media_type='text/event-stream')
+
     def serve_chat(self, data: ChatRequest):
         if data.temperature is None:
             data.temperature = self.config.default_temperature
@@ -332,10 +887,13 @@ class LMServer(object):
                 }
 
             def model_fn(history, context, temperature):
-                history[-1][1], new_context = self.process_chat(
+                # Stream the partial response into the chat history
+                new_context = context[0]
+                for history[-1][1], new_context in self.stream_chat(
                     history[-1][0], context[0], temperature
-                )
-                return {
+                ):
+                    yield {chatbot: history}
+                yield {
                     msg: gr.update(value='', interactive=True),
                     clear: gr.update(interactive=True),
                     send: gr.update(interactive=True),
@@ -400,7 +958,8 @@ class LMServer(object):
                 queue=False
             )
 
-        gradio_chatbot.queue(concurrency_count=1)
+        # Concurrent chats are batched together by the scheduler
+        gradio_chatbot.queue(concurrency_count=max(self.config.batch_size, 1))
         return gradio_chatbot
 
     def run(self):
@@ -413,10 +972,12 @@ class LMServer(object):
             pre_compile_data = ['a' for _ in range(self.config.batch_size)]
             for task in pre_compile:
                 if task == 'loglikelihood':
-                    self.loglikelihood(pre_compile_data, pre_compile_data)
-                    self.loglikelihood_rolling(pre_compile_data)
+                    self.pre_compile_loglikelihood(pre_compile_data)
                 elif task == 'generate':
-                    self.generate(pre_compile_data, 1.0)
+                    if self.decode_engine is not None:
+                        self.decode_engine.generate(pre_compile_data, 1.0)
+                    else:
+                        self.generate(pre_compile_data, 1.0)
                 elif task == 'greedy_until':
                     self.greedy_until(
                         pre_compile_data, pre_compile_data,
@@ -431,14 +992,26 @@ class LMServer(object):
 
 
 class LMClient(object):
-    """ A simple client for the LM server. """
+    """ A simple client for the LM server. Batches are sent by a pool of
+        num_workers threads through a shared HTTP session, and the outputs
+        are reassembled in order. The url can be a comma separated list of
+        servers, in which case the batches are distributed over the servers
+        in a round robin manner. Failed requests are retried with exponential
+        backoff on the next server.
+    """
 
     @staticmethod
     def get_default_config(updates=None):
         config = ConfigDict()
         config.url = 'http://localhost:5007'
         config.batch_size = 1
+        config.num_workers = 1
+        config.max_retries = 3
+        config.retry_backoff = 1.0
+        config.timeout = 0.0
         config.wait_for_ready = True
+        config.ready_poll_interval = 1.0
+        config.protocol = 'json'
         config.dummy = False
 
         if updates is not None:
@@ -447,18 +1020,27 @@ class LMClient(object):
 
     def __init__(self, config=None):
         self.config = self.get_default_config(config)
+        self.urls = [url.strip() for url in self.config.url.split(',') if url.strip() != '']
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=len(self.urls),
+            pool_maxsize=max(self.config.num_workers, 1),
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         if self.config.wait_for_ready:
             self.wait_for_ready()
 
     def wait_for_ready(self):
         if self.config.dummy:
             return
-        while True:
-            try:
-                requests.get(urllib.parse.urljoin(self.config.url, 'ready'))
-                return
-            except (Timeout, ConnectionError) as e:
-                time.sleep(10)
+        for url in self.urls:
+            while True:
+                try:
+                    self.session.get(urllib.parse.urljoin(url, 'ready'))
+                    break
+                except (Timeout, ConnectionError) as e:
+                    time.sleep(self.config.ready_poll_interval)
 
     @staticmethod
     def batched(iterator, batch_size):
@@ -471,6 +1053,64 @@ class LMClient(object):
         if len(batch) > 0:
             yield batch
 
+    def post(self, endpoint, data, url_index=0, stream=False):
+        """ Post a request to an endpoint, starting from the url_index-th
+            server and retrying on the following servers on failure.
+        """
+        if self.config.protocol == 'msgpack':
+            request_kwargs = dict(
+                data=msgpack.packb(data),
+                headers={
+                    'Content-Type': MSGPACK_CONTENT_TYPE,
+                    'Accept': MSGPACK_CONTENT_TYPE,
+                },
+            )
+        else:
+            assert self.config.protocol == 'json', f'Unknown protocol: {self.config.protocol}'
+            request_kwargs = dict(json=data)
+
+        for retry in range(self.config.max_retries + 1):
+            url = self.urls[(url_index + retry) % len(self.urls)]
+            try:
+                response = self.session.post(
+                    urllib.parse.urljoin(url, endpoint), stream=stream,
+                    timeout=self.config.timeout if self.config.timeout > 0 else None,
+                    **request_kwargs,
+                )
+                response.raise_for_status()
+                return response
+            except (Timeout, ConnectionError, HTTPError) as e:
+                # Client errors are not retried
+                client_error = (
+                    isinstance(e, HTTPError) and e.response is not None
+                    and e.response.status_code < 500
+                )
+                if client_error or retry == self.config.max_retries:
+                    raise
+                absl.logging.warning(
+                    f'Request to {url} failed with {e!r}, retrying.'
+                )
+                time.sleep(self.config.retry_backoff * 2 ** retry)
+
+    @staticmethod
+    def decode_response(response):
+        if response.headers.get('content-type', '').startswith(MSGPACK_CONTENT_TYPE):
+            return msgpack.unpackb(response.content)
+        return response.json()
+
+    def post_batches(self, endpoint, batches):
+        """ Post the requests of a list of batches concurrently, and return
+            the JSON responses in the same order.
+        """
+        with ThreadPoolExecutor(max_workers=max(self.config.num_workers, 1)) as executor:
+            futures = [
+                executor.submit(
+                    lambda i, data: self.decode_response(self.post(endpoint, data, i)), i, data
+                )
+                for i, data in enumerate(batches)
+            ]
+            return [future.result() for future in tqdm(futures, ncols=0)]
+
     def loglikelihood(self, prefix, text):
         prefix, text = list(prefix), list(text)
         if self.config.dummy:
@@ -479,35 +1119,47 @@ class LMClient(object):
         log_likelihood = []
         is_greedy = []
 
-        batched_iterator = list(zip(
-            self.batched(prefix, self.config.batch_size),
-            self.batched(text, self.config.batch_size)
-        ))
-        for batch_prefix, batch_text in tqdm(batched_iterator, ncols=0):
-            response = requests.post(
-                urllib.parse.urljoin(self.config.url, 'loglikelihood'),
-                json={'prefix_text': batch_prefix, 'text': batch_text}
-            ).json()
+        responses = self.post_batches('loglikelihood', [
+            {'prefix_text': batch_prefix, 'text': batch_text}
+            for batch_prefix, batch_text in zip(
+                self.batched(prefix, self.config.batch_size),
+                self.batched(text, self.config.batch_size)
+            )
+        ])
+        for response in responses:
             log_likelihood.extend(response['log_likelihood'])
             is_greedy.extend(response['is_greedy'])
 
         return log_likelihood, is_greedy
 
-    def loglikelihood_rolling(self, text):
+    def loglikelihood_rolling(self, text, return_token_loglikelihood=False):
+        """ Return the loglikelihood of the texts and whether they are greedy,
+            and additionally the loglikelihood of each token of the texts if
+            return_token_loglikelihood is True.
+        """
         text = list(text)
         if self.config.dummy:
+            if return_token_loglikelihood:
+                return [-1.0 for _ in text], [False for _ in text], [[] for _ in text]
             return [-1.0 for _ in text], [False for _ in text]
 
         log_likelihood = []
         is_greedy = []
-        batched_iterator = list(self.batched(text, self.config.batch_size))
-        for batch_text in tqdm(batched_iterator, ncols=0):
-            response = requests.post(
-                urllib.parse.urljoin(self.config.url, 'loglikelihood-rolling'),
-                json={'text': batch_text}
-            ).json()
+        token_log_likelihood = []
+        responses = self.post_batches('loglikelihood-rolling', [
+            {
+                'text': batch_text,
+                'return_token_loglikelihood': return_token_loglikelihood,
+            }
+            for batch_text in self.batched(text, self.config.batch_size)
+        ])
+        for response in responses:
             log_likelihood.extend(response['log_likelihood'])
             is_greedy.extend(response['is_greedy'])
+            if return_token_loglikelihood:
+                token_log_likelihood.extend(response['token_log_likelihood'])
+        if return_token_loglikelihood:
+            return log_likelihood, is_greedy, token_log_likelihood
         return log_likelihood, is_greedy
 
     def greedy_until(self, prefix, until):
@@ -521,46 +1173,98 @@ class LMClient(object):
                     results.append('dummy text ' + u[0])
             return results
 
-        batched_iterator = list(zip(
-            self.batched(prefix, self.config.batch_size),
-            self.batched(until, self.config.batch_size),
-        ))
+        responses = self.post_batches('greedy-until', [
+            {'prefix_text': batch_prefix, 'until': batch_until}
+            for batch_prefix, batch_until in zip(
+                self.batched(prefix, self.config.batch_size),
+                self.batched(until, self.config.batch_size),
+            )
+        ])
         output_text = []
-        for batch_prefix, batch_until in tqdm(batched_iterator, ncols=0):
-            response = requests.post(
-                urllib.parse.urljoin(self.config.url, 'greedy-until'),
-                json={'prefix_text': batch_prefix, 'until': batch_until}
-            ).json()
+        for response in responses:
             output_text.extend(response['output_text'])
         return output_text
 
-    def generate(self, prefix, temperature=None):
+    def generate(self, prefix, temperature=None, max_new_tokens=None, top_k=None,
+                 top_p=None, min_p=None, do_sample=None):
         prefix = list(prefix)
         if self.config.dummy:
             return ['' for _ in prefix]
 
+        responses = self.post_batches('generate', [
+            {
+                'prefix_text': batch_prefix,
+                'temperature': temperature,
+                'max_new_tokens': max_new_tokens,
+                'top_k': top_k,
+                'top_p': top_p,
+                'min_p': min_p,
+                'do_sample': do_sample,
+            }
+            for batch_prefix in self.batched(prefix, self.config.batch_size)
+        ])
         output_text = []
-        batched_iterator = list(self.batched(prefix, self.config.batch_size))
-        for batch_prefix in tqdm(batched_iterator, ncols=0):
-            response = requests.post(
-                urllib.parse.urljoin(self.config.url, 'generate'),
-                json={
-                    'prefix_text': batch_prefix,
-                    'temperature': temperature,
-                }
-            ).json()
+        for response in responses:
             output_text.extend(response['output_text'])
         return output_text
 
+    def iterate_events(self, endpoint, data):
+        """ Iterate over the server-sent events of a streaming endpoint. """
+        with self.post(endpoint, data, stream=True) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith('data: '):
+                    yield json.loads(line[len('data: '):])
+
+    def generate_stream(self, prefix, temperature=None, max_new_tokens=None):
+        """ Yield (index, text) pairs of the text generated for each prefix
+            as soon as it is generated by the server.
+        """
+        prefix = list(prefix)
+        if self.config.dummy:
+            return
+        events = self.iterate_events(
+            'generate-stream',
+            {
+                'prefix_text': prefix,
+                'temperature': temperature,
+                'max_new_tokens': max_new_tokens,
+            }
+        )
+        for event in events:
+            if not event.get('done', False):
+                yield event['index'], event['text']
+
+    def chat_stream(self, prompt, context, temperature=None):
+        """ Yield (text, context) pairs with the text of the response as soon
+            as it is generated by the server. The context is None except for
+            the last pair, where it is the updated context.
+        """
+        if self.config.dummy:
+            yield '', context
+            return
+        events = self.iterate_events(
+            'chat-stream',
+            {
+                'prompt': prompt,
+                'context': context,
+                'temperature': temperature,
+            }
+        )
+        for event in events:
+            if event.get('done', False):
+                yield '', event['context']
+            else:
+                yield event['text'], None
+
     def chat(self, prompt, context, temperature=None):
         if self.config.dummy:
             return ''
-        response = requests.post(
-            urllib.parse.urljoin(self.config.url, 'chat'),
-            json={
+        response = self.decode_response(self.post(
+            'chat',
+            {
                 'prompt': prompt,
                 'context': context,
                 'temperature': temperature,
             }
-        ).json()
+        ))
         return response['response'], response['context']